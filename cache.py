@@ -1,4 +1,17 @@
+from collections import OrderedDict
+from hashlib import md5
+import cPickle
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy
+
 from django.conf import settings
+from sqlite3 import dbapi2 as db
 
 class ResourceCache(object):
     def __init__(self):
@@ -20,4 +33,443 @@ class ResourceCache(object):
         pass
 
 
+DATA_CACHE_PATH = os.path.join(settings.MEDIA_ROOT, '.cache', '_data')
+
+
+class DatasetVersions(object):
+    """A counter per DataResource slug that is bumped whenever the data underneath it changes.  It lives in a sqlite
+    file rather than in process memory so that every worker sees the same version, and outside the resource's own
+    cache directory so that clearing that directory doesn't reset it."""
+
+    def __init__(self):
+        if not os.path.exists(DATA_CACHE_PATH):
+            os.makedirs(DATA_CACHE_PATH)
+        self.conn = db.connect(os.path.join(DATA_CACHE_PATH, 'versions.sqlite'))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS versions (slug text PRIMARY KEY, version integer)")
+        self.conn.commit()
+
+    @classmethod
+    def get(cls):
+        if not hasattr(cls, '_versions'):
+            cls._versions = threading.local()
+        if not hasattr(cls._versions, 'versions'):
+            cls._versions.versions = DatasetVersions()
+
+        return cls._versions.versions
+
+    def version(self, slug):
+        row = self.conn.execute("SELECT version FROM versions WHERE slug=?", [slug]).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, slug):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO versions (slug, version) VALUES (?, coalesce((SELECT version FROM versions WHERE slug=?), 0) + 1)",
+            [slug, slug])
+        self.conn.commit()
+
+
+def dataset_version(slug):
+    return DatasetVersions.get().version(slug)
+
+
+def bump_dataset_version(slug):
+    DatasetVersions.get().bump(slug)
+
+
+class QueryResultCache(object):
+    """
+    Caches the results of REST data API queries.  Entries are keyed on the dataset slug, the dataset version, and the
+    normalized query parameters, so any edit to a dataset makes all of its old entries unreachable without a TTL.
+
+    There are two tiers: a per-process LRU of GA_RESOURCES_QUERY_CACHE_SIZE entries (default 256), and, if
+    GA_RESOURCES_QUERY_CACHE_ON_DISK is set, a directory of JSON files shared by all processes.
+    """
+
+    def __init__(self, max_entries=256, on_disk=False):
+        self.max_entries = max_entries
+        self.on_disk = on_disk
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_cache(cls):
+        if not hasattr(cls, '_cache'):
+            cls._cache = QueryResultCache(
+                max_entries=getattr(settings, 'GA_RESOURCES_QUERY_CACHE_SIZE', 256),
+                on_disk=getattr(settings, 'GA_RESOURCES_QUERY_CACHE_ON_DISK', False)
+            )
+        return cls._cache
+
+    @staticmethod
+    def key(slug, version, params):
+        h = md5()
+        h.update(json.dumps([slug, version, sorted(params.items())]))
+        return h.hexdigest()
+
+    def _disk_path(self, slug, version, key):
+        slug_hash = md5(slug).hexdigest()
+        return os.path.join(DATA_CACHE_PATH, 'query', slug_hash), '{version}-{key}.json'.format(version=version, key=key)
+
+    def get(self, slug, params, version=None):
+        """
+        Return the cached result for a query or None.
+
+        :param version: the dataset version to look up, as read by the caller before it runs the query.  Pass the same
+            version to set(), so that rows read while an edit commits are never stored under the edit's version.
+        """
+        if version is None:
+            version = dataset_version(slug)
+        key = self.key(slug, version, params)
+
+        with self.lock:
+            if key in self.entries:
+                value = self.entries.pop(key)
+                self.entries[key] = value  # most recently used goes to the end
+                return value
+
+        if self.on_disk:
+            path, name = self._disk_path(slug, version, key)
+            if os.path.exists(os.path.join(path, name)):
+                try:
+                    with open(os.path.join(path, name)) as f:
+                        value = json.load(f)
+                except (IOError, ValueError):
+                    return None
+                self._remember(key, value)
+                return value
+
+        return None
+
+    def set(self, slug, params, value, version=None):
+        """Cache the result of a query, run against the dataset as of version.  see get"""
+        if version is None:
+            version = dataset_version(slug)
+        elif version != dataset_version(slug):
+            return  # the dataset changed while the query ran, so the result could never be hit again
+        key = self.key(slug, version, params)
+        self._remember(key, value)
+
+        if self.on_disk:
+            path, name = self._disk_path(slug, version, key)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            prefix = '{version}-'.format(version=version)
+            for stale in os.listdir(path):  # entries from older versions can never be hit again
+                if not stale.startswith(prefix):
+                    try:
+                        os.unlink(os.path.join(path, stale))
+                    except OSError:
+                        pass
+            tmp = os.path.join(path, name + '.tmp' + str(os.getpid()))
+            with open(tmp, 'w') as f:
+                json.dump(value, f)
+            os.rename(tmp, os.path.join(path, name))
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+WFS_CACHE_PATH = os.path.join(DATA_CACHE_PATH, 'wfs')
+
+
+class WFSResultCache(object):
+    """
+    Serialized WFS GetFeature responses, kept as files shared by every process.  Entries are keyed on a fingerprint
+    of the dataset slug, the dataset version and the request's parameters, so an edit to a dataset makes its old
+    entries unreachable at once; their files are deleted when the dataset's features_* signals fire or it is modified.
+
+    The cache is held under GA_RESOURCES_WFS_CACHE_SIZE bytes (default 256MB, 0 to disable) by evicting the least
+    recently used entries, and a response bigger than GA_RESOURCES_WFS_CACHE_MAX_ENTRY bytes (default a tenth of
+    that) is never stored.  When each entry was last used is kept in a sqlite index alongside them.
+    """
+
+    def __init__(self, path=WFS_CACHE_PATH, max_bytes=256 * 1024 * 1024, max_entry_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes // 10
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.conn = db.connect(os.path.join(path, 'index.sqlite'))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key text PRIMARY KEY, slug text, size integer, last_used real)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_slug ON entries (slug)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.conn.commit()
+
+    @classmethod
+    def get(cls):
+        if not hasattr(cls, '_caches'):
+            cls._caches = threading.local()
+        if not hasattr(cls._caches, 'cache'):
+            max_bytes = getattr(settings, 'GA_RESOURCES_WFS_CACHE_SIZE', 256 * 1024 * 1024)
+            cls._caches.cache = WFSResultCache(
+                max_bytes=max_bytes,
+                max_entry_bytes=getattr(settings, 'GA_RESOURCES_WFS_CACHE_MAX_ENTRY', max_bytes // 10)
+            )
+        return cls._caches.cache
+
+    @staticmethod
+    def key(slug, params):
+        h = md5()
+        h.update(json.dumps([slug, dataset_version(slug), sorted(params.items())]))
+        return h.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def open(self, slug, params):
+        """An open file of the cached response to a request, or None"""
+        if not self.max_bytes:
+            return None
+        key = self.key(slug, params)
+        try:
+            f = open(self._filename(key), 'rb')
+        except IOError:
+            return None
+        self.conn.execute("UPDATE entries SET last_used=? WHERE key=?", [time.time(), key])
+        self.conn.commit()
+        return f
+
+    def store(self, slug, params, chunks):
+        """
+        Pass the chunks of a response through, writing them to the cache as they go by.  The entry is added only once
+        the whole response has been written, so a client that hangs up halfway leaves nothing behind.
+        """
+        if not self.max_bytes:
+            for chunk in chunks:
+                yield chunk
+            return
+
+        key = self.key(slug, params)
+        filename = self._filename(key)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        tmp = '{filename}.tmp{pid}.{thread}'.format(filename=filename, pid=os.getpid(), thread=threading.current_thread().ident)
+
+        f = open(tmp, 'wb')
+        size = 0
+        try:
+            for chunk in chunks:
+                if f is not None:
+                    size += len(chunk)
+                    if size > self.max_entry_bytes:
+                        f.close()
+                        f = None
+                        os.unlink(tmp)
+                    else:
+                        f.write(chunk)
+                yield chunk
+
+            if f is not None:
+                f.close()
+                f = None
+                os.rename(tmp, filename)
+                self.conn.execute("INSERT OR REPLACE INTO entries (key, slug, size, last_used) VALUES (?, ?, ?, ?)",
+                                  [key, slug, size, time.time()])
+                self.conn.commit()
+                self.evict()
+        finally:
+            if f is not None:
+                f.close()
+                os.unlink(tmp)
+
+    def _remove(self, keys):
+        for key in keys:
+            try:
+                os.unlink(self._filename(key))
+            except OSError:
+                pass
+        self.conn.executemany("DELETE FROM entries WHERE key=?", [[key] for key in keys])
+        self.conn.commit()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is no bigger than max_bytes"""
+        total = self.conn.execute("SELECT coalesce(sum(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append(key)
+            total -= size
+        self._remove(evicted)
+
+    def invalidate(self, slug):
+        """Remove every entry for a dataset"""
+        self._remove([row[0] for row in self.conn.execute("SELECT key FROM entries WHERE slug=?", [slug]).fetchall()])
+
+
+# Columnar dataframe cache.  A frame is stored as a directory holding meta.json and one file per column, so a
+# reader can load only the columns it needs, and fixed width columns are memory mapped so that every process reading
+# the same cache shares the same pages.  Text and geometry (as WKB) are stored as a byte heap plus offsets, which can
+# also be mapped; only columns of arbitrary python objects fall back to a pickle.
+
+def _is_utf8(value):
+    try:
+        value.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _column_kind(values):
+    if values.dtype != object:
+        return 'array'
+    kinds = set()
+    for value in values:
+        if value is None or (isinstance(value, float) and value != value):
+            continue
+        elif hasattr(value, 'wkb'):
+            kinds.add('wkb')
+        elif isinstance(value, unicode):
+            kinds.add('text')
+        elif isinstance(value, str):
+            kinds.add('str' if _is_utf8(value) else 'blob')  # bytes that aren't utf-8 can't be read back as text
+        elif isinstance(value, buffer):
+            kinds.add('blob')
+        else:
+            return 'pickle'
+
+    if 'str' in kinds:  # utf-8 byte strings go with text or with other byte strings
+        kinds.remove('str')
+        if not kinds & set(['text', 'blob']):
+            kinds.add('text')
+    if len(kinds) > 1:
+        return 'pickle'
+    return kinds.pop() if kinds else 'text'
+
+
+def _write_column(path, name, values, geometry=False):
+    kind = _column_kind(values)
+    if geometry and kind in ('text', 'blob'):  # geometry that was loaded lazily is already WKB
+        kind = 'wkb'
+    if kind == 'array':
+        numpy.save(os.path.join(path, name + '.npy'), values)
+    elif kind == 'pickle':
+        with open(os.path.join(path, name + '.pickle'), 'wb') as f:
+            cPickle.dump(values, f, cPickle.HIGHEST_PROTOCOL)
+    else:
+        nulls = numpy.zeros(len(values), dtype=bool)
+        offsets = numpy.zeros(len(values) + 1, dtype=numpy.int64)
+        heap = []
+        position = 0
+        for i, value in enumerate(values):
+            if value is None or (isinstance(value, float) and value != value):
+                nulls[i] = True
+            else:
+                if kind == 'wkb':
+                    value = value.wkb if hasattr(value, 'wkb') else str(value)
+                elif kind == 'text':
+                    value = value.encode('utf-8') if isinstance(value, unicode) else value
+                else:
+                    value = str(value)
+                heap.append(value)
+                position += len(value)
+            offsets[i + 1] = position
+        heap = ''.join(heap)
+        numpy.save(os.path.join(path, name + '.heap.npy'),
+                   numpy.frombuffer(heap, dtype=numpy.uint8) if heap else numpy.zeros(0, dtype=numpy.uint8))
+        numpy.save(os.path.join(path, name + '.offsets.npy'), offsets)
+        numpy.save(os.path.join(path, name + '.nulls.npy'), nulls)
+    return kind
+
+
+def _load(filename):
+    try:
+        return numpy.load(filename, mmap_mode='r')
+    except ValueError:  # empty arrays can't be mapped
+        return numpy.load(filename)
+
+
+def _read_column(path, name, kind):
+    if kind == 'array':
+        return _load(os.path.join(path, name + '.npy'))
+    elif kind == 'pickle':
+        with open(os.path.join(path, name + '.pickle'), 'rb') as f:
+            return cPickle.load(f)
+    else:
+        heap = _load(os.path.join(path, name + '.heap.npy'))
+        offsets = _load(os.path.join(path, name + '.offsets.npy'))
+        nulls = _load(os.path.join(path, name + '.nulls.npy'))
+        values = numpy.empty(len(nulls), dtype=object)
+        for i in xrange(len(nulls)):
+            if not nulls[i]:
+                value = heap[offsets[i]:offsets[i + 1]].tostring()
+                values[i] = value.decode('utf-8') if kind == 'text' else value
+        return values
+
+
+def columnar_frame_exists(path):
+    return os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def remove_columnar_frame(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):  # a pickle or hdf file left from before the cache was columnar
+        os.unlink(path)
+
+
+def columnar_frame_columns(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return [c['name'] for c in json.load(f)['columns']]
+
+
+def write_columnar_frame(path, df):
+    """Write a dataframe to the columnar cache at path, replacing whatever is there.  Geometry columns are stored as
+    WKB.  The frame is written to a temporary directory first and renamed into place, so readers never see half of it.
+    If another writer puts its frame in place first, this one is discarded."""
+    directory = os.path.dirname(path) or '.'
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + '.tmp', dir=directory)
+
+    meta = {'length': len(df), 'columns': []}
+    for i, name in enumerate(df.columns):
+        kind = _write_column(tmp, 'c' + str(i), df[name].values, geometry=(name == 'geometry'))
+        meta['columns'].append({'name': name, 'kind': kind})
+    meta['index'] = {'name': df.index.name, 'kind': _write_column(tmp, 'index', numpy.asarray(df.index.values))}
+
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    old = tmp + '.old'
+    try:  # move the frame being replaced aside in one step, then remove it once the new one is in place
+        os.rename(path, old)
+    except OSError:
+        pass
+    try:
+        os.rename(tmp, path)
+    except OSError:  # another writer's frame is already in place, and it is as current as this one
+        remove_columnar_frame(tmp)
+    remove_columnar_frame(old)
+
+
+def read_columnar_frame(path, columns=None, lazy_geometry=False):
+    """
+    Read a frame written by write_columnar_frame.
+
+    :param columns: a list of column names to read.  Other columns are never touched.
+    :param lazy_geometry: leave geometry columns as WKB rather than decoding them to shapely objects
+    """
+    from pandas import DataFrame, Index, Series
+
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    index = Index(_read_column(path, 'index', meta['index']['kind']), name=meta['index']['name'])
+    data = OrderedDict()
+    for i, column in enumerate(meta['columns']):
+        if columns is not None and column['name'] not in columns:
+            continue
+        values = _read_column(path, 'c' + str(i), column['kind'])
+        if column['kind'] == 'wkb' and not lazy_geometry:
+            from ga_resources.drivers import decode_wkb
+            values = decode_wkb(values)
+        data[column['name']] = Series(values, index=index, dtype=object if column['kind'] != 'array' else None)
 
+    return DataFrame(data, index=index, columns=list(data.keys()))
@@ -0,0 +1,107 @@
+"""
+Value distributions of a single column, for building choropleth classes: a histogram, class breaks by equal interval,
+quantile and Jenks natural breaks, and the most common values.  Everything is computed with numpy over an array of
+the column's values, which drivers read from the memory mapped dataframe cache or straight from their database.
+"""
+
+import numpy
+import pandas
+
+CLASSIFICATION_METHODS = ('equal_interval', 'quantile', 'jenks')
+JENKS_MAX_VALUES = 1000  # jenks is quadratic in the number of values, so larger columns are classified from a sample
+
+
+def equal_interval_breaks(values, classes):
+    return [float(b) for b in numpy.linspace(values[0], values[-1], classes + 1)]
+
+
+def quantile_breaks(values, classes):
+    breaks = numpy.percentile(values, numpy.linspace(0, 100, classes + 1))
+    return sorted(set(float(b) for b in breaks))
+
+
+def jenks_breaks(values, classes, max_values=JENKS_MAX_VALUES):
+    """
+    Fisher-Jenks natural breaks, by dynamic programming over the sorted values.  Each row of the table is filled with
+    one vectorized pass per value, using cumulative sums for the squared deviation of every candidate class.  Columns
+    of more than max_values values are classified from evenly spaced order statistics.
+    """
+    if len(values) > max_values:
+        values = values[numpy.linspace(0, len(values) - 1, max_values).astype(numpy.int64)]
+    n = len(values)
+    classes = min(classes, len(numpy.unique(values)))
+    if classes < 2:
+        return [float(values[0]), float(values[-1])]
+
+    s1 = numpy.concatenate([[0.0], numpy.cumsum(values)])
+    s2 = numpy.concatenate([[0.0], numpy.cumsum(values * values)])
+
+    def deviation(first, last):  # squared deviation of values[first:last+1] for an array of firsts
+        total = s1[last + 1] - s1[first]
+        return s2[last + 1] - s2[first] - total * total / (last + 1 - first)
+
+    ends = numpy.arange(n)
+    cost = numpy.empty((classes, n))
+    cost[0] = s2[1:] - s1[1:] * s1[1:] / (ends + 1)
+    start = numpy.zeros((classes, n), dtype=numpy.int64)
+    for k in range(1, classes):
+        cost[k, :k] = numpy.inf
+        for last in range(k, n):
+            firsts = numpy.arange(k, last + 1)
+            candidates = cost[k - 1, firsts - 1] + deviation(firsts, last)
+            best = numpy.argmin(candidates)
+            cost[k, last] = candidates[best]
+            start[k, last] = firsts[best]
+
+    breaks = [float(values[-1])]
+    last = n - 1
+    for k in range(classes - 1, 0, -1):
+        first = start[k, last]
+        breaks.append(float(values[first - 1]))
+        last = first - 1
+    breaks.append(float(values[0]))
+    return breaks[::-1]
+
+
+def top_values(series, top):
+    counts = series.value_counts()[:top]
+    return [[value.item() if hasattr(value, 'item') else value, int(count)] for value, count in counts.iteritems()]
+
+
+def distribution(values, bins=10, classes=5, methods=CLASSIFICATION_METHODS, top=10):
+    """
+    Describe the distribution of an array of values.
+
+    :param bins: number of equal width histogram bins
+    :param classes: number of classes for each classification method
+    :param methods: classification methods to compute breaks for, from CLASSIFICATION_METHODS
+    :param top: number of most common values to list
+    :return: a dict of count, nulls, top and, for numeric columns, min, max, histogram and breaks.  breaks maps each
+        method to a list of class edges from the minimum to the maximum.
+    """
+    series = pandas.Series(values)
+    present = series.dropna()
+    result = {
+        'count': int(present.size),
+        'nulls': int(series.size - present.size),
+        'top': top_values(present, top)
+    }
+
+    if series.dtype.kind in 'iuf' and present.size:
+        numbers = numpy.sort(present.values.astype(numpy.float64))
+        counts, edges = numpy.histogram(numbers, bins=bins)
+        result['min'] = float(numbers[0])
+        result['max'] = float(numbers[-1])
+        result['histogram'] = {'counts': [int(c) for c in counts], 'edges': [float(e) for e in edges]}
+        result['breaks'] = {}
+        for method in methods:
+            if method == 'equal_interval':
+                result['breaks'][method] = equal_interval_breaks(numbers, classes)
+            elif method == 'quantile':
+                result['breaks'][method] = quantile_breaks(numbers, classes)
+            elif method == 'jenks':
+                result['breaks'][method] = jenks_breaks(numbers, classes)
+            else:
+                raise ValueError('unknown classification method {method}'.format(method=method))
+
+    return result
@@ -3,10 +3,12 @@ import cPickle
 import shutil
 from collections import OrderedDict
 from hashlib import md5
+from itertools import izip
 from datetime import datetime
 from urllib2 import urlopen
 import time
 import math
+import numpy
 from sqlite3 import dbapi2 as db
 
 from django.utils.timezone import utc
@@ -18,7 +20,10 @@ import sh
 import requests
 import re
 from django.conf import settings
-from ga_resources import predicates
+from ga_resources import classification, predicates, sketches
+from ga_resources.spatialrefs import proj4, spatial_reference, transformation, transform_point, transform_points
+from ga_resources.cache import bump_dataset_version, dataset_version, columnar_frame_exists, read_columnar_frame, \
+    remove_columnar_frame, write_columnar_frame
 
 
 try:
@@ -26,11 +31,193 @@ try:
 except ImportError:
    import mapnik2 as mapnik
 
-from osgeo import osr
 
 VECTOR = False
 RASTER = True
 
+DATAFRAME_BATCH_SIZE = getattr(settings, 'GA_RESOURCES_DATAFRAME_BATCH_SIZE', 10000)
+SUMMARY_SAMPLE_ROWS = getattr(settings, 'GA_RESOURCES_SUMMARY_SAMPLE_ROWS', 100000)
+SIMPLIFY_PIXELS = getattr(settings, 'GA_RESOURCES_SIMPLIFY_PIXELS', 0.5)  # detail smaller than this is dropped at a zoom level
+WEB_MERCATOR_PIXEL_SIZE = 156543.03392804097  # metres per pixel of a 256 pixel tile at zoom 0
+GENERALIZED_ZOOMS = getattr(settings, 'GA_RESOURCES_GENERALIZED_ZOOMS', (3, 5, 7, 9, 11))  # zooms to pregeneralize vectors for at ingest
+
+
+def zoom_tolerance(zoom, srs, pixels=None):
+    """
+    The simplification tolerance, in the units of srs, that removes detail smaller than pixels (default
+    GA_RESOURCES_SIMPLIFY_PIXELS) pixels when drawn on a web map at zoom.  srs is a SpatialReference; without one,
+    coordinates are assumed to be in metres.
+    """
+    pixels = SIMPLIFY_PIXELS if pixels is None else pixels
+    if srs is not None and srs.IsGeographic():
+        pixel_size = 360.0 / 256 / 2 ** zoom
+    else:
+        metres = srs.GetLinearUnits() if srs is not None else 1.0  # metres per unit, such as 0.3048 for feet
+        pixel_size = WEB_MERCATOR_PIXEL_SIZE / 2 ** zoom / (metres or 1.0)
+    return pixel_size * pixels
+
+
+def scale_zoom(bbox, width, srs):
+    """
+    The web map zoom level, rounded up, whose pixels are the size of the pixels of an image of bbox width pixels
+    across.  srs is anything spatial_reference accepts, such as a proj4 string.
+    """
+    pixel_size = float(bbox[2] - bbox[0]) / width
+    if pixel_size <= 0:
+        return None
+    reference = spatial_reference(srs)
+    if reference.IsGeographic():
+        zoom_0 = 360.0 / 256
+    else:
+        zoom_0 = WEB_MERCATOR_PIXEL_SIZE
+        pixel_size *= reference.GetLinearUnits() or 1.0
+    return max(0, int(math.ceil(math.log(zoom_0 / pixel_size, 2) - 0.01)))
+
+
+def round_coordinates(geometry, precision):
+    """Round the coordinates of a GeoJSON geometry mapping to precision decimal places"""
+    def rnd(coordinates):
+        if isinstance(coordinates, (int, long, float)):
+            return round(coordinates, precision)
+        return [rnd(c) for c in coordinates]
+
+    geometry = dict(geometry)
+    if 'geometries' in geometry:
+        geometry['geometries'] = [round_coordinates(g, precision) for g in geometry['geometries']]
+    elif 'coordinates' in geometry:
+        geometry['coordinates'] = rnd(geometry['coordinates'])
+    return geometry
+
+
+def simplify_dataframe(df, tolerance=None, precision=None):
+    """Simplify, preserving topology, and/or round the coordinates of the shapely geometries of a dataframe in place"""
+    from shapely.geometry import shape, mapping
+
+    if tolerance:
+        df['geometry'] = [g.simplify(tolerance, preserve_topology=True) if g is not None else None for g in df['geometry']]
+    if precision is not None:
+        df['geometry'] = [shape(round_coordinates(mapping(g), precision)) if g is not None else None for g in df['geometry']]
+    return df
+
+
+def decode_wkb(values):
+    """Decode a sequence of WKB strings or buffers into a list of shapely geometries.  Empty and unreadable values
+    become None."""
+    from shapely import wkb
+
+    loads = wkb.loads
+    geometries = []
+    for value in values:
+        try:
+            geometries.append(loads(str(value)) if value is not None else None)
+        except Exception:
+            geometries.append(None)
+    return geometries
+
+
+def decode_geometry(df):
+    """Decode a dataframe loaded with lazy_geometry=True in place, so its geometry column holds shapely objects"""
+    if 'geometry' in df:
+        sample = df['geometry'].dropna()
+        if len(sample) and isinstance(sample.iloc[0], (basestring, buffer)):
+            df['geometry'] = decode_wkb(df['geometry'])
+    return df
+
+
+def _typed_batch(values, dtype):
+    """
+    A batch of a column's values as a numpy array of dtype.  Nulls become NaN, so integer columns with nulls become
+    float64 as they would in pandas, and boolean columns with nulls stay python objects.
+    """
+    if dtype.kind == 'f' or not any(v is None for v in values):
+        return numpy.array(values, dtype=dtype)
+    elif dtype.kind in 'iu':
+        return numpy.array([numpy.nan if v is None else v for v in values], dtype=numpy.float64)
+    else:
+        return numpy.array(values, dtype=object)
+
+
+def dataframe_from_cursor(cursor, geometry_column, start=0, lazy_geometry=False, batch_size=None, type_codes=None):
+    """
+    Build a DataFrame from a cursor over "SELECT AsBinary(geometry_column), * FROM ...".
+
+    Rows are pulled with fetchmany and transposed straight into columns, so no per-row dict or record list is built,
+    and each column is handed to pandas separately so it can pick a typed dtype for it.  The native geometry column
+    is dropped and the WKB becomes the 'geometry' column, decoded to shapely in a single pass at the end or left as
+    raw WKB if lazy_geometry is True (see decode_geometry).
+
+    :param start: number of leading rows to discard
+    :param type_codes: dict of cursor.description type codes to numpy dtypes.  Columns of those types are packed into
+        typed arrays a batch at a time, instead of being held as lists of python objects until the end.
+    """
+    from pandas import DataFrame, Series
+
+    batch_size = batch_size or DATAFRAME_BATCH_SIZE
+    type_codes = type_codes or {}
+
+    while start > 0:
+        rows = cursor.fetchmany(min(start, batch_size))
+        if not rows:
+            break
+        start -= len(rows)
+
+    rows = cursor.fetchmany(batch_size)
+    names = [c[0] for c in cursor.description]  # server side cursors only describe themselves after the first fetch
+    dtypes = [numpy.dtype(type_codes[c[1]]) if i != 0 and c[1] in type_codes else None
+              for i, c in enumerate(cursor.description)]
+    lowered = [name.lower() for name in names[1:]]
+    throwaway_ix = lowered.index(geometry_column.lower()) + 1 if geometry_column.lower() in lowered else None
+
+    columns = [[] for _ in names]
+    while rows:
+        for column, dtype, values in zip(columns, dtypes, zip(*rows)):
+            if dtype is None:
+                column.extend(values)
+            else:
+                column.append(_typed_batch(values, dtype))
+        rows = cursor.fetchmany(batch_size)
+
+    wkbs = columns[0]
+    data = OrderedDict()
+    for i, name in enumerate(names):
+        if i != 0 and i != throwaway_ix:
+            if dtypes[i] is None:
+                data[name] = Series(columns[i])
+            else:
+                data[name] = Series(numpy.concatenate(columns[i]) if columns[i] else numpy.empty(0, dtype=dtypes[i]))
+        columns[i] = None  # let go of each list as soon as pandas has its own copy
+    data['geometry'] = Series(wkbs if lazy_geometry else decode_wkb(wkbs), dtype=object)
+
+    return DataFrame(data, columns=list(data.keys()))
+
+
+def features_from_cursor(cursor, geometry_column, start=0, batch_size=None):
+    """
+    Iterate over a cursor over "SELECT AsBinary(geometry_column), * FROM ..." one feature at a time, as (properties,
+    WKB) pairs, where properties is an OrderedDict of the other columns.  Rows are pulled batch_size at a time, so
+    only a batch is ever held in memory.  The cursor is closed when the rows run out.
+
+    :param start: number of leading rows to discard
+    """
+    batch_size = batch_size or DATAFRAME_BATCH_SIZE
+
+    while start > 0:
+        rows = cursor.fetchmany(min(start, batch_size))
+        if not rows:
+            break
+        start -= len(rows)
+
+    rows = cursor.fetchmany(batch_size)
+    names = [c[0] for c in cursor.description]
+    lowered = [name.lower() for name in names]
+    keep = [i for i in range(1, len(names)) if lowered[i] != geometry_column.lower()]
+    while rows:
+        for row in rows:
+            yield OrderedDict((names[i], row[i]) for i in keep), row[0]
+        rows = cursor.fetchmany(batch_size)
+    cursor.close()
+
+
 class Driver(object):
     """Abstract class that defines a number of reusable methods to load geographic data and create services from it"""
     def __init__(self, data_resource):
@@ -146,6 +333,11 @@ class Driver(object):
         """True if the REST API is supported for data sources"""
         return True
 
+    @classmethod
+    def supports_vector_tiles(cls):
+        """True if the driver can make Mapbox vector tiles of its data with vector_tile(z, x, y)"""
+        return False
+
     @classmethod
     def supports_local_caching(cls):
         """True if the whole resource is downloaded and cached locally.  False for stream-based drivers"""
@@ -197,6 +389,21 @@ class Driver(object):
                 self.resource.last_change = datetime.utcnow().replace(tzinfo=utc)
 
 
+    def data_changed(self, added=None, removed=None):
+        """
+        Record that the data underneath this resource has changed, invalidating results cached against it.
+
+        :param added: the rows that were added, as dicts of column name to value.  For an update, the new values of
+            only the columns that changed.
+        :param removed: the rows that were removed, or for an update the old values of the changed columns.
+
+        If either of added or removed is given, the cached summary is updated in place rather than dropped.
+        """
+        key = self._summary_key()
+        bump_dataset_version(self.resource.slug)
+        self.clear_dataframe_cache()
+        self._update_summary(key, added, removed)
+
     def get_metadata(self, **kwargs):
         """Abstract. If there is metadata conforming to some standard, then return it here"""
         return {}
@@ -234,32 +441,20 @@ class Driver(object):
         """
         _, nativesrs, result = self.ready_data_resource(**kwargs)
 
-        s_srs = osr.SpatialReference()
+        s_srs = spatial_reference(srs)
         t_srs = nativesrs
 
-        if isinstance(srs, osr.SpatialReference):
-            s_srs = srs
-        elif srs.lower().startswith('epsg'):
-            s_srs.ImportFromEPSG(int(srs.split(':')[-1]))
-        else:
-            s_srs.ImportFromProj4(srs.encode('ascii'))
-
-        crx = osr.CoordinateTransformation(s_srs, t_srs)
-        x1, y1, _ = crx.TransformPoint(wherex, wherey)
+        x1, y1 = transform_point(wherex, wherey, s_srs, t_srs)
         
         # transform wherex and wherey to 3857 and then add $fuzziness meters to them
         # transform the fuzzy coords to $nativesrs
         # substract fuzzy coords from x1 and y1 to get the fuzziness needed in the native coordinate space
         epsilon = 0
         if fuzziness > 0:
-           meters = osr.SpatialReference()
-           meters.ImportFromEPSG(3857) # use web mercator for meters
-           nat2met = osr.CoordinateTransformation(s_srs, meters) # switch from the input srs to the metric one
-           met2nat = osr.CoordinateTransformation(meters, t_srs) # switch from the metric srs to the native one
-           mx, my, _ = nat2met.TransformPoint(wherex, wherey) # calculate the input coordinates in meters
+           mx, my = transform_point(wherex, wherey, s_srs, 3857) # calculate the input coordinates in meters, using web mercator
            fx = mx+fuzziness # add metric fuzziness to the x coordinate only to get a radius
            fy = my 
-           fx, fy, _ = met2nat.TransformPoint(fx, fy)
+           fx, fy = transform_point(fx, fy, 3857, t_srs) # switch from the metric srs to the native one
            epsilon = fx - x1 # the geometry should be buffered by this much
         elif 'bbox' in kwargs and 'width' in kwargs and 'height' in kwargs:
            # use the bounding box to calculate a radius of 8 pixels around the input point
@@ -268,59 +463,271 @@ class Driver(object):
            height = int(kwargs['height']) # the tile height in pixels
            dy = (maxy-miny)/height # the height delta in native coordinate units between pixels
            dx = (maxx-minx)/width # the width delta in native coordinate units between pixels
-           x2, y2, _ = crx.TransformPoint(wherex+dx*8, wherey) # return a point 8 pixels to the right of the source point in native coordinate units
+           x2, y2 = transform_point(wherex+dx*8, wherey, s_srs, t_srs) # return a point 8 pixels to the right of the source point in native coordinate units
            epsilon = x2 - x1 # the geometry should be buffered by this much
         else:
            pass
 
         return result, x1, y1, epsilon
 
+    def native_points(self, points, srs, fuzziness=0, **kwargs):
+        """
+        The vectorized counterpart of get_data_for_point's coordinate handling: transform many points to the native
+        coordinate system at once.
+
+        :param points: a sequence of (x, y) pairs in srs
+        :param srs: a spatial reference system, either as a string EPSG:#### or PROJ.4 string, or as an osr.SpatialReference
+        :param fuzziness: as for get_data_for_point
+        :return: a four-tuple of the ready_data_resource result, arrays of the native x and y coordinates, and an array
+            of the distance in native units around each point that features should be pulled from
+        """
+        _, nativesrs, result = self.ready_data_resource(**kwargs)
+
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        x1, y1 = transform_points(points[:, 0], points[:, 1], srs, nativesrs)
+
+        epsilon = numpy.zeros(len(points))
+        if fuzziness > 0:
+            mx, my = transform_points(points[:, 0], points[:, 1], srs, 3857)
+            epsilon = transform_points(mx + fuzziness, my, 3857, nativesrs)[0] - x1
+        elif 'bbox' in kwargs and 'width' in kwargs:
+            minx, miny, maxx, maxy = kwargs['bbox']
+            dx = (maxx - minx) / int(kwargs['width'])
+            # 8 pixels to the right of each point, as in get_data_for_point
+            epsilon = transform_points(points[:, 0] + dx * 8, points[:, 1], srs, nativesrs)[0] - x1
+
+        return result, x1, y1, epsilon
+
+    def get_data_for_points(self, points, srs, fuzziness=0, **kwargs):
+        """
+        Get data for many x,y points in one call, for sampling a layer at a set of locations.  Drivers that can look up
+        all the points in one pass over their data override this; the default looks them up one at a time.
+
+        :param points: a sequence of (x, y) pairs in srs
+        :param srs: a spatial reference system, either as a string EPSG:#### or PROJ.4 string, or as an osr.SpatialReference
+        :param fuzziness: the distance in meters around each point that features data should be pulled from
+        :return: a list with an entry for each point, in the same order, of what get_data_for_point returns for it
+        """
+        return [self.get_data_for_point(x, y, srs, fuzziness=fuzziness, **kwargs) for x, y in points]
+
     def as_dataframe(self, **kwargs):
         """Return the entire dataset as a pandas dataframe"""
 
         raise NotImplementedError("This driver does not support dataframes")
 
-    def summary(self, **kwargs):
-        """Requires dataframe support.  Return a summary of the dataframe using pandas's standard methods and our own
-        predicates"""
+    def feature_rows(self, **kwargs):
+        """
+        The features as_dataframe(**kwargs) selects as (properties, geometry) pairs in native coordinates, where the
+        geometry is WKB or shapely.  This goes through the dataframe; drivers that read from a database override it to
+        stream rows from a cursor instead.
+        """
+        df = self.as_dataframe(**kwargs)
+        columns = [c for c in df.columns if c != 'geometry']
+        for values in izip(*[df[c].values for c in columns + ['geometry']]):
+            yield OrderedDict(izip(columns, values[:-1])), values[-1]
+
+    def iter_features(self, srs=None, tolerance=None, precision=None, **kwargs):
+        """
+        Iterate over the features selected by the as_dataframe filters as (properties, shapely geometry) pairs.  For
+        output formats that can be written a feature at a time, so that nothing the size of the result is built.
+
+        :param srs: the coordinate system of the bbox and of the features returned, if not the native one
+        :param tolerance: simplify geometries, preserving topology, to this tolerance in native units
+        :param precision: round coordinates to this many decimal places
+        """
+        from shapely import wkb
+        from shapely.geometry import mapping, shape
+        from shapely.ops import transform
+
+        # feature_rows works in native coordinates, so the bbox goes in native and the features come out reprojected
+        # here, once.  as_dataframe would reproject them itself if it were given the srs.
+        reproject = None
+        if srs is not None and proj4(srs) != proj4(self.resource.srs):
+            reproject = lambda xs, ys: transform_points(xs, ys, self.resource.srs, srs)
+            if kwargs.get('bbox', None) is not None:
+                minx, miny, maxx, maxy = kwargs['bbox']
+                xs, ys = transform_points([minx, minx, maxx, maxx], [miny, maxy, miny, maxy], srs, self.resource.srs)
+                kwargs['bbox'] = (xs.min(), ys.min(), xs.max(), ys.max())
+
+        for properties, geometry in self.feature_rows(**kwargs):
+            if geometry is not None and not hasattr(geometry, 'geom_type'):
+                try:
+                    geometry = wkb.loads(str(geometry))
+                except Exception:
+                    geometry = None
+            if geometry is not None:
+                if tolerance:
+                    geometry = geometry.simplify(tolerance, preserve_topology=True)
+                if reproject:
+                    geometry = transform(reproject, geometry)
+                if precision is not None:
+                    geometry = shape(round_coordinates(mapping(geometry), precision))
+            yield properties, geometry
+
+    def cached_dataframe(self, load, source=None, columns=None, lazy_geometry=False):
+        """
+        The unfiltered dataframe for this resource, from memory, from the columnar cache at get_filename('dfx'), or
+        by calling load() and caching what it returns.  load() should leave geometry as WKB.
+
+        :param source: a file that the cache is stale with respect to if it has been modified since the cache was written
+        :param columns: a list of columns to read.  The others are never read from disk.
+        :param lazy_geometry: leave the geometry column as WKB.  see decode_geometry
+        """
+        if hasattr(self, '_df'):
+            return self._df[columns] if columns else self._df
+
+        dfx_path = self.get_filename('dfx')
+        df = None
+        if columnar_frame_exists(dfx_path) and (source is None or os.stat(dfx_path).st_mtime >= os.stat(source).st_mtime):
+            try:
+                df = read_columnar_frame(dfx_path, columns=columns, lazy_geometry=lazy_geometry)
+            except (IOError, OSError, ValueError, KeyError):
+                remove_columnar_frame(dfx_path)
+
+        if df is None:
+            df = load()
+            try:
+                write_columnar_frame(dfx_path, df)
+            except (IOError, OSError):  # the frame is still good without the cache; the next call tries again
+                pass
+            if columns:
+                df = df[columns]
+            if not lazy_geometry:
+                decode_geometry(df)
+
+        if not columns and not lazy_geometry:
+            self._df = df
+        return df
+
+    def clear_dataframe_cache(self):
+        if hasattr(self, '_df'):
+            del self._df
+        remove_columnar_frame(self.get_filename('dfx'))
+
+    def select_column(self, column):
+        """Abstract. Read the values of one column straight from the data source, as an array"""
+        raise NotImplementedError("This driver does not support reading single columns")
+
+    def column_values(self, column):
+        """The values of one column as an array.  If the dataframe cache has been built only that column is read from
+        it, otherwise the driver reads it from its source with select_column if it can."""
+        if hasattr(self, '_df'):
+            return self._df[column].values
+
+        dfx_path = self.get_filename('dfx')
+        if columnar_frame_exists(dfx_path):
+            return read_columnar_frame(dfx_path, columns=[column], lazy_geometry=True)[column].values
+
+        try:
+            return self.select_column(column)
+        except NotImplementedError:
+            return self.as_dataframe()[column].values
+
+    def column_distribution(self, column, **kwargs):
+        """The distribution of a column's values: histogram, class breaks and most common values.  Keyword arguments
+        are passed to ga_resources.classification.distribution"""
+        return classification.distribution(self.column_values(column), **kwargs)
 
+    def _summary_key(self):
+        return self.resource.md5sum, self.resource.last_change, dataset_version(self.resource.slug)
+
+    def _cached_summary(self, key=None):
+        """The cached summary record for this resource if there is one and it is current as of key"""
         sum_path = self.get_filename('sum')
-        if self.resource.big and os.path.exists(sum_path):
+        if not os.path.exists(sum_path):
+            return None
+        try:
             with open(sum_path) as sm:
-                return cPickle.load(sm)
+                cached = cPickle.load(sm)
+        except Exception:
+            return None
+        if not isinstance(cached, dict) or cached.get('key') != (key or self._summary_key()):
+            return None
+        return cached
 
-        df = self.as_dataframe(**kwargs)
-        keys = [k for k in df.keys() if k != 'geometry']
-        type_table = {
-            'float64': 'number',
-            'int64': 'number',
-            'object': 'text'
+    def _write_summary(self, state, summary=None):
+        cached = {
+            'key': self._summary_key(),
+            'state': state,
+            'summary': summary or [predicates.column_summary(name, column) for name, column in state.items()]
         }
+        sum_path = self.get_filename('sum')
+        tmp = sum_path + '.tmp' + str(os.getpid())
+        with open(tmp, 'w') as sm:
+            cPickle.dump(cached, sm, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, sum_path)
+        return cached['summary']
+
+    def has_cached_summary(self):
+        return self._cached_summary() is not None
+
+    def _update_summary(self, key, added, removed):
+        """Fold edited rows into the summary cached under key and re-cache it under the current key.  If the change
+        can't be folded in exactly the cached summary is dropped and the next call to summary() rescans."""
+        sum_path = self.get_filename('sum')
+        cached = self._cached_summary(key) if (added is not None or removed is not None) else None
+        if cached is not None and cached['state'] is not None:  # approximate summaries can't be updated
+            state = cached['state']
+            exact = True
+            for name, column in state.items():
+                exact = exact and predicates.update_column_state(
+                    column,
+                    added=[row[name] for row in added or () if name in row],
+                    removed=[row[name] for row in removed or () if name in row])
+            if exact:
+                self._write_summary(state)
+                return
+
+        if os.path.exists(sum_path):
+            os.unlink(sum_path)
+
+    def attribute_batches(self, sample=None, batch_size=None):
+        """
+        Abstract. Stream the non-geometry columns of the dataset for approximate_summary, without loading it.
+
+        :param sample: the fraction of rows to read, or None to pick one that reads about SUMMARY_SAMPLE_ROWS rows.
+        :return: a tuple of (column names, fraction of rows actually sampled, iterator over lists of row tuples).  A
+            driver that samples whole blocks of rows must yield each block as one sketches.Block, so that the errors
+            of the summary account for rows of a block being alike.
+        """
+        raise NotImplementedError("This driver does not support streaming attributes")
+
+    def approximate_summary(self, sample=None, confidence=0.95):
+        """A summary computed in bounded memory from a sample of rows streamed through sketches.  Each column carries
+        'approximate', 'sample' and 'error' keys giving the bounds of its estimates.  See ga_resources.sketches"""
+        names, fraction, batches = self.attribute_batches(sample=sample)
+        column_sketches = [sketches.ColumnSketch() for _ in names]
+        for rows in batches:
+            for sketch, values in zip(column_sketches, zip(*rows)):
+                sketch.add(values)
+            if isinstance(rows, sketches.Block):
+                for sketch in column_sketches:
+                    sketch.end_block()
+        return [sketch.summary(name, fraction, confidence) for name, sketch in zip(names, column_sketches)]
+
+    def summary(self, **kwargs):
+        """Requires dataframe support.  Return a summary of the dataframe using pandas's standard methods and our own
+        predicates.  The summary of the whole dataset is cached and kept current through data_changed().  Big
+        resources are summarized approximately if the driver can stream its attributes."""
 
-        ctx = [{'name': k} for k in keys]
-        for i, k in enumerate(keys):
-            s = df[k]
-            ctx[i]['kind'] = type_table[s.dtype.name]
-            ctx[i]['tags'] = [tag for tag in [
-                'unique' if predicates.unique(s) else None,
-                'not null' if predicates.not_null(s) else None,
-                'null' if predicates.some_null(s) else None,
-                'empty' if predicates.all_null(s) else None,
-                'categorical' if predicates.categorical(s) else None,
-                'open ended' if predicates.continuous(s) else None,
-                'mostly null' if predicates.mostly_null(s) else None,
-                'uniform' if predicates.uniform(s) else None
-            ] if tag]
-            if 'categorical' in ctx[i]['tags']:
-                ctx[i]['uniques'] = [x for x in s.unique()]
-            for k, v in s.describe().to_dict().items():
-                ctx[i][k] = v
+        if not kwargs:
+            cached = self._cached_summary()
+            if cached is not None:
+                return cached['summary']
 
-        if self.resource.big:
-            with open(sum_path, 'w') as sm:
-                cPickle.dump(ctx, sm)
+            if self.resource.big:
+                try:
+                    return self._write_summary(None, self.approximate_summary())
+                except NotImplementedError:
+                    pass
+
+        df = self.as_dataframe(**kwargs)
+        state = OrderedDict((k, predicates.column_state(df[k])) for k in df.keys() if k != 'geometry')
 
-        return ctx
+        if kwargs:
+            return [predicates.column_summary(name, column) for name, column in state.items()]
+        else:
+            return self._write_summary(state)
 
 
 
@@ -361,8 +768,10 @@ LAYER_CACHE_PATH = os.path.join(s.MEDIA_ROOT, '.cache', '_cached_layers')
 if not os.path.exists(LAYER_CACHE_PATH):
     sh.mkdir('-p', LAYER_CACHE_PATH)
 
-def cache_entry_name(layers, srs, styles, bgcolor=None, transparent=True, query=None):
+def cache_entry_name(layers, srs, styles, bgcolor=None, transparent=True, query=None, generalized=None):
     d = OrderedDict(layers=layers, srs=srs, styles=styles, bgcolor=bgcolor, transparent=transparent)
+    if generalized:  # the generalized tables layers are drawn from at this zoom, if any
+        d['generalized'] = generalized
     if query: # insert the query keys, but ensure a consistent order
         keys = sorted(query.keys())
         for k in keys:
@@ -381,14 +790,9 @@ def prepare_wms(layers, srs, styles, bgcolor=None, transparent=True, **kwargs):
     if not os.path.exists(LAYER_CACHE_PATH):
         os.makedirs(LAYER_CACHE_PATH)  # just in case it's not there yet.
 
-    cached_filename = cache_entry_name(
-        layers, srs, styles,
-        bgcolor=bgcolor,
-        transparent=transparent,
-        query=kwargs['query'] if 'query' in kwargs else None
-    )
-
     layer_specs = []
+    generalized = []
+    zoom = kwargs.get('zoom', None)
     for layer in layers:
         if "#" in layer:
             layer, kwargs['sublayer'] = layer.split("#") 
@@ -396,6 +800,17 @@ def prepare_wms(layers, srs, styles, bgcolor=None, transparent=True, **kwargs):
         driver = rendered_layer.data_resource.driver_instance
         layer_spec = driver.ready_data_resource(**kwargs)
         layer_specs.append((rendered_layer, layer_spec))
+        if zoom is not None and 'sublayer' not in kwargs and hasattr(driver, 'generalized_table'):
+            generalized.append(driver.generalized_table(zoom))
+
+    # zooms that draw from the same tables share a mapfile.  layers without generalized tables get just one
+    cached_filename = cache_entry_name(
+        layers, srs, styles,
+        bgcolor=bgcolor,
+        transparent=transparent,
+        query=kwargs['query'] if 'query' in kwargs else None,
+        generalized=generalized if any(generalized) else None
+    )
 
     if not os.path.exists(cached_filename + ".xml"):  # not an else as previous clause may remove file.
         try:
@@ -448,6 +863,8 @@ def render(fmt, width, height, bbox, srs, styles, layers, **kwargs):
         else:
             srs = "+init=" + srs.lower()
 
+    if kwargs.get('zoom', None) is None:
+        kwargs['zoom'] = scale_zoom(bbox, width, srs)
     name = prepare_wms(layers, srs, styles, **kwargs)
     filename = "{name}.{bbox}.{width}x{height}.{fmt}".format(
         name=name,
@@ -517,14 +934,15 @@ class CacheManager(object):
 
         if os.path.exists(self.cachename):
             conn = db.connect(self.cachename)
+            self._upgrade_directory(conn)
         else:
             conn = db.connect(self.cachename)
             cursor = conn.cursor()
             cursor.executescript("""
                 BEGIN TRANSACTION;
                 CREATE TABLE caches (name text PRIMARY KEY, kind text);
-                CREATE TABLE layers (slug text primary key, cache_name text);
-                CREATE TABLE styles (slug text primary key, cache_name text);
+                CREATE TABLE layers (slug text, cache_name text, PRIMARY KEY (slug, cache_name));
+                CREATE TABLE styles (slug text, cache_name text, PRIMARY KEY (slug, cache_name));
                 END TRANSACTION;
                 ANALYZE;
                 VACUUM;
@@ -533,6 +951,22 @@ class CacheManager(object):
 
         self.conn = conn
 
+    @staticmethod
+    def _upgrade_directory(conn):
+        """Rekey directories made when a layer or style could only be in one cache, so every cache of a layer (its
+        rendered tiles, vector tiles, and each set of styles) is found and shaved"""
+        for table in ('layers', 'styles'):
+            sql, = conn.execute("select sql from sqlite_master where type='table' and name=?", [table]).fetchone()
+            if 'PRIMARY KEY (slug, cache_name)' not in sql:
+                conn.executescript("""
+                    BEGIN TRANSACTION;
+                    ALTER TABLE {table} RENAME TO {table}_old;
+                    CREATE TABLE {table} (slug text, cache_name text, PRIMARY KEY (slug, cache_name));
+                    INSERT OR IGNORE INTO {table} SELECT slug, cache_name FROM {table}_old;
+                    DROP TABLE {table}_old;
+                    END TRANSACTION;
+                """.format(table=table))
+
     @classmethod
     def get(cls):
         import threading
@@ -578,6 +1012,28 @@ class CacheManager(object):
         return self.tile_caches[name]
 
 
+    def get_vector_tile_cache(self, layers):
+        layers = [layer if isinstance(layer, basestring) else layer.slug for layer in layers]
+        name = cache_entry_name(
+            layers,
+            "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null",
+            [],
+            query={'format': 'pbf'}
+        )
+
+        c = self.conn.cursor()
+        c.execute("INSERT OR REPLACE INTO caches (name, kind) VALUES (:name, :kind)", { "name" : name, "kind" : "vector" })
+        for layer in layers:
+            c.execute("INSERT OR REPLACE INTO layers (slug, cache_name) VALUES (:layer, :name)", {
+                "layer" : layer,
+                "name" : name
+            })
+        self.conn.commit()
+
+        if name not in self.tile_caches:
+            self.tile_caches[name] = VectorTileCache(layers)
+        return self.tile_caches[name]
+
     def get_wms_cache(self, layers, srs, styles, **kwargs):
         name = cache_entry_name(
             layers, srs, styles,
@@ -684,11 +1140,6 @@ class MBTileCache(object):
         self.styles = styles if not isinstance(styles, basestring) else [styles]
 
         self.kwargs = kwargs
-        e4326 = osr.SpatialReference()
-        e3857 = osr.SpatialReference()
-        e4326.ImportFromEPSG(4326)
-        e3857.ImportFromEPSG(3857)
-        self.crx = osr.CoordinateTransformation(e4326, e3857)
 
         paths = os.path.split(self.cachename)[:-1]
         p = ''
@@ -728,12 +1179,28 @@ class MBTileCache(object):
 
         self.cache = conn
 
-    def fetch_tile(self, z, x, y):
-        tile_id = u':'.join(str(k) for k in (z,x,y))
+    @property
+    def crx(self):
+        """lon/lat to web mercator.  Transformations aren't thread safe, so this is the current thread's copy"""
+        return transformation(4326, 3857)
+
+    def render_tile(self, z, x, y):
+        """Render a tile that isn't in the cache"""
         sw = self.crx.TransformPoint(*num2deg(x, y+1, z))
         ne = self.crx.TransformPoint(*num2deg(x+1, y, z))
         width = 256
         height = 256
+
+        dispatch.tile_rendered.send(sender=CacheManager, layers=self.layers, styles=self.styles)
+        from ga_resources.tasks import render as delayed_render
+        # _, blob = delayed_render.delay('png', width, height, (sw[0], sw[1], ne[0], ne[1]), self.srs, self.styles, self.layers, **self.kwargs).get()
+        return delayed_render.delay('png', width, height, (sw[0], sw[1], ne[0], ne[1]), self.srs, self.styles, self.layers, **self.kwargs).get()
+
+    def cacheable(self, blob):
+        return len(blob) > 350
+
+    def fetch_tile(self, z, x, y):
+        tile_id = u':'.join(str(k) for k in (z,x,y))
         insert_map = """INSERT OR REPLACE INTO map (tile_id,zoom_level,tile_column,tile_row,grid_id) VALUES(?,?,?,?,'');"""
         insert_data = """INSERT OR REPLACE INTO images (tile_id,tile_data) VALUES(?,?);"""
 
@@ -742,11 +1209,8 @@ class MBTileCache(object):
         try:
             blob = buffer(c.fetchone()[0])
         except:
-            dispatch.tile_rendered.send(sender=CacheManager, layers=self.layers, styles=self.styles)
-            from ga_resources.tasks import render as delayed_render
-            # _, blob = delayed_render.delay('png', width, height, (sw[0], sw[1], ne[0], ne[1]), self.srs, self.styles, self.layers, **self.kwargs).get()
-            blob = delayed_render.delay('png', width, height, (sw[0], sw[1], ne[0], ne[1]), self.srs, self.styles, self.layers, **self.kwargs).get()
-            if len(blob) > 350:
+            blob = self.render_tile(z, x, y)
+            if self.cacheable(blob):
                 blob = buffer(blob)
                 d = self.cache.cursor()
                 d.execute(insert_map, [tile_id, z, x, y])
@@ -811,13 +1275,8 @@ class MBTileCache(object):
                 zoom_level = ?
         )
         """
-        e4326 = osr.SpatialReference()
-        e3857 = osr.SpatialReference()
-        e4326.ImportFromEPSG(4326)
-        e3857.ImportFromEPSG(3857)
-        crx = osr.CoordinateTransformation(e3857, e4326)
-        x1, y1, _ = crx.TransformPoint(x1, y1)
-        x2, y2, _ = crx.TransformPoint(x2, y2)
+        x1, y1 = transform_point(x1, y1, 3857, 4326)
+        x2, y2 = transform_point(x2, y2, 3857, 4326)
 
         for zoom in range(min_zoom, max_zoom+1):
             a1, b1 = deg2num(y1, x1, zoom)
@@ -832,6 +1291,32 @@ class MBTileCache(object):
         conn.close()
 
 
+class VectorTileCache(MBTileCache):
+    """
+    Mapbox vector tiles of layers whose drivers can make them (see PostGISDriver.vector_tile), kept in an MBTiles file
+    like rendered tiles so that edits shave them the same way.  A tile of several layers is the concatenation of each
+    layer's tile, which is itself a valid tile.
+    """
+
+    def __init__(self, layers, **kwargs):
+        super(VectorTileCache, self).__init__(layers, [], query={'format': 'pbf'})
+
+    def render_tile(self, z, x, y):
+        dispatch.tile_rendered.send(sender=CacheManager, layers=self.layers, styles=self.styles)
+        tiles = []
+        for layer in self.layers:
+            slug, _, sublayer = layer.partition('#')
+            driver = m.RenderedLayer.objects.get(slug=slug).data_resource.driver_instance
+            if not driver.supports_vector_tiles():
+                raise NotImplementedError('{slug} cannot be served as vector tiles'.format(slug=slug))
+            kwargs = {'sublayer': sublayer} if sublayer else {}
+            tiles.append(driver.vector_tile(z, x, y, layer_name=slug.split('/')[-1], **kwargs))
+        return ''.join(tiles)
+
+    def cacheable(self, blob):
+        return True  # an empty vector tile is a real answer, and most tiles of sparse data are empty
+
+
 class WMSResultsCache(object):
     def __init__(self, layers, srs, styles, **kwargs):
         self.name = cache_entry_name(
@@ -1,7 +1,11 @@
 from django.contrib.gis.geos import Polygon
+import numpy
 import os
-from osgeo import osr, gdal
+from osgeo import gdal
 from . import Driver, RASTER
+from ga_resources.spatialrefs import spatial_reference, transformation, transform_point, transform_points
+
+POINT_WINDOW_PIXELS = 16 * 1024 * 1024  # points spread over a larger window than this are read one pixel at a time
 from pandas import DataFrame, Panel
 
 
@@ -32,13 +36,10 @@ class GeotiffDriver(Driver):
                 y0 + dy*ny if dy > 0 else y0
             )
 
-            crs = osr.SpatialReference()
-            crs.ImportFromWkt(ds.GetProjection())
+            crs = spatial_reference(ds.GetProjection())
 
             self.resource.spatial_metadata.native_srs = crs.ExportToProj4()
-            e4326 = osr.SpatialReference()
-            e4326.ImportFromEPSG(4326)
-            crx = osr.CoordinateTransformation(crs, e4326)
+            crx = transformation(crs, 4326)
             x04326, y04326, _ = crx.TransformPoint(xmin, ymin)
             x14326, y14326, _ = crx.TransformPoint(xmax, ymax)
             self.resource.spatial_metadata.bounding_box = Polygon.from_bbox((x04326, y04326, x14326, y14326))
@@ -68,13 +69,10 @@ class GeotiffDriver(Driver):
             y0 + dy*ny if dy > 0 else y0
         )
 
-        crs = osr.SpatialReference()
-        crs.ImportFromWkt(ds.GetProjection())
+        crs = spatial_reference(ds.GetProjection())
 
         self.resource.spatial_metadata.native_srs = crs.ExportToProj4()
-        e4326 = osr.SpatialReference()
-        e4326.ImportFromEPSG(4326)
-        crx = osr.CoordinateTransformation(crs, e4326)
+        crx = transformation(crs, 4326)
         x04326, y04326, _ = crx.TransformPoint(xmin, ymin)
         x14326, y14326, _ = crx.TransformPoint(xmax, ymax)
         self.resource.spatial_metadata.bounding_box = Polygon.from_bbox((x04326, y04326, x14326, y14326))
@@ -122,17 +120,7 @@ class GeotiffDriver(Driver):
         n = ds.RasterCount
         ret = []
 
-        s_srs = osr.SpatialReference()
-        t_srs = osr.SpatialReference()
-
-        if srs.lower().startswith('epsg'):
-            s_srs.ImportFromEPSG(int(srs.split(':')[-1]))
-        else:
-            s_srs.ImportFromProj4(srs)
-
-        t_srs.ImportFromProj4(nativesrs)
-        crx = osr.CoordinateTransformation(s_srs, t_srs)
-        x1, y1, _ = crx.TransformPoint(wherex, wherey)
+        x1, y1 = transform_point(wherex, wherey, srs, nativesrs)
 
         nx = ds.RasterXSize
         ny = ds.RasterYSize
@@ -152,6 +140,42 @@ class GeotiffDriver(Driver):
 
             return dict(zip(range(ds.RasterCount), ds.ReadAsArray(xoff,yoff,1,1).reshape(ds.RasterCount)))
 
+    def get_data_for_points(self, points, srs, fuzziness=0, **kwargs):
+        """
+        Get the values of all bands at many points.  The points are transformed together and the window of the raster
+        that covers them is read once, then indexed by every point's pixel.
+
+        :return: a list with an entry for each point, None if it is off the raster or otherwise a dict of band index to value
+        """
+        _, (_, nativesrs, result) = self.ready_data_resource(**kwargs)
+        ds = gdal.Open(result['file'])
+
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+        if not len(points):
+            return []
+        x1, y1 = transform_points(points[:, 0], points[:, 1], srs, nativesrs)
+
+        x0, dx, _, y0, _, dy = ds.GetGeoTransform()
+        cols = numpy.floor((x1 - x0) / dx).astype(numpy.int64)
+        rows = numpy.floor((y1 - y0) / dy).astype(numpy.int64)
+        inside = (cols >= 0) & (cols < ds.RasterXSize) & (rows >= 0) & (rows < ds.RasterYSize)
+
+        values = numpy.zeros((ds.RasterCount, len(points)))
+        if inside.any():
+            c0, c1, r0, r1 = cols[inside].min(), cols[inside].max(), rows[inside].min(), rows[inside].max()
+            width, height = int(c1 - c0 + 1), int(r1 - r0 + 1)
+            if width * height <= POINT_WINDOW_PIXELS:
+                window = ds.ReadAsArray(int(c0), int(r0), width, height).reshape(ds.RasterCount, height, width)
+                values = window[:, rows[inside] - r0, cols[inside] - c0]
+            else:
+                values = numpy.array([ds.ReadAsArray(int(c), int(r), 1, 1).reshape(ds.RasterCount)
+                                      for c, r in zip(cols[inside], rows[inside])]).T
+
+        results = [None] * len(points)
+        for i, band_values in zip(numpy.flatnonzero(inside), values.T.tolist()):
+            results[i] = dict(zip(range(ds.RasterCount), band_values))
+        return results
+
     def as_dataframe(self):
         """
         Creates a dataframe object for a shapefile's main layer using layer_as_dataframe. This object is cached on disk for
@@ -4,7 +4,7 @@ from cStringIO import StringIO
 from django.contrib.gis.geos import Polygon
 from lxml import etree
 from . import Driver
-from osgeo import osr
+from ga_resources.spatialrefs import spatial_reference
 import re
 from PIL import Image
 
@@ -41,8 +41,7 @@ class KmzDriver(Driver):
         super(KmzDriver, self).compute_fields(**kwargs)
         # archive = ZipFile(self.cached_basename + self.src_ext)
 
-        srs = osr.SpatialReference()
-        srs.ImportFromEPSG(4326)
+        srs = spatial_reference(4326)
         self.resource.native_srs = srs.ExportToProj4()
         self.resource.bounding_box = Polygon.from_bbox((-180, -90, 180, 90))
         self.resource.native_bounding_box = Polygon.from_bbox((-180, -90, 180, 90))
@@ -1,16 +1,15 @@
 # from ga_ows.views import wms, wfs
 import shutil
-import json
 from zipfile import ZipFile
 
-import pandas
 from django.contrib.gis.geos import Polygon
 from ga_resources.models import SpatialMetadata
 import os
-from osgeo import osr, ogr
+from osgeo import ogr
 from . import Driver
-from pandas import DataFrame
-from shapely import wkb
+from .sql import attribute_filter, literal
+from ga_resources.spatialrefs import proj4, spatial_reference, transformation
+from .shapefile import layer_as_dataframe, set_attribute_filter
 from django.template.defaultfilters import slugify
 import re
 
@@ -112,9 +111,7 @@ class OGRDriver(Driver):
         crs = lyr.GetSpatialRef()
 
         self.resource.spatial_metadata.native_srs = crs.ExportToProj4()
-        e4326 = osr.SpatialReference()
-        e4326.ImportFromEPSG(4326)
-        crx = osr.CoordinateTransformation(crs, e4326)
+        crx = transformation(crs, 4326)
         x04326, y04326, _ = crx.TransformPoint(xmin, ymin)
         x14326, y14326, _ = crx.TransformPoint(xmax, ymax)
         self.resource.spatial_metadata.bounding_box = Polygon.from_bbox((x04326, y04326, x14326, y14326))
@@ -147,49 +144,20 @@ class OGRDriver(Driver):
         return [f.items() for f in lyr]
 
     def attrquery(self, key, value):
-        key, op = key.split('__')
-        op = {
-            'gt': ">",
-            'gte': ">=",
-            'lt': "<",
-            'lte': '<=',
-            'startswith': 'LIKE',
-            'endswith': 'LIKE',
-            'istartswith': 'ILIKE',
-            'iendswith': 'ILIKE',
-            'icontains': "ILIKE",
-            'contains': "LIKE",
-            'in': 'IN',
-            'ne': "<>"
-        }[op]
-
-        value = {
-            'gt': identity,
-            'gte': identity,
-            'lt': identity,
-            'lte': identity,
-            'startswith': lambda x: '%' + x,
-            'endswith': lambda x: x + '%',
-            'istartswith': lambda x: '%' + x,
-            'iendswith': lambda x: x + '%',
-            'icontains': lambda x: '%' + x + '%',
-            'contains': lambda x: '%' + x + '%',
-            'in': lambda x: x if isinstance(x, basestring) else '(' + ','.join(identity(a) for a in x) + ')',
-            'ne': identity
-        }[op](value)
-
-        return ' '.join([key, op, value])
+        """An OGR attribute filter for one django style filter, column__op = value.  OGR can't bind parameters, so
+        the value is rendered as a quoted literal."""
+        return attribute_filter(key, value, placeholder=literal, ilike='LIKE')[0]
 
     def as_dataframe(self, **kwargs):
         """
         Creates a dataframe object for a shapefile's main layer using layer_as_dataframe. This object is cached on disk for
         layer use, but the cached copy will only be picked up if the shapefile's mtime is older than the dataframe's mtime.
 
-        :param shp: The shapefile
+        :param columns: only read these columns, whether from the datasource or the cached dataframe
         :return:
         """
 
-        dfx_path = self.get_filename('dfx')
+        columns = kwargs.pop('columns', None)
 
         if len(kwargs) != 0:
             ds = ogr.Open(self.get_master_filename())
@@ -200,22 +168,14 @@ class OGRDriver(Driver):
                 minx, miny, maxx, maxy = kwargs['bbox']
 
                 if 'srs' in kwargs:
-                    if isinstance(kwargs['srs'], basestring):
-                        s_srs = osr.SpatialReference()
-                        if kwargs['srs'].lower().startswith('epsg:'):
-                            s_srs.ImportFromEPSG(int(kwargs['srs'].split(':')[1]))
-                        else:
-                            s_srs.ImportFromProj4(kwargs['srs'])
-                    else:
-                        s_srs = kwargs['srs']
-
+                    s_srs = spatial_reference(kwargs['srs'])
                     t_srs = self.resource.srs
 
-                    if s_srs.ExportToProj4() != t_srs.ExportToProj4():
-                        crx = osr.CoordinateTransformation(s_srs, t_srs)
+                    if proj4(s_srs) != proj4(t_srs):
+                        crx = transformation(s_srs, t_srs)
                         minx, miny, _ = crx.TransformPoint(minx, miny)
                         maxx, maxy, _ = crx.TransformPoint(maxx, maxy)
-                        xrc = osr.CoordinateTransformation(t_srs, s_srs)
+                        xrc = transformation(t_srs, s_srs)
 
                 lyr.SetSpatialFilterRect(minx, miny, maxx, maxy)
             elif 'boundary' in kwargs:
@@ -223,61 +183,24 @@ class OGRDriver(Driver):
                 lyr.SetSpatialFilter(boundary)
 
             if 'query' in kwargs:
-                if isinstance(kwargs['query'], basestring):
-                    query = json.loads(kwargs['query'])
-                else:
-                    query = kwargs['query']
-
-                for key, value in query.items():
-                    attrq = self.attrquery(key, value) if '__' in key else key, '='
-                    lyr.SetAttributeFilter(attrq)
+                set_attribute_filter(lyr, kwargs['query'])
 
             start = kwargs['start'] if 'start' in kwargs else 0
-            count = kwargs['count'] if 'count' in kwargs else len(lyr) - start
-
-            records = []
-            for i in range(start):
-                lyr.next()
+            count = kwargs['count'] if 'count' in kwargs else None
 
-            for i in range(count):
-                f = lyr.next()
-                if f.geometry():
-                    records.append(
-                        dict(fid=i, geometry=wkb.loads(transform(f.geometry(), xrc).ExportToWkb()), **f.items()))
-
-            df = DataFrame.from_records(
-                data=records,
-                index='fid'
-            )
+            df = layer_as_dataframe(lyr, start=start, count=count, crx=xrc, columns=columns)
 
             if 'sort_by' in kwargs:
                 df = df.sort_index(by=kwargs['sort_by'])
 
             return df
 
-        elif hasattr(self, '_df'):
-            return self._df
-
-        elif os.path.exists(dfx_path) and os.stat(dfx_path).st_mtime >= os.stat(self.get_master_filename()).st_mtime:
-            if self.resource.big:
-                self._df = pandas.read_hdf(dfx_path, 'df')
-            else:
-                self._df = pandas.read_pickle(dfx_path)
-            return self._df
         else:
-            ds = ogr.Open(self.get_master_filename())
-            lyr = ds.GetLayerByIndex(0)
-            df = DataFrame.from_records(
-                data=[dict(fid=f.GetFID(), geometry=wkb.loads(f.geometry().ExportToWkb()), **f.items()) for f in lyr if
-                      f.geometry()],
-                index='fid'
-            )
-            if self.resource.big:
-                df.to_hdf(dfx_path, 'df')
-            else:
-                df.to_pickle(dfx_path)
-            self._df = df
-            return self._df
+            def load():
+                ds = ogr.Open(self.get_master_filename())
+                return layer_as_dataframe(ds.GetLayerByIndex(0), lazy_geometry=True)
+
+            return self.cached_dataframe(load, source=self.get_master_filename(), columns=columns)
 
     @classmethod
     def from_dataframe(cls, df, shp, driver, srs, in_subdir=False):
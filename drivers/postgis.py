@@ -1,15 +1,24 @@
 # from ga_ows.views import wms, wfs
+from collections import OrderedDict
 from uuid import uuid4
 import json
+import re
+import threading
+import time
 
 from django.conf import settings as s
-from django.contrib.gis.geos import Polygon, GEOSGeometry
-import os
-from osgeo import osr
-from . import Driver
-from pandas import DataFrame
-from shapely import wkb
-from psycopg2 import connect
+from django.contrib.gis.geos import Polygon
+from . import Driver, dataframe_from_cursor, features_from_cursor, zoom_tolerance, DATAFRAME_BATCH_SIZE, SUMMARY_SAMPLE_ROWS
+from .sql import attribute_filter, numbered_parameters, quote_identifier
+from ga_resources.spatialrefs import proj4, spatial_reference, transformation
+from ga_resources import sketches
+import shapely.geometry
+import psycopg2
+from psycopg2 import connect, errorcodes
+from psycopg2.extensions import connection as psycopg2_connection, TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR
+from psycopg2.pool import PoolError
+from celery.signals import task_postrun
+from django.core.signals import request_finished
 from django.db import connection as django_db_connection
 from django.db import connections as django_db_connections
 import pandas
@@ -24,6 +33,312 @@ def transform(geom, crx):
     return geom
 
 
+POOL_MIN_SIZE = getattr(s, 'GA_RESOURCES_POSTGIS_POOL_MIN_SIZE', 1)
+POOL_MAX_SIZE = getattr(s, 'GA_RESOURCES_POSTGIS_POOL_MAX_SIZE', 10)
+POOL_TIMEOUT = getattr(s, 'GA_RESOURCES_POSTGIS_POOL_TIMEOUT', 30)  # seconds to wait for a connection when all are in use
+POOL_CHECK_INTERVAL = getattr(s, 'GA_RESOURCES_POSTGIS_POOL_CHECK_INTERVAL', 60)  # seconds idle before a connection is checked
+STATEMENT_TIMEOUT = getattr(s, 'GA_RESOURCES_POSTGIS_STATEMENT_TIMEOUT', 0)  # milliseconds, 0 for none
+DATASETS_CONFIG = getattr(s, 'GA_RESOURCES_POSTGIS_DATASETS', {})  # connection driver_config and schema for create_dataset
+WEB_MERCATOR_HALF_WORLD = 20037508.342789244  # metres from the origin to the edge of the web mercator world
+LOAD_BATCH_SIZE = getattr(s, 'GA_RESOURCES_POSTGIS_LOAD_BATCH_SIZE', 50000)  # rows per round trip loading a whole table
+PREPARED_STATEMENTS = getattr(s, 'GA_RESOURCES_POSTGIS_PREPARED_STATEMENTS', 100)  # kept per pooled connection, 0 for none
+
+# postgres type oids of the columns that are packed into typed arrays as they are read.  see dataframe_from_cursor
+POSTGRES_DTYPES = {
+    16: 'bool',
+    20: 'int64',
+    21: 'int16',
+    23: 'int32',
+    700: 'float32',
+    701: 'float64',
+}
+
+
+# the errors EXECUTE raises when a prepared statement no longer fits its tables ("cached plan must not change result
+# type") or has gone from the server
+STALE_STATEMENT_ERRORS = {errorcodes.FEATURE_NOT_SUPPORTED, errorcodes.INVALID_SQL_STATEMENT_NAME}
+
+_star_select = re.compile(r'\bselect\b.*?[\s,](\w+\.)?\*\s*(,|\bfrom\b)', re.IGNORECASE | re.DOTALL)
+
+# bumped whenever a driver in this process changes a table's schema, so connections drop the statements they prepared
+_schema_generation = [0]
+
+
+def schema_changed():
+    """Have every pooled connection deallocate its prepared statements before its next one, as results may differ"""
+    _schema_generation[0] += 1
+
+
+class PreparingConnection(psycopg2_connection):
+    """A psycopg2 connection that keeps the statements prepared on it.  see execute"""
+
+    def __init__(self, *args, **kwargs):
+        super(PreparingConnection, self).__init__(*args, **kwargs)
+        self.prepared = OrderedDict()  # statement -> name it is prepared as, or None if it can't be, least recent first
+        self.prepared_count = 0
+        self.generation = _schema_generation[0]
+
+
+def execute(cursor, sql, params=()):
+    """
+    Execute a statement with psycopg2 %s parameters on a cursor.  On a pooled connection the statement is prepared
+    on the server the first time it is seen, and afterwards only EXECUTEd with the new values, so PostgreSQL parses
+    and plans each shape of query once per connection rather than once per request.  The PREPARED_STATEMENTS most
+    recently used are kept.  Named cursors, other connections, statements PostgreSQL can't infer parameter types
+    for, and SELECT * statements, whose result type changes whenever a column is added, are executed as they are.
+
+    Statements are deallocated when a driver in this process alters a table (see schema_changed).  A statement whose
+    table was altered elsewhere so that its result type changed fails; if it started the transaction it is rolled back
+    and the plain statement run instead, otherwise the error is raised and the connection's statements are
+    deallocated once the transaction has been rolled back.
+    """
+    connection = cursor.connection
+    statements = getattr(connection, 'prepared', None)
+    if statements is None or cursor.name or not PREPARED_STATEMENTS or _star_select.search(sql):
+        cursor.execute(sql, params)
+        return
+
+    if connection.generation != _schema_generation[0]:
+        cursor.execute('DEALLOCATE ALL')
+        statements.clear()
+        connection.generation = _schema_generation[0]
+
+    if sql in statements:
+        name = statements.pop(sql)
+        statements[sql] = name
+    else:
+        name = None
+        numbered = numbered_parameters(sql)
+        if numbered is not None and numbered[1] == len(params):
+            while len(statements) >= PREPARED_STATEMENTS:
+                _, evicted = statements.popitem(last=False)
+                if evicted:
+                    cursor.execute('DEALLOCATE ' + evicted)
+            connection.prepared_count += 1
+            name = 'ga_statement_{n}'.format(n=connection.prepared_count)
+            cursor.execute('SAVEPOINT ga_prepare')
+            try:
+                cursor.execute('PREPARE {name} AS {sql}'.format(name=name, sql=numbered[0]))
+                cursor.execute('RELEASE SAVEPOINT ga_prepare')
+            except psycopg2.Error:
+                cursor.execute('ROLLBACK TO SAVEPOINT ga_prepare')
+                name = None
+        statements[sql] = name
+
+    if name is None:
+        cursor.execute(sql, params)
+        return
+
+    # a statement that starts the transaction can be retried after a rollback.  one inside a transaction can't be
+    in_transaction = connection.get_transaction_status() != TRANSACTION_STATUS_IDLE
+    try:
+        cursor.execute('EXECUTE {name}{arguments}'.format(
+            name=name,
+            arguments='(' + ','.join('%s' for _ in params) + ')' if params else ''
+        ), params)
+    except psycopg2.Error as e:
+        if e.pgcode not in STALE_STATEMENT_ERRORS:
+            raise
+        if in_transaction:
+            connection.generation = None
+            raise
+        connection.rollback()
+        del statements[sql]
+        if e.pgcode != errorcodes.INVALID_SQL_STATEMENT_NAME:
+            cursor.execute('DEALLOCATE ' + name)
+        cursor.execute(sql, params)
+
+
+class ConnectionPool(object):
+    """
+    A thread safe pool of connections to one database.  Connections are opened as they are needed up to max_size, and
+    a caller that finds them all in use waits up to timeout seconds for one to be returned.  A connection that has
+    been idle for check_interval seconds is checked with a trivial query before it is handed out again, and replaced
+    if the server has gone away.
+    """
+
+    def __init__(self, params, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT,
+                 check_interval=POOL_CHECK_INTERVAL):
+        self.params = params
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.lock = threading.Condition()
+        self.idle = [(self._connect(), time.time()) for _ in range(min_size)]  # (connection, time it was returned)
+        self.size = len(self.idle)  # open connections, idle or checked out
+
+    def _connect(self):
+        return connect(connection_factory=PreparingConnection, **self.params)
+
+    def _healthy(self, connection, idle_since):
+        if connection.closed:
+            return False
+        if time.time() - idle_since < self.check_interval:
+            return True
+        try:
+            c = connection.cursor()
+            c.execute('select 1')
+            c.close()
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        deadline = time.time() + self.timeout
+        with self.lock:
+            while True:
+                if self.idle:
+                    connection, idle_since = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    self.size += 1
+                    connection = None
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolError('all {n} connections are in use'.format(n=self.max_size))
+                self.lock.wait(remaining)
+
+        if connection is not None:
+            if self._healthy(connection, idle_since):
+                return connection
+            try:
+                connection.close()
+            except psycopg2.Error:
+                pass
+
+        try:
+            return self._connect()
+        except:
+            with self.lock:
+                self.size -= 1
+                self.lock.notify()
+            raise
+
+    def putconn(self, connection):
+        """Return a connection to the pool.  Whatever transaction it is in is rolled back."""
+        try:
+            if not connection.closed:
+                connection.rollback()
+        except psycopg2.Error:
+            connection.close()
+
+        with self.lock:
+            if connection.closed:
+                self.size -= 1
+            else:
+                self.idle.append((connection, time.time()))
+            self.lock.notify()
+
+    def closeall(self):
+        with self.lock:
+            for connection, _ in self.idle:
+                connection.close()
+            self.size -= len(self.idle)
+            self.idle = []
+
+
+_pools = {}  # connection parameters -> ConnectionPool
+_pools_lock = threading.Lock()
+_checked_out = threading.local()  # .connections : {connection parameters: the connection this thread holds}
+
+
+def connection_parameters(cfg):
+    """The psycopg2.connect arguments for a PostGIS driver_config, as a hashable tuple"""
+    params = dict((k, cfg[k]) for k in ('user', 'password', 'host', 'port') if cfg.get(k, None) is not None)
+    params['database'] = cfg['dbname']
+    timeout = cfg.get('statement_timeout', STATEMENT_TIMEOUT)
+    if timeout:
+        params['options'] = '-c statement_timeout={timeout}'.format(timeout=int(timeout))
+    return tuple(sorted(params.items()))
+
+
+def pooled_connection(cfg):
+    """
+    A connection to the database of a PostGIS driver_config, from a pool shared by every driver with the same connection
+    parameters.  A thread holds on to the connection it is given, so every call from the same thread gets the same one,
+    until release_connections() returns them all to their pools at the end of the request or celery task.  A held
+    connection whose transaction failed is rolled back before it is handed out again, so one failed statement doesn't
+    fail everything after it.
+
+    The pool's size is set by the first driver_config to ask for it: pool_min_size, pool_max_size, pool_timeout and
+    pool_check_interval, defaulting to the GA_RESOURCES_POSTGIS_POOL_* settings.
+    """
+    key = connection_parameters(cfg)
+    pool = _pools.get(key, None)
+    if pool is None:
+        with _pools_lock:
+            if key not in _pools:
+                _pools[key] = ConnectionPool(
+                    dict(key),
+                    min_size=cfg.get('pool_min_size', POOL_MIN_SIZE),
+                    max_size=cfg.get('pool_max_size', POOL_MAX_SIZE),
+                    timeout=cfg.get('pool_timeout', POOL_TIMEOUT),
+                    check_interval=cfg.get('pool_check_interval', POOL_CHECK_INTERVAL)
+                )
+            pool = _pools[key]
+
+    connections = _checked_out.__dict__.setdefault('connections', {})
+    connection = connections.get(key, None)
+    if connection is not None and connection.closed:
+        pool.putconn(connection)
+        connection = None
+    if connection is None:
+        connection = connections[key] = pool.getconn()
+    elif connection.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+        connection.rollback()
+    return connection
+
+
+def release_connections(**kwargs):
+    """Return the connections this thread holds to their pools.  Called when each request or celery task finishes."""
+    connections = _checked_out.__dict__.get('connections', {})
+    for key, connection in connections.items():
+        _pools[key].putconn(connection)
+    connections.clear()
+
+
+request_finished.connect(release_connections, weak=False)
+task_postrun.connect(release_connections, weak=False)  # workers send no request_finished
+
+
+_table_metadata = {}  # (database, table) -> (signature, {key: value})
+_table_metadata_lock = threading.Lock()
+
+
+def database_key(cfg):
+    """Identifies the database of a driver_config, for caching things about its tables"""
+    if cfg.get('use_django_dbms', False):
+        return 'django', cfg.get('django_dbms_alias', 'default')
+    return connection_parameters(cfg)
+
+
+def table_signature(connection, table):
+    """
+    Numbers that change whenever a table's rows do: its storage file and the statistics collector's counts of rows
+    inserted, updated and deleted.  The counts are reported at the end of each transaction, up to half a second late.
+    None for a select, which has no statistics of its own.
+    """
+    if table.strip().lower().startswith('select'):
+        return None
+    c = connection.cursor()
+    c.execute("""select c.relfilenode, s.n_tup_ins, s.n_tup_upd, s.n_tup_del from pg_class c
+        left join pg_stat_all_tables s on s.relid = c.oid where c.oid = %s::regclass""", [table])
+    signature = tuple(c.fetchone())
+    c.close()
+    return signature
+
+
+def config_connection(cfg):
+    """The connection for a driver_config: one of django's if use_django_dbms is set, otherwise a pooled one"""
+    if cfg.get('use_django_dbms', False):
+        if cfg.get('django_dbms_alias', None):
+            return django_db_connections[cfg['django_dbms_alias']]
+        return django_db_connection
+    return pooled_connection(cfg)
+
+
 class PostGISDriver(Driver):
     """
     Config Parameters:
@@ -36,9 +351,14 @@ class PostGISDriver(Driver):
         * django_dbms_alias : string (default: use django's default connection)
         * table : the default table to use
         * tables : dict of layer names -> tables, must all be in the same coordinate system for now.  Can also be select queries. paired with the geometry field name.
-        * estimate_extent : see mapnik documentation
+        * estimate_extent : see mapnik documentation.  compute_fields also takes the extent from ST_EstimatedExtent if
+          this is set, which it is by default for big resources
         * cursor_size : int. default of 2000 for "big" tables else ignored
-        * srid : the native srid of the tables
+        * srid : the native srid of the tables.  if not given, compute_fields reads it from geometry_columns
+        * statement_timeout : integer milliseconds (default GA_RESOURCES_POSTGIS_STATEMENT_TIMEOUT). cancel longer queries
+        * pool_min_size, pool_max_size, pool_timeout, pool_check_interval : see pooled_connection
+        * load_batch_size : int. rows per round trip when loading the whole table.  see load_dataframe
+        * key_field : the integer key column of the table for the REST data API (default ogc_fid)
     """
 
     def ready_data_resource(self, **kwargs):
@@ -86,22 +406,7 @@ class PostGISDriver(Driver):
         return slug, srs, conn
 
     def _connection(self):
-        # create a database connection, or use the
-        cfg = self.resource.driver_config
-        if cfg.get('use_django_dbms', False):
-            if cfg.get('django_dbms_alias', None):
-                connection = django_db_connections[cfg['django_dbms_alias']]
-            else:
-                connection = django_db_connection
-        else:
-            connection = connect(
-                database=cfg['dbname'],
-                user=cfg.get('user', None),
-                password=cfg.get('password', None),
-                host=cfg.get('host', None),
-                port=cfg.get('port', None)
-            )
-        return connection
+        return config_connection(self.resource.driver_config)
 
     def compute_fields(self, **kwargs):
         """Other keyword args get passed in as a matter of course, like BBOX, time, and elevation, but this basic driver
@@ -109,14 +414,13 @@ class PostGISDriver(Driver):
 
         super(PostGISDriver, self).compute_fields(**kwargs)
         cfg = self.resource.driver_config
-        connection = self._connection()
         xmin=ymin=float('inf')
         ymax=xmax=float('-inf')
 
-        dataframe = self.get_filename('dfx')
-        if os.path.exists(dataframe):
-            os.unlink(dataframe)
+        self.clear_dataframe_cache()
 
+        estimate = cfg.get('estimate_extent', self.resource.big)
+        srid = cfg.get('srid', None)
         for entry in [cfg['table']] + cfg.get('tables', {}).values():
             if isinstance(entry, list):
                 table, geom_field = entry
@@ -125,34 +429,109 @@ class PostGISDriver(Driver):
             else:
                 table = entry
                 geom_field = 'geometry'
-            c = connection.cursor()
-            c.execute("select AsText(st_extent({geom_field})) from {table}".format(geom_field=geom_field, table=table))
 
-            xmin0, ymin0, xmax0, ymax0 = GEOSGeometry(c.fetchone()[0]).extent
+            extent = self._metadata(table, ('extent', geom_field, bool(estimate)), lambda: self._extent(table, geom_field, estimate))
+            if srid is None:
+                srid = self._metadata(table, ('srid', geom_field), lambda: self._geometry_srid(table, geom_field))
+            if extent is None:  # an empty table
+                continue
+
+            xmin0, ymin0, xmax0, ymax0 = extent
             xmin = xmin0 if xmin0 < xmin else xmin
             ymin = ymin0 if ymin0 < ymin else ymin
             xmax = xmax0 if xmax0 > xmax else xmax
             ymax = ymax0 if ymax0 > ymax else ymax
 
-        crs = osr.SpatialReference()
-        crs.ImportFromEPSG(cfg['srid'])
-        self.resource.spatial_metadata.native_srs = crs.ExportToProj4()
+        if xmin > xmax:
+            xmin = ymin = xmax = ymax = 0.0
+
+        if srid is not None and 'srid' not in cfg:  # remember what was found, so queries needn't look it up again
+            cfg['srid'] = int(srid)
+            self.resource.resource_config = json.dumps(cfg)
 
-        e4326 = osr.SpatialReference()
-        e4326.ImportFromEPSG(4326)
-        crx = osr.CoordinateTransformation(crs, e4326)
+        crs = spatial_reference(int(srid or 4326))
+        self.resource.native_srs = crs.ExportToProj4()
+
+        crx = transformation(crs, 4326)
         x04326, y04326, _ = crx.TransformPoint(xmin, ymin)
         x14326, y14326, _ = crx.TransformPoint(xmax, ymax)
 
-        print xmin, xmax, ymin, ymax
-        print x04326, y04326, x14326, y14326
-        self.resource.spatial_metadata.bounding_box = Polygon.from_bbox((x04326, y04326, x14326, y14326))
-        self.resource.spatial_metadata.native_bounding_box = Polygon.from_bbox((xmin, ymin, xmax, ymax))
-        self.resource.spatial_metadata.three_d = False
-
-        self.resource.spatial_metadata.save()
+        self.resource.bounding_box = Polygon.from_bbox((x04326, y04326, x14326, y14326))
+        self.resource.native_bounding_box = Polygon.from_bbox((xmin, ymin, xmax, ymax))
+        self.resource.three_d = False
         self.resource.save()
 
+    def _metadata(self, table, key, compute):
+        """
+        Look up a piece of metadata about a table (its extent, srid), calling compute() only if it isn't cached.
+        Entries are kept per table for as long as its table_signature stays the same, so a change to the rows from any
+        process retires them.  Metadata about selects isn't cached.
+        """
+        signature = table_signature(self._connection(), table)
+        if signature is None:
+            return compute()
+
+        cache_key = (database_key(self.resource.driver_config), table)
+        with _table_metadata_lock:
+            cached = _table_metadata.get(cache_key)
+            if cached is None or cached[0] != signature:
+                cached = _table_metadata[cache_key] = (signature, {})
+            entries = cached[1]
+
+        if key not in entries:
+            entries[key] = compute()
+        return entries[key]
+
+    def _forget_metadata(self):
+        database = database_key(self.resource.driver_config)
+        with _table_metadata_lock:
+            for key in [k for k in _table_metadata if k[0] == database]:
+                del _table_metadata[key]
+
+    def _extent(self, table, geometry_field, estimate=False):
+        """
+        The extent of a table's geometry as (xmin, ymin, xmax, ymax), or None if it is empty.
+
+        :param estimate: read the extent from the planner's statistics with ST_EstimatedExtent instead of scanning the
+            table.  The estimate may be a little larger than the true extent, or stale until the table is next analyzed.
+            A table without statistics is scanned.
+        """
+        connection = self._connection()
+        c = connection.cursor()
+        subquery = table.strip().lower().startswith('select')
+        extent = None
+        if estimate and not subquery:
+            schema, _, name = table.rpartition('.')
+            try:
+                c.execute("""select ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) from
+                    (select ST_EstimatedExtent(coalesce(nullif(%s, ''), current_schema()), %s, %s) as e) as x""",
+                    [schema.strip('"'), name.strip('"'), geometry_field])
+                extent = c.fetchone()
+            except psycopg2.Error:  # older PostGIS raises instead of returning null when there are no statistics
+                connection.rollback()
+                c = connection.cursor()
+
+        if extent is None or extent[0] is None:
+            c.execute("select ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) from (select ST_Extent({geometry_field}) as e from {table} as w) as x".format(
+                geometry_field=geometry_field,
+                table='(' + table + ')' if subquery else table
+            ))
+            extent = c.fetchone()
+        c.close()
+        return None if extent[0] is None else tuple(extent)
+
+    def _geometry_srid(self, table, geometry_field):
+        """The srid of a table's geometry column from geometry_columns, or None if it isn't registered there"""
+        if table.strip().lower().startswith('select'):
+            return None
+        schema, _, name = table.rpartition('.')
+        c = self._connection().cursor()
+        c.execute("""select srid from geometry_columns where f_table_schema = coalesce(nullif(%s, ''), current_schema())
+            and f_table_name = %s and f_geometry_column = %s""", [schema.strip('"'), name.strip('"'), geometry_field])
+        row = c.fetchone()
+        c.close()
+        return row[0] if row and row[0] else None
+
     def _table(self, **kwargs):
         cfg = self.resource.driver_config
         if 'sublayer' in kwargs:
@@ -176,71 +555,51 @@ class PostGISDriver(Driver):
 
     def get_data_for_point(self, wherex, wherey, srs, **kwargs):
         result, x1, y1, fuzziness = super(PostGISDriver, self).get_data_for_point(wherex, wherey, srs, **kwargs)
-        cfg = self.resource.driver_config
         table, geometry_field = self._table(**kwargs)
 
-        if fuzziness == 0:
-            geometry = "GeomFromText('POINT({x} {y})', {srid})".format(
-                x = x1,
-                y = y1,
-                srid = cfg['srid']
-            )
-        else:
-            geometry = "ST_Buffer(GeomFromText('POINT({x} {y})', {srid}), {fuzziness})".format(
-                x = x1,
-                y = y1,
-                srid = cfg['srid'],
-                fuzziness = fuzziness
-            )
+        geometry = "ST_SetSRID(ST_MakePoint(%s, %s), {srid})".format(srid=self._srid)
+        params = [float(x1), float(y1)]
+        if fuzziness != 0:
+            geometry = "ST_Buffer({geometry}, %s)".format(geometry=geometry)
+            params.append(float(fuzziness))
 
         cursor = self._cursor(**kwargs)
-
-        cursor.execute("SELECT * FROM {table} WHERE ST_Intersects({geometry}, {geometry_field})".format(
-            geometry = geometry,
-            table = table,
-            geometry_field = geometry_field
-        ))
+        execute(cursor, "SELECT * FROM {table} WHERE ST_Intersects({geometry}, {geometry_field})".format(
+            geometry=geometry,
+            table=table.replace('%', '%%'),
+            geometry_field=geometry_field
+        ), params)
         rows = [list(r) for r in cursor.fetchall()]
         keys = [c.name for c in cursor.description]
 
         return [dict(zip(keys, r)) for r in rows]
 
+    def get_data_for_points(self, points, srs, fuzziness=0, **kwargs):
+        """Look up all the points with one indexed join.  The points are passed as arrays and unnested into rows, and
+        ST_DWithin matches each against the table's spatial index."""
+        result, x1, y1, epsilon = self.native_points(points, srs, fuzziness, **kwargs)
+        table, geometry_field = self._table(**kwargs)
+
+        cursor = self._cursor(count=True)
+        cursor.execute('''
+            SELECT p.id, w.* FROM unnest(%s::integer[], %s::float8[], %s::float8[], %s::float8[]) AS p(id, x, y, r)
+            JOIN {table} AS w ON ST_DWithin(w.{geometry_field}, ST_SetSRID(ST_MakePoint(p.x, p.y), {srid}), p.r)
+            ORDER BY p.id'''.format(table=table, geometry_field=geometry_field, srid=self._srid),
+            (range(len(x1)), x1.tolist(), y1.tolist(), epsilon.tolist()))
+
+        keys = [c.name for c in cursor.description][1:]
+        results = [[] for _ in range(len(x1))]
+        for row in cursor.fetchall():
+            results[row[0]].append(dict((k, v) for k, v in zip(keys, row[1:]) if k != geometry_field))
+        cursor.close()
+        return results
+
     def attrquery(self, key, value):
-        if '__' not in key:
-            return key+'='+value
-
-        key, op = key.split('__')
-        op = {
-            'gt': ">",
-            'gte': ">=",
-            'lt': "<",
-            'lte': '<=',
-            'startswith': 'LIKE',
-            'endswith': 'LIKE',
-            'istartswith': 'ILIKE',
-            'iendswith': 'ILIKE',
-            'icontains': "ILIKE",
-            'contains': "LIKE",
-            'in': 'IN',
-            'ne': "<>"
-        }[op]
-
-        value = {
-            'gt': identity,
-            'gte': identity,
-            'lt': identity,
-            'lte': identity,
-            'startswith': lambda x: '%' + x,
-            'endswith': lambda x: x + '%',
-            'istartswith': lambda x: '%' + x,
-            'iendswith': lambda x: x + '%',
-            'icontains': lambda x: '%' + x + '%',
-            'contains': lambda x: '%' + x + '%',
-            'in': lambda x: x if isinstance(x, basestring) else '(' + ','.join(identity(a) for a in x) + ')',
-            'ne': identity
-        }[op](value)
-
-        return ' '.join([key, op, value])
+        """
+        A where clause for one django style filter, column__op = value, as sql and a list of query parameters.  The
+        value is always passed as a parameter, never spliced into the sql.
+        """
+        return attribute_filter(key, value, arrays=True)
 
     def _cursor(self, **kwargs):
         connection = self._connection()
@@ -253,139 +612,931 @@ class PostGISDriver(Driver):
         return cursor
 
 
+    def select_column(self, column):
+        table, _ = self._table()
+        if table.strip().lower().startswith('select'):
+            table = '(' + table + ') as w'
+
+        c = self._connection().cursor()
+        c.execute('select * from {table} limit 0'.format(table=table))
+        if column not in [d[0] for d in c.description]:
+            raise ValueError('unknown column {column}'.format(column=column))
+        c.close()
+
+        cursor = self._cursor(big=True)
+        cursor.execute('select "{column}" from {table}'.format(column=column, table=table))
+        values = []
+        while True:
+            rows = cursor.fetchmany(DATAFRAME_BATCH_SIZE)
+            if not rows:
+                break
+            values.extend(row[0] for row in rows)
+        cursor.close()
+        return pandas.Series(values).values
+
+    def attribute_batches(self, sample=None, batch_size=None):
+        table, geometry_column = self._table()
+        subquery = table.strip().lower().startswith('select')
+        if subquery:
+            table = '(' + table + ') as w'
+
+        connection = self._connection()
+        c = connection.cursor()
+        c.execute('select * from {table} limit 0'.format(table=table))
+        columns = [d[0] for d in c.description if d[0].lower() != geometry_column.lower()]
+
+        if sample is None:
+            if subquery:
+                c.execute('select count(*) from {table}'.format(table=table))
+            else:  # the planner's estimate, kept current by analyze
+                c.execute('select reltuples::bigint from pg_class where oid = %s::regclass', [table])
+            rows = c.fetchone()[0]
+            sample = min(1.0, SUMMARY_SAMPLE_ROWS / float(rows)) if rows > 0 else 1.0
+        c.close()
+
+        if sample >= 1.0:
+            sampling = ''
+        elif subquery:
+            sampling = ' where random() < {fraction}'.format(fraction=sample)
+        else:  # block sampling by the server: whole pages are picked at random and read
+            sampling = ' tablesample system ({percent})'.format(percent=sample * 100)
+
+        pages = sample < 1.0 and not subquery
+        cursor = self._cursor(big=True)
+        cursor.execute('select {columns}{page} from {table}{sampling}'.format(
+            columns=','.join('"{0}"'.format(k) for k in columns),
+            page=', (ctid::text::point)[0]' if pages else '',
+            table=table,
+            sampling=sampling
+        ))
+
+        def batches():
+            while True:
+                rows = cursor.fetchmany(batch_size or DATAFRAME_BATCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+            cursor.close()
+
+        def blocks():  # the sampled pages are read in order, and each is yielded as a block of the cluster sample
+            block, page = sketches.Block(), None
+            for rows in batches():
+                for row in rows:
+                    if row[-1] != page and block:
+                        yield block
+                        block = sketches.Block()
+                    page = row[-1]
+                    block.append(row[:-1])
+            if block:
+                yield block
+
+        if pages:
+            return columns, sample, blocks()
+
+        return columns, sample, batches()
+
+    @classmethod
+    def supports_vector_tiles(cls):
+        return True
+
+    def vector_tile(self, z, x, y, layer_name=None, extent=4096, buffer=64, **kwargs):
+        """
+        A Mapbox vector tile of the features in web mercator tile z/x/y, made entirely by the database in one query
+        with ST_AsMVT.  Rows are found through the table's spatial index and clipped and quantized to the tile grid by
+        ST_AsMVTGeom.  Every column but the geometry becomes a feature property.
+
+        :param layer_name: the name of the layer in the tile (default the table name)
+        :param extent: the size of the tile grid
+        :param buffer: the margin, in grid units, that geometries are kept for past the tile's edges
+        :param kwargs: sublayer, to tile one of the tables in cfg['tables']
+        :return: the tile as a string of protobuf bytes
+        """
+        table, geometry_field = self._table(**kwargs)
+        if table.strip().lower().startswith('select'):
+            table = '(' + table + ')'
+        srid = self._srid
+
+        c = self._connection().cursor()
+        c.execute('select * from {table} as w limit 0'.format(table=table))
+        columns = [d[0] for d in c.description if d[0] != geometry_field]
+
+        size = 2 * WEB_MERCATOR_HALF_WORLD / 2 ** z
+        bounds = [-WEB_MERCATOR_HALF_WORLD + x * size, WEB_MERCATOR_HALF_WORLD - (y + 1) * size,
+                  -WEB_MERCATOR_HALF_WORLD + (x + 1) * size, WEB_MERCATOR_HALF_WORLD - y * size]
+        margin = size * buffer / extent
+        search = [bounds[0] - margin, bounds[1] - margin, bounds[2] + margin, bounds[3] + margin]
+        search_frame = 'ST_MakeEnvelope(%s, %s, %s, %s, 3857)'
+        if srid != 3857:
+            search_frame = 'ST_Transform({frame}, {srid})'.format(frame=search_frame, srid=srid)
+        geometry = 'w.' + geometry_field if srid == 3857 else 'ST_Transform(w.{0}, 3857)'.format(geometry_field)
+
+        c.execute("""select ST_AsMVT(t, %s, {extent}, 'mvt_geometry') from (
+            select ST_AsMVTGeom({geometry}, ST_MakeEnvelope(%s, %s, %s, %s, 3857), {extent}, {buffer}, true) as mvt_geometry{columns}
+            from {table} as w where w.{geometry_field} && {search_frame}
+        ) as t where mvt_geometry is not null""".format(
+            extent=int(extent),
+            buffer=int(buffer),
+            geometry=geometry,
+            columns=''.join(', w.' + quote_identifier(k) for k in columns),
+            table=table.replace('%', '%%'),
+            geometry_field=geometry_field,
+            search_frame=search_frame
+        ), [layer_name or table.split('.')[-1]] + bounds + search)
+        tile = c.fetchone()[0]
+        c.close()
+        return str(tile) if tile is not None else ''
+
+    def load_dataframe(self, batch_size=None):
+        """
+        Read the whole default table into a dataframe with lazy geometry.  Rows are streamed through a server side
+        cursor in large batches, one round trip each, and numeric and boolean columns are packed into typed arrays a
+        batch at a time.  cfg['load_batch_size'] or GA_RESOURCES_POSTGIS_LOAD_BATCH_SIZE sets the batch size.
+        """
+        table, geometry_column = self._table()
+        if table.strip().lower().startswith('select'):
+            table = '(' + table + ') AS w'
+        batch_size = batch_size or self.resource.driver_config.get('load_batch_size', LOAD_BATCH_SIZE)
+
+        cursor = self._cursor(big=True)
+        cursor.itersize = batch_size
+        cursor.execute("SELECT AsBinary({geometry_column}), * FROM {table}".format(table=table, geometry_column=geometry_column))
+        df = dataframe_from_cursor(cursor, geometry_column, lazy_geometry=True, batch_size=batch_size, type_codes=POSTGRES_DTYPES)
+        cursor.close()
+        return df
+
+    def _filtered_cursor(self, **kwargs):
+        """A cursor over the rows selected by the as_dataframe filters, as "SELECT AsBinary(geometry), * ...", and the
+        name of the geometry column"""
+        lyr = {}
+
+        if 'bbox' in kwargs:
+            minx, miny, maxx, maxy = kwargs['bbox']
+
+            if 'srs' in kwargs:
+                s_srs = spatial_reference(kwargs['srs'])
+                t_srs = self.resource.srs
+
+                if proj4(s_srs) != proj4(t_srs):
+                    crx = transformation(s_srs, t_srs)
+                    minx, miny, _ = crx.TransformPoint(minx, miny)
+                    maxx, maxy, _ = crx.TransformPoint(maxx, maxy)
+
+            lyr['bbox'] = (minx, miny, maxx, maxy)
+        elif 'boundary' in kwargs:
+            lyr['boundary'] = kwargs['boundary']
+
+        if 'query' in kwargs:
+            if isinstance(kwargs['query'], basestring):
+                query = json.loads(kwargs['query'])
+            else:
+                query = kwargs['query']
+            lyr['query'] = [self.attrquery(key, value) for key, value in sorted(query.items())]
+
+        start = int(kwargs.get('start', 0) or 0)
+        count = int(kwargs['count']) if kwargs.get('count', None) else None
+
+        # construct the query.  every value is a query parameter, and paging and sorting are done by the server,
+        # so a page deep into a big table costs only the rows on it.
+
+        table, geometry_column = self._table(**kwargs)
+        if table.strip().lower().startswith('select'):
+            table = '(' + table + ")"
+        table = table.replace('%', '%%')  # the query is run with parameters, so literal percents must be doubled
+        srid = self._srid
+
+        where = []
+        params = []
+        if 'bbox' in lyr:
+            where.append("{geometry_column} && ST_MakeEnvelope(%s, %s, %s, %s, {srid})")
+            params.extend(float(b) for b in lyr['bbox'])
+
+        if 'boundary' in lyr:
+            where.append("ST_Intersects(ST_GeomFromText(%s, {srid}), {geometry_column})")
+            params.append(getattr(lyr['boundary'], 'wkt', lyr['boundary']))
+
+        for clause, values in lyr.get('query', []):
+            where.append(clause)
+            params.extend(values)
+
+        q = "SELECT AsBinary({geometry_column}), * FROM {table} AS w"
+        if where:
+            q += ' WHERE ' + ' AND '.join(where)
+
+        if 'sort_by' in kwargs:
+            sort_by = kwargs['sort_by']
+            if isinstance(sort_by, basestring):
+                sort_by = sort_by.split(',')
+            q += ' ORDER BY ' + ','.join(quote_identifier(column.strip()) for column in sort_by)
+
+        if count is not None:
+            q += ' LIMIT %s'
+            params.append(count)
+        if start:
+            q += ' OFFSET %s'
+            params.append(start)
+
+        cursor = self._cursor(**kwargs)
+        execute(cursor, q.format(
+            geometry_column=geometry_column,
+            table=table,
+            srid=srid
+        ), params)
+        return cursor, geometry_column
+
+    def feature_rows(self, **kwargs):
+        """Stream the rows selected by the as_dataframe filters from a server side cursor, without building a dataframe"""
+        cursor, geometry_column = self._filtered_cursor(big=True, **kwargs)
+        return features_from_cursor(cursor, geometry_column)
+
     def as_dataframe(self, **kwargs):
         """
         Creates a dataframe object for a shapefile's main layer using layer_as_dataframe. This object is cached on disk for
         layer use, but the cached copy will only be picked up if the shapefile's mtime is older than the dataframe's mtime.
 
-        :param shp: The shapefile
+        :param lazy_geometry: leave the geometry column as raw WKB.  see ga_resources.drivers.decode_geometry
+        :param columns: only read these columns of the cached dataframe
+        :param bbox, boundary, query: filters, run by the server.  query is a dict of django style column__op: value
+        :param start, count, sort_by: the slice of the sorted rows to return, also run by the server
         :return:
         """
 
-        dfx_path = self.get_filename('dfx')
+        lazy_geometry = kwargs.pop('lazy_geometry', False)
+        columns = kwargs.pop('columns', None)
 
         if len(kwargs) != 0:
-            cfg = self.resource.driver_config
-            lyr = {}
-            crx = xrc = None
-
-            if 'bbox' in kwargs:
-                minx, miny, maxx, maxy = kwargs['bbox']
-
-                if 'srs' in kwargs:
-                    if isinstance(kwargs['srs'], basestring):
-                        s_srs = osr.SpatialReference()
-                        if kwargs['srs'].lower().startswith('epsg:'):
-                            s_srs.ImportFromEPSG(int(kwargs['srs'].split(':')[1]))
-                        else:
-                            s_srs.ImportFromProj4(kwargs['srs'])
-                    else:
-                        s_srs = kwargs['srs']
-
-                    t_srs = self.resource.srs
-
-                    if s_srs.ExportToProj4() != t_srs.ExportToProj4():
-                        crx = osr.CoordinateTransformation(s_srs, t_srs)
-                        minx, miny, _ = crx.TransformPoint(minx, miny)
-                        maxx, maxy, _ = crx.TransformPoint(maxx, maxy)
-                        xrc = osr.CoordinateTransformation(t_srs, s_srs)
-
-                lyr['bbox'] = (minx, miny, maxx, maxy)
-            elif 'boundary' in kwargs:
-                lyr['boundary'] = kwargs['boundary']
-
-
-            if 'query' in kwargs:
-                lyr['query'] = []
-
-                if isinstance(kwargs['query'], basestring):
-                    query = json.loads(kwargs['query'])
-                else:
-                    query = kwargs['query']
+            cursor, geometry_column = self._filtered_cursor(**kwargs)
+            return dataframe_from_cursor(cursor, geometry_column, lazy_geometry=lazy_geometry, type_codes=POSTGRES_DTYPES)
 
-                lyr['query'] = ' AND '.join(self.attrquery(key, value) for key, value in query.items())
-
-            start = kwargs['start'] if 'start' in kwargs else 0
-            count = start + kwargs['count'] if 'count' in kwargs else -1
-
-
-            # contsruct query
-
-            cursor = self._cursor(**kwargs)
+        else:
+            return self.cached_dataframe(self.load_dataframe, columns=columns, lazy_geometry=lazy_geometry)
+
+    # REST data API.  These mirror SpatialiteDriver's query and editing interface on a plain table, keyed by the
+    # integer column key_field.  Every value is a query parameter and every column name is quoted.
+
+    @property
+    def _tablename(self):
+        return self._table()[0]
+
+    @property
+    def _geometry_field(self):
+        return self._table()[1]
+
+    @property
+    def _srid(self):
+        """The native srid: from driver_config, or else geometry_columns, or else 4326"""
+        srid = self.resource.driver_config.get('srid', None)
+        if srid is None:
+            table, geometry_field = self._table()
+            srid = self._metadata(table, ('srid', geometry_field), lambda: self._geometry_srid(table, geometry_field))
+        return int(srid or 4326)
+
+    @property
+    def _key_field(self):
+        return self.resource.driver_config.get('key_field', 'ogc_fid')
+
+    def _geometry_parameter(self, srid=None):
+        """SQL for a WKT query parameter in srid, transformed to the native srid if it differs"""
+        if srid and int(srid) != self._srid:
+            return 'ST_Transform(ST_GeomFromText(%s, {srid}), {native})'.format(srid=int(srid), native=self._srid)
+        return 'ST_GeomFromText(%s, {native})'.format(native=self._srid)
+
+    def schema(self):
+        c = self._connection().cursor()
+        c.execute('select * from {table} limit 0'.format(table=self._tablename))
+        names = [d[0] for d in c.description]
+        c.close()
+        return names
+
+    def full_schema(self):
+        human_names = {
+            'text': 'Text',
+            'character varying': 'Text',
+            'character': 'Text',
+            'double precision': 'Real',
+            'real': 'Real',
+            'numeric': 'Real',
+            'integer': 'Integer',
+            'bigint': 'Integer',
+            'smallint': 'Integer',
+            'point': 'Point',
+            'linestring': 'LineString',
+            'polygon': 'Polygon',
+            'multipoint': 'MultiPoint',
+            'multilinestring': 'MultiLineString',
+            'multipolygon': 'MultiPolygon',
+            'geometrycollection': 'GeometryCollection',
+        }
 
+        c = self._connection().cursor()
+        c.execute('''select attname, format_type(atttypid, atttypmod) from pg_attribute
+            where attrelid = %s::regclass and attnum > 0 and not attisdropped''', [self._tablename])
+        schema = {}
+        for name, typename in c.fetchall():
+            typename = typename.lower()
+            if typename.startswith('geometry('):  # geometry(MultiPolygon,4326)
+                typename = typename[len('geometry('):].split(',')[0].rstrip(')')
+            schema[name] = human_names.get(typename.split('(')[0], '*')
+        c.close()
+        return schema
+
+    def add_column(self, name, field_type):
+        if not re.match(r'^[a-zA-Z][a-zA-Z ]*(\(\s*\d+\s*(,\s*\d+\s*)?\))?$', field_type):
+            raise ValueError('unsupported column type {field_type}'.format(field_type=field_type))
 
-            q = "SELECT AsBinary({geometry_column}), * FROM {table} AS w WHERE "
-            addand = False
-            if 'bbox' in lyr:
-                q += "{geometry_column} && ST_SetSRID(ST_MakeBox2D(ST_Point({xmin}, {ymin}), ST_Point({xmax}, {ymax})), {srid}) "
-                addand = True
+        connection = self._connection()
+        c = connection.cursor()
+        c.execute('alter table {table} add column {column_name} {column_type}'.format(
+            table=self._tablename,
+            column_name=quote_identifier(name),
+            column_type=field_type
+        ))
+        c.close()
+        connection.commit()
+        self.data_changed()
 
-            if 'boundary' in lyr:
-                q += "ST_Intersects(GeomFromText('{boundary}', {geometry_column}))"
-                addand = True
+    def data_changed(self, added=None, removed=None):
+        """Without added or removed rows the table itself may have changed, so prepared statements are dropped too"""
+        if added is None and removed is None:
+            schema_changed()
+        super(PostGISDriver, self).data_changed(added=added, removed=removed)
 
-            if 'query' in lyr:
-                if addand:
-                    q += ' AND '
-                q += lyr['query']
+    def create_index(self, *fields):
+        connection = self._connection()
+        c = connection.cursor()
+        c.execute('create index {index_name} on {table} ({fields})'.format(
+            index_name=quote_identifier('_'.join([self._tablename.split('.')[-1]] + list(fields))),
+            table=self._tablename,
+            fields=','.join(quote_identifier(f) for f in fields)
+        ))
+        c.close()
+        connection.commit()
+
+    def _old_rows(self, keys, columns=None):
+        """The current values of rows that are about to be updated or deleted, for folding into the cached summary.
+        Empty if there is no cached summary to fold them into."""
+        if not self.has_cached_summary():
+            return []
+
+        key = self._key_field
+        columns = [k for k in (columns or self.schema()) if k not in (self._geometry_field, key)]
+        c = self._connection().cursor()
+        execute(c, 'select {columns} from {table} where {key} = ANY(%s)'.format(
+            columns=','.join(quote_identifier(k) for k in [key] + columns),
+            table=self._tablename,
+            key=quote_identifier(key)
+        ), [[int(k) for k in keys]])
+        rows = [dict(zip([key] + columns, row)) for row in c.fetchall()]
+        c.close()
+        return rows
+
+    def _new_row(self, values, key):
+        """An inserted row as it is stored, with every column, for folding into the cached summary"""
+        row = dict((k, values.get(k, None)) for k in self.schema() if k != self._geometry_field)
+        row[self._key_field] = key
+        return row
+
+    def _insert_statement(self, keys, srid=None):
+        return 'insert into {table} ({keys}) values ({values})'.format(
+            table=self._tablename,
+            keys=','.join(quote_identifier(k) for k in keys),
+            values=','.join('%s' if k != self._geometry_field else self._geometry_parameter(srid) for k in keys)
+        )
+
+    def delete_row(self, key):
+        removed = self._old_rows([key])
+        connection = self._connection()
+        c = connection.cursor()
+        c.execute('delete from {table} where {key} = %s'.format(table=self._tablename, key=quote_identifier(self._key_field)), [int(key)])
+        c.close()
+        connection.commit()
+        self.data_changed(removed=removed)
+
+    def add_row(self, **values):
+        srid = values.pop('srid', None)
+        keys = [k for k in values.keys() if k != self._key_field]
+        connection = self._connection()
+        c = connection.cursor()
+        c.execute(self._insert_statement(keys, srid) + ' returning {key}'.format(key=quote_identifier(self._key_field)),
+                  [values[k] for k in keys])
+        new_id = c.fetchone()[0]
+        c.close()
+        connection.commit()
+        self.data_changed(added=[self._new_row(values, new_id)])
+        return self.get_row(new_id, geometry_format='wkt')
+
+    def update_row(self, key, **values):
+        srid = values.pop('srid', None)
+        values.pop(self._key_field, None)
+        changed = [k for k in values.keys() if k != self._geometry_field]
+        removed = [dict((k, row[k]) for k in changed) for row in self._old_rows([key], changed)]
 
-            if count > 0:
-                q += ' LIMIT {count}'.format(count=count)
+        connection = self._connection()
+        c = connection.cursor()
+        if values:
+            c.execute('update {table} set {set_clause} where {key} = %s'.format(
+                table=self._tablename,
+                set_clause=','.join('{column}={value}'.format(
+                    column=quote_identifier(k),
+                    value='%s' if k != self._geometry_field else self._geometry_parameter(srid)) for k in values.keys()),
+                key=quote_identifier(self._key_field)
+            ), values.values() + [int(key)])
+        c.close()
+        connection.commit()
+        self.data_changed(added=[dict((k, values[k]) for k in changed)] if removed else [], removed=removed)
+        return self.get_row(key, geometry_format='wkt')
+
+    def add_rows(self, rows, srid=None):
+        """
+        Insert many rows in a single transaction, a multi-row insert per thousand rows.
 
-            table, geometry_column = self._table(**kwargs)
-            if table.strip().lower().startswith('select'):
-                table = '(' + table + ")"
+        :param rows: a list of dicts of column name to value.  Geometries are WKT.
+        :param srid: the srid of the geometries, if not the native srid of the table.
+        :return: the new keys, in the same order as rows.
+        """
+        if not rows:
+            return []
 
-            cursor.execute(q.format(
-                boundary = cfg.get('boundary', None),
-                geometry_column = geometry_column,
-                table = table,
-                srid=cfg.get('srid',4326),
-                **dict(zip(('xmin','ymin','xmax','ymax'), lyr.get('bbox',(0,0,0,0))))
-            ))
-            for i in range(start):
-                cursor.fetchone()
+        keys = sorted(set(k for row in rows for k in row.keys() if k not in {'srid', self._key_field}))
+        values = '(' + ','.join('%s' if k != self._geometry_field else self._geometry_parameter(srid) for k in keys) + ')'
+        connection = self._connection()
+        c = connection.cursor()
+        new_ids = []
+        try:
+            for i in range(0, len(rows), 1000):
+                chunk = rows[i:i + 1000]
+                c.execute('insert into {table} ({keys}) values {values} returning {key}'.format(
+                    table=self._tablename,
+                    keys=','.join(quote_identifier(k) for k in keys),
+                    values=','.join(c.mogrify(values, [row.get(k, None) for k in keys]) for row in chunk),
+                    key=quote_identifier(self._key_field)
+                ))
+                new_ids.extend(r[0] for r in c.fetchall())
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+        finally:
+            c.close()
+
+        self.data_changed(added=[self._new_row(row, key) for row, key in zip(rows, new_ids)])
+        return new_ids
+
+    def update_rows(self, rows, srid=None):
+        """
+        Update many rows in a single transaction.  Rows are grouped by the set of columns they change so that each
+        group is written with one statement, prepared once and executed for each row.
 
-            names = [c.name for c in cursor.description]
-            throwaway_ix = names[1:].index(geometry_column) + 1
-            records = []
-            for record in cursor:
-                records.append({name: value for i, (name, value) in enumerate(zip(names, record)) if i != throwaway_ix})
-                records[-1]['geometry'] = wkb.loads(str(records[-1]['asbinary']))
-                del records[-1]['asbinary']
+        :param rows: a list of dicts of column name to value.  Each one must contain the key_field.
+        :param srid: the srid of the geometries, if not the native srid of the table.
+        :return: the keys that were updated.  Rows that matched nothing or had nothing to change are left out.
+        """
+        key = self._key_field
+        groups = {}
+        for row in rows:
+            keys = tuple(sorted(k for k in row.keys() if k not in {'srid', key}))
+            if keys:
+                groups.setdefault(keys, []).append(row)
 
-            df = DataFrame.from_records(data=records)
+        changed = dict((int(row[key]), [k for k in row.keys() if k not in ('srid', key, self._geometry_field)]) for row in rows)
+        old = self._old_rows(changed.keys(), sorted(set(k for keys in changed.values() for k in keys)))
 
-            if 'sort_by' in kwargs:
-                df = df.sort_index(by=kwargs['sort_by'])
+        updated = []
+        connection = self._connection()
+        c = connection.cursor()
+        try:
+            for keys, group in groups.items():
+                statement = 'update {table} set {set_clause} where {key} = %s'.format(
+                    table=self._tablename,
+                    set_clause=','.join('{column}={value}'.format(
+                        column=quote_identifier(k),
+                        value='%s' if k != self._geometry_field else self._geometry_parameter(srid)) for k in keys),
+                    key=quote_identifier(key)
+                )
+                for row in group:  # one at a time, since executemany only reports the total rowcount
+                    execute(c, statement, [row[k] for k in keys] + [int(row[key])])
+                    if c.rowcount > 0:
+                        updated.append(int(row[key]))
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+        finally:
+            c.close()
+
+        updated_set = set(updated)
+        removed = [dict((k, row[k]) for k in changed[row[key]]) for row in old if row[key] in updated_set]
+        added = [dict((k, row[k]) for k in changed[int(row[key])]) for row in rows if int(row[key]) in updated_set] if old else []
+        if updated:
+            self.data_changed(added=added, removed=removed)
+        return updated
+
+    def delete_rows(self, keys):
+        """Delete many rows by key in a single statement"""
+        removed = self._old_rows(keys)
+        connection = self._connection()
+        c = connection.cursor()
+        try:
+            c.execute('delete from {table} where {key} = ANY(%s)'.format(
+                table=self._tablename,
+                key=quote_identifier(self._key_field)
+            ), [[int(k) for k in keys]])
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+        finally:
+            c.close()
+
+        self.data_changed(removed=removed)
+
+    def extent_of_rows(self, keys):
+        """
+        The union bounding box of a set of rows in native coordinates.
 
-            return df
+        :param keys: values of the key_field
+        :return: an (xmin, ymin, xmax, ymax) tuple, or None if none of the rows has a geometry.
+        """
+        c = self._connection().cursor()
+        execute(c, 'select ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) from (select ST_Extent({geometry}) as e from {table} where {key} = ANY(%s)) as x'.format(
+            geometry=quote_identifier(self._geometry_field),
+            table=self._tablename,
+            key=quote_identifier(self._key_field)
+        ), [[int(k) for k in keys]])
+        extent = c.fetchone()
+        c.close()
+        return None if extent[0] is None else tuple(extent)
+
+    def _geometry_output(self, geometry_format, tolerance=None, precision=None):
+        """A select expression for the geometry column in the output format, or None for no geometry"""
+        geometry = quote_identifier(self._geometry_field)
+        if tolerance:
+            geometry = 'ST_SimplifyPreserveTopology({geometry}, {tolerance})'.format(geometry=geometry, tolerance=float(tolerance))
+        geometry_format = (geometry_format or '').lower()
+        if geometry_format == 'geojson':
+            return 'ST_AsGeoJSON({geometry}{precision})'.format(
+                geometry=geometry,
+                precision=', {0}'.format(int(precision)) if precision is not None else '')
+        elif geometry_format == 'wkt':
+            if precision is not None:
+                geometry = 'ST_SnapToGrid({geometry}, {size})'.format(geometry=geometry, size=10.0 ** -int(precision))
+            return 'ST_AsText({geometry})'.format(geometry=geometry)
+        return None
+
+    def _select_rows(self, columns, where_clauses, where_values, geometry_format='geojson', tolerance=None,
+                     precision=None, order_clause='', order_values=(), limit=None):
+        """Run a select of columns and the geometry in geometry_format, returning a list of dicts"""
+        geometry = self._geometry_field
+        with_geometry = geometry in columns
+        output = self._geometry_output(geometry_format, tolerance, precision) if with_geometry else None
+        columns = [k for k in columns if k != geometry]
+        select = [quote_identifier(k) for k in columns] + ([output] if output else [])
+
+        c = self._connection().cursor()
+        execute(c, 'select {select} from {table}{where} {order_clause}{limit}'.format(
+            select=','.join(select) or 'null',
+            table=self._tablename,
+            where=' where ' + ' and '.join(where_clauses) if where_clauses else '',
+            order_clause=order_clause,
+            limit=' limit %s' if limit else ''
+        ), where_values + list(order_values) + ([int(limit)] if limit else []))
+
+        records = []
+        for row in c.fetchall():
+            record = dict(zip(columns, row))
+            if output:
+                g = row[len(columns)]
+                record[geometry] = json.loads(g) if g and geometry_format.lower() == 'geojson' else g
+            elif with_geometry:
+                record[geometry] = None
+            records.append(record)
+        c.close()
+        return records
+
+    def get_row(self, key, geometry_format='geojson'):
+        rows = self._select_rows(self.schema(), ['{key} = %s'.format(key=quote_identifier(self._key_field))], [int(key)],
+                                 geometry_format=geometry_format)
+        return rows[0] if rows else None
+
+    def get_rows(self, key_start=0, key_end=None, limit=50, geometry_format='geojson'):
+        key = quote_identifier(self._key_field)
+        where_clauses = ['{key} >= %s'.format(key=key)]
+        where_values = [int(key_start)]
+        if key_end:
+            where_clauses.append('{key} <= %s'.format(key=key))
+            where_values.append(int(key_end))
+            limit = None
+
+        return self._select_rows(self.schema(), where_clauses, where_values, geometry_format=geometry_format,
+                                 order_clause='order by {key}'.format(key=key), limit=limit if limit > -1 else None)
+
+    query_operators = {
+        'eq': '=',
+        '=': '=',
+        'gt': '>',
+        'ge': '>=',
+        'lt': '<',
+        'le': '<=',
+        'contains': 'like',
+        'startswith': 'like',
+        'endswith': 'like',
+        'isnull': 'is null',
+        'notnull': 'is not null',
+        'ne': '<>',
+        'regexp': '~',
+        'like': 'like'
+    }
+
+    # geometry operators and the PostGIS predicates they are run as.  All but disjoint are answered from the GiST index
+    geom_operators = {
+        'equals': 'ST_Equals',
+        'disjoint': 'ST_Disjoint',
+        'touches': 'ST_Touches',
+        'within': 'ST_Within',
+        'overlaps': 'ST_Overlaps',
+        'crosses': 'ST_Crosses',
+        'intersects': 'ST_Intersects',
+        'contains': 'ST_Contains',
+        'mbrequal': '{geometry} ~= {qg}',
+        'mbrdisjoint': 'NOT {geometry} && {qg}',
+        'mbrtouches': 'ST_Touches(ST_Envelope({geometry}), ST_Envelope({qg}))',
+        'mbrwithin': '{geometry} @ {qg}',
+        'mbroverlaps': '{geometry} && {qg}',
+        'mbrintersects': '{geometry} && {qg}',
+        'mbrcontains': '{geometry} ~ {qg}',
+    }
+
+    def _query_where(
+            self,
+            geometry_operator='intersects',
+            query_geometry=None,
+            query_mbr=None,
+            query_geometry_srid=None,
+            start=None,
+            end=None,
+            alias=None,
+            **kwargs
+    ):
+        """
+        Parse the filter arguments to query() into SQL.
 
-        elif hasattr(self, '_df'):
-            return self._df
+        :param alias: if the table is aliased in the statement, qualify column names with the alias
+        :return: a list of where clauses to be and-ed together and the list of values bound to their placeholders
+        """
+        column = lambda name: (alias + '.' if alias else '') + quote_identifier(name)
+        key = column(self._key_field)
+        geometry = column(self._geometry_field)
+        geometry_operator = geometry_operator.lower() if geometry_operator else None
+
+        if query_geometry and not isinstance(query_geometry, basestring):
+            query_geometry = query_geometry.wkt
+        elif query_mbr:
+            query_geometry = shapely.geometry.box(*query_mbr).wkt
+
+        where_clauses = []
+        where_values = []
+        for name, value in sorted(kwargs.items()):  # sorted, so the same filters always make the same statement
+            name, _, op = name.partition('__')
+            op = op or 'eq'
+            if op not in self.query_operators:
+                raise ValueError('unsupported query operator {op}'.format(op=op))
+            if op in ('isnull', 'notnull'):
+                where_clauses.append('{column} {op}'.format(column=column(name), op=self.query_operators[op]))
+                continue
+            where_clauses.append('{column} {op} %s'.format(column=column(name), op=self.query_operators[op]))
+            where_values.append({
+                'contains': lambda x: '%' + x + '%',
+                'startswith': lambda x: x + '%',
+                'endswith': lambda x: '%' + x,
+            }.get(op, lambda x: x)(value))
+
+        if start:
+            where_clauses.append('{key} >= %s'.format(key=key))
+            where_values.append(int(start))
+        if end:
+            where_clauses.append('{key} <= %s'.format(key=key))
+            where_values.append(int(end))
+
+        if query_geometry:
+            qg = self._geometry_parameter(query_geometry_srid)
+            if geometry_operator.startswith('relate'):
+                geometry_operator, matrix = geometry_operator.split(':')
+                where_clauses.append('ST_Relate({geometry}, {qg}, %s)'.format(geometry=geometry, qg=qg))
+                where_values.extend([query_geometry, matrix])
+            elif geometry_operator.startswith('distance'):
+                geometry_operator, srid, comparator, val = geometry_operator.split(':')
+                if len(srid) == 0 and comparator in {'lt', 'le'}:  # "closer than" in native units is an index search
+                    where_clauses.append('ST_DWithin({geometry}, {qg}, %s)'.format(geometry=geometry, qg=qg))
+                    if comparator == 'lt':
+                        where_clauses.append('ST_Distance({geometry}, {qg}) < %s'.format(geometry=geometry, qg=qg))
+                        where_values.extend([query_geometry, float(val), query_geometry, float(val)])
+                    else:
+                        where_values.extend([query_geometry, float(val)])
+                else:
+                    if len(srid) > 0:
+                        geometry = 'ST_Transform({geometry}, {srid})'.format(geometry=geometry, srid=int(srid))
+                        qg = 'ST_Transform({qg}, {srid})'.format(qg=qg, srid=int(srid))
+                    where_clauses.append('ST_Distance({geometry}, {qg}) {op} %s'.format(
+                        geometry=geometry, qg=qg, op=self.query_operators[comparator]))
+                    where_values.extend([query_geometry, float(val)])
+            elif geometry_operator in self.geom_operators:
+                predicate = self.geom_operators[geometry_operator]
+                if '{' not in predicate:
+                    predicate += '({geometry}, {qg})'
+                where_clauses.append(predicate.format(geometry=geometry, qg=qg))
+                where_values.append(query_geometry)
+            else:
+                raise NotImplementedError('unsupported query operator for geometry')
+
+        return where_clauses, where_values
+
+    def query(
+            self,
+            geometry_operator='intersects',
+            query_geometry=None,
+            query_mbr=None,
+            query_geometry_srid=None,
+            only=None,
+            start=None,
+            end=None,
+            limit=None,
+            geometry_format='geojson',
+            order_by=None,
+            tolerance=None,
+            zoom=None,
+            precision=None,
+            **kwargs
+    ):
+        """
+        Query the dataset.  Besides the filters of _query_where:
 
-        elif os.path.exists(dfx_path):
-            self._df = pandas.read_pickle(dfx_path)
-            return self._df
+        :param geometry_operator: also nearest:N, for the N rows nearest to the query geometry in order of distance,
+            found by walking the GiST index
+        :param tolerance: simplify geometries with ST_SimplifyPreserveTopology to this tolerance in native units
+        :param zoom: simplify geometries to the detail visible at this web map zoom level, if tolerance isn't given
+        :param precision: round output coordinates to this many decimal places
+        """
+        columns = only or self.schema()
+        if zoom is not None and not tolerance:
+            tolerance = zoom_tolerance(int(zoom), self.resource.srs)
+
+        order_clause = ''
+        order_values = []
+        if geometry_operator and geometry_operator.lower().startswith('nearest'):
+            if not query_geometry and query_mbr:
+                query_geometry = shapely.geometry.box(*query_mbr).wkt
+            elif not query_geometry:
+                raise ValueError('{op} needs a query geometry, as g or a bounding box'.format(op=geometry_operator))
+            elif not isinstance(query_geometry, basestring):
+                query_geometry = query_geometry.wkt
+            where_clauses, where_values = self._query_where(geometry_operator=None, start=start, end=end, **kwargs)
+            order_clause = 'order by {geometry} <-> {qg}'.format(
+                geometry=quote_identifier(self._geometry_field),
+                qg=self._geometry_parameter(query_geometry_srid))
+            order_values = [query_geometry]
+            limit = int(geometry_operator.split(':')[1])
         else:
-            table, geometry_column = self._table(**kwargs)
-            query = "SELECT AsBinary({geometry_column}), * FROM {table}".format(table=table, geometry_column=geometry_column)
-            print query
-            cursor = self._cursor(**kwargs)
-            cursor.execute(query)
-            names = [c.name for c in cursor.description]
-            throwaway_ix = names[1:].index(geometry_column) + 1
-            records = []
-            for record in cursor.fetchall():
-                records.append({name: value for i, (name, value) in enumerate(zip(names, record)) if i != throwaway_ix})
-                records[-1]['geometry'] = wkb.loads(str(records[-1]['asbinary']))
-                del records[-1]['asbinary']
-
-            df = DataFrame.from_records(data=records)
-            df.to_pickle(dfx_path)
-            self._df = df
-            return self._df
-
+            where_clauses, where_values = self._query_where(
+                geometry_operator=geometry_operator,
+                query_geometry=query_geometry,
+                query_mbr=query_mbr,
+                query_geometry_srid=query_geometry_srid,
+                start=start,
+                end=end,
+                **kwargs
+            )
+            if order_by:
+                order_clause = 'order by ' + ','.join(quote_identifier(k) for k in order_by.split(','))
+
+        return self._select_rows(columns, where_clauses, where_values, geometry_format=geometry_format,
+                                 tolerance=tolerance, precision=precision, order_clause=order_clause,
+                                 order_values=order_values, limit=limit)
+
+    aggregate_functions = {'count', 'sum', 'avg', 'min', 'max'}
+
+    def aggregate(
+            self,
+            aggregates=(('count', '*'),),
+            group_by=(),
+            grid=None,
+            zones=None,
+            zone_key=None,
+            **kwargs
+    ):
+        """
+        Aggregate the rows matching a query in the database, so that only the aggregated rows are returned.  See
+        SpatialiteDriver.aggregate.  zones must be a PostGIS DataResource in the same database, and zone_key defaults to its
+        key field.
+        """
+        schema = set(self.schema())
+        geometry = quote_identifier(self._geometry_field)
+        for column in group_by:
+            if column not in schema:
+                raise ValueError('cannot group by unknown column {column}'.format(column=column))
+
+        select = ['w.' + quote_identifier(column) for column in group_by]
+        names = list(group_by)
+        for function, column in aggregates:
+            function = function.lower()
+            if function not in self.aggregate_functions or (column != '*' and column not in schema):
+                raise ValueError('unsupported aggregate {function}({column})'.format(function=function, column=column))
+            select.append('{function}({column})'.format(function=function, column=column if column == '*' else 'w.' + quote_identifier(column)))
+            names.append(function if column == '*' else function + '_' + column)
+
+        group_clauses = list(select[:len(group_by)])
+        from_clause = '{table} AS w'.format(table=self._tablename)
+
+        if grid:
+            grid = float(grid)
+            for axis in ('X', 'Y'):
+                select.append('floor(ST_{axis}(ST_Centroid(w.{geometry})) / {grid})::integer'.format(axis=axis, geometry=geometry, grid=grid))
+                group_clauses.append(select[-1])
+            names.extend(['cell_x', 'cell_y'])
+
+        if zones:
+            zone_driver = zones.driver_instance
+            if not isinstance(zone_driver, PostGISDriver) or \
+                    connection_parameters(zone_driver.resource.driver_config) != connection_parameters(self.resource.driver_config):
+                raise ValueError('zones must be a PostGIS dataset in the same database')
+            zone_key = zone_key or zone_driver._key_field
+            if zone_key not in zone_driver.schema():
+                raise ValueError('zones have no column {zone_key}'.format(zone_key=zone_key))
+
+            zone_geometry = 'z.' + quote_identifier(zone_driver._geometry_field)
+            if zone_driver._srid != self._srid:
+                zone_geometry = 'ST_Transform({zone_geometry}, {srid})'.format(zone_geometry=zone_geometry, srid=self._srid)
+            from_clause += ' JOIN {zone_table} AS z ON ST_Intersects({zone_geometry}, w.{geometry})'.format(
+                zone_table=zone_driver._tablename,
+                zone_geometry=zone_geometry,
+                geometry=geometry
+            )
+            select.append('z.' + quote_identifier(zone_key))
+            group_clauses.append(select[-1])
+            names.append(zone_key)
+
+        where_clauses, where_values = self._query_where(alias='w', **kwargs)
+
+        c = self._connection().cursor()
+        c.execute('select {select} from {from_clause} {where} {group}'.format(
+            select=','.join(select),
+            from_clause=from_clause,
+            where=' where ' + ' and '.join(where_clauses) if where_clauses else '',
+            group=' group by ' + ','.join(group_clauses) if group_clauses else ''
+        ), where_values)
+        rows = [dict(zip(names, row)) for row in c.fetchall()]
+        c.close()
+
+        if grid:
+            for row in rows:
+                x, y = row['cell_x'], row['cell_y']
+                row['cell'] = [x * grid, y * grid, (x + 1) * grid, (y + 1) * grid]
+
+        return rows
+
+    @classmethod
+    def create_dataset(cls, title, parent=None, geometry_column_name='geometry', srid=4326, geometry_type='GEOMETRY', owner=None, columns_definitions=()):
+        """
+        Create an empty table in the database of GA_RESOURCES_POSTGIS_DATASETS, a driver_config without a table, and a
+        DataResource for it keyed by ogc_fid.
+        """
+        from ga_resources.models import DataResource
+
+        cfg = dict(DATASETS_CONFIG)
+        if not cfg:
+            raise ValueError('GA_RESOURCES_POSTGIS_DATASETS is not configured')
+        if not re.match(r'^[a-zA-Z]+$', geometry_type):
+            raise ValueError('unsupported geometry type {geometry_type}'.format(geometry_type=geometry_type))
+
+        table = cfg.pop('schema', 'public') + '.ds_' + uuid4().hex
+        geometry = quote_identifier(geometry_column_name)
+        connection = config_connection(cfg)
+        c = connection.cursor()
+        try:
+            c.execute('create table {table} (ogc_fid serial primary key, {geometry} geometry({geometry_type}, {srid}))'.format(
+                table=table, geometry=geometry, geometry_type=geometry_type, srid=int(srid)))
+            c.execute('create index on {table} using gist ({geometry})'.format(table=table, geometry=geometry))
+            for column, datatype in columns_definitions:
+                if not re.match(r'^[a-zA-Z][a-zA-Z ]*(\(\s*\d+\s*(,\s*\d+\s*)?\))?$', datatype):
+                    raise ValueError('unsupported column type {datatype}'.format(datatype=datatype))
+                c.execute('alter table {table} add column {column} {datatype}'.format(
+                    table=table, column=quote_identifier(column), datatype=datatype))
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+        finally:
+            c.close()
+
+        cfg.update(table=[table, geometry_column_name], srid=int(srid), key_field='ogc_fid')
+        ds = DataResource.objects.create(
+            title=title,
+            parent=parent,
+            driver='ga_resources.drivers.postgis',
+            resource_config=json.dumps(cfg),
+            in_menus=[],
+            owner=owner
+        )
+        ds.resource.compute_fields()
+        return ds
 
 
 
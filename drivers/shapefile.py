@@ -1,16 +1,19 @@
 # from ga_ows.views import wms, wfs
 import shutil
 import json
+from collections import OrderedDict
+from itertools import izip
 from zipfile import ZipFile
 
 import pandas
 from django.contrib.gis.geos import Polygon
 import os
 import sh
-from osgeo import osr, ogr
-from . import Driver
+from osgeo import ogr
+from . import Driver, decode_wkb
+from .sql import attribute_filter, attribute_filters, literal
+from ga_resources.spatialrefs import proj4, spatial_reference, transformation
 from pandas import DataFrame
-from shapely import wkb
 from django.template.defaultfilters import slugify
 import re
 
@@ -45,6 +48,73 @@ def transform(geom, crx):
     return geom
 
 
+def layer_as_dataframe(lyr, start=0, count=None, crx=None, lazy_geometry=False, columns=None):
+    """
+    Read an OGR layer into a DataFrame indexed by fid.  Attribute values are collected into one list per field rather
+    than a dict per feature, and geometries are exported to WKB and decoded in a single pass at the end, or left as
+    WKB if lazy_geometry is True.  Features without geometry are skipped.
+
+    :param start: number of features to skip.  The layer seeks to it with SetNextByIndex, which the shapefile driver
+        does without reading the features before it, unless a filter is set.
+    :param count: maximum number of features to read, or None for all of them
+    :param crx: an optional CoordinateTransformation to apply to each geometry
+    :param columns: only these columns (and 'geometry' if it is listed), in this order.  OGR is told to ignore the
+        other fields, so they are never read from the file.
+    """
+    defn = lyr.GetLayerDefn()
+    names = [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())]
+    keep_geometry = columns is None or 'geometry' in columns
+    lyr.SetIgnoredFields([str(name) for name in names if columns is not None and name not in columns] + ['OGR_STYLE'])
+    if columns is not None:
+        names = [name for name in columns if name != 'geometry']
+    fields = [defn.GetFieldIndex(str(name)) for name in names]
+    if -1 in fields:
+        raise KeyError('no such columns {0}'.format([name for name, i in izip(names, fields) if i == -1]))
+    fids = []
+    wkbs = []
+    values = [[] for _ in names]
+
+    lyr.ResetReading()
+    if start and lyr.SetNextByIndex(start) != ogr.OGRERR_NONE:
+        f = None  # past the end of the layer
+    else:
+        f = lyr.GetNextFeature()
+
+    read = 0
+    while f is not None and (count is None or read < count):
+        g = f.GetGeometryRef()
+        if g is not None:
+            fids.append(f.GetFID())
+            if keep_geometry:
+                wkbs.append(transform(g, crx).ExportToWkb())
+            for field, column in izip(fields, values):
+                column.append(f.GetField(field))
+        read += 1
+        f = lyr.GetNextFeature()
+
+    data = OrderedDict()
+    for i, name in enumerate(names):
+        data[name] = pandas.Series(values[i])
+        values[i] = None
+    if keep_geometry:
+        data['geometry'] = pandas.Series(wkbs if lazy_geometry else decode_wkb(wkbs), dtype=object)
+
+    df = DataFrame(data, columns=list(columns) if columns is not None else list(data.keys()))
+    df.index = pandas.Index(fids, name='fid')
+    return df
+
+
+def set_attribute_filter(lyr, query):
+    """
+    Filter a layer by every django style filter in a query at once.  The filters are ANDed into a single OGR attribute
+    filter, since each call to SetAttributeFilter replaces the one before it.
+    """
+    if isinstance(query, basestring):
+        query = json.loads(query)
+    if query:
+        lyr.SetAttributeFilter(attribute_filters(query, placeholder=literal, ilike='LIKE')[0])
+
+
 class ShapefileDriver(Driver):
     @classmethod
     def supports_multiple_layers(cls):
@@ -92,8 +162,7 @@ class ShapefileDriver(Driver):
 
         if not projection_found:
             with open(self.cached_basename + '.prj', 'w') as f:
-                srs = osr.SpatialReference()
-                srs.ImportFromEPSG(4326)
+                srs = spatial_reference(4326)
                 f.write(srs.ExportToWkt())
 
         ds = ogr.Open(self.cached_basename + '.shp')
@@ -103,9 +172,7 @@ class ShapefileDriver(Driver):
 
 
         self.resource.spatial_metadata.native_srs = crs.ExportToProj4()
-        e4326 = osr.SpatialReference()
-        e4326.ImportFromEPSG(4326)
-        crx = osr.CoordinateTransformation(crs, e4326)
+        crx = transformation(crs, 4326)
         x04326, y04326, _ = crx.TransformPoint(xmin, ymin)
         x14326, y14326, _ = crx.TransformPoint(xmax, ymax)
         self.resource.spatial_metadata.bounding_box = Polygon.from_bbox((x04326, y04326, x14326, y14326))
@@ -137,49 +204,22 @@ class ShapefileDriver(Driver):
         return [f.items() for f in lyr]
 
     def attrquery(self, key, value):
-        key, op = key.split('__')
-        op = {
-            'gt' : ">",
-            'gte' : ">=",
-            'lt' : "<",
-            'lte' : '<=',
-            'startswith' : 'LIKE',
-            'endswith' : 'LIKE',
-            'istartswith' : 'ILIKE',
-            'iendswith' : 'ILIKE',
-            'icontains' : "ILIKE",
-            'contains' : "LIKE",
-            'in' : 'IN',
-            'ne' : "<>"
-        }[op]
-
-        value = {
-            'gt': identity,
-            'gte': identity,
-            'lt': identity,
-            'lte': identity,
-            'startswith': lambda x : '%' + x,
-            'endswith': lambda x : x + '%',
-            'istartswith': lambda x : '%' + x,
-            'iendswith': lambda x : x + '%',
-            'icontains': lambda x : '%' + x + '%',
-            'contains': lambda x: '%' + x + '%',
-            'in': lambda x: x if isinstance(x, basestring) else '(' + ','.join(identity(a) for a in x) + ')',
-            'ne': identity
-        }[op](value)
-
-        return ' '.join([key, op, value])
+        """An OGR attribute filter for one django style filter, column__op = value.  OGR can't bind parameters, so
+        the value is rendered as a quoted literal."""
+        return attribute_filter(key, value, placeholder=literal, ilike='LIKE')[0]
 
     def as_dataframe(self, **kwargs):
         """
         Creates a dataframe object for a shapefile's main layer using layer_as_dataframe. This object is cached on disk for
         layer use, but the cached copy will only be picked up if the shapefile's mtime is older than the dataframe's mtime.
 
-        :param shp: The shapefile
+        :param lazy_geometry: leave the geometry column as raw WKB.  see ga_resources.drivers.decode_geometry
+        :param columns: only read these columns, whether from the shapefile or the cached dataframe
         :return:
         """
 
-        dfx_path = self.get_filename('dfx')
+        lazy_geometry = kwargs.pop('lazy_geometry', False)
+        columns = kwargs.pop('columns', None)
         shp_path = self.get_filename('shp')
 
         if len(kwargs) != 0:
@@ -191,22 +231,14 @@ class ShapefileDriver(Driver):
                 minx,miny,maxx,maxy = kwargs['bbox']
 
                 if 'srs' in kwargs:
-                    if isinstance(kwargs['srs'], basestring):
-                        s_srs = osr.SpatialReference()
-                        if kwargs['srs'].lower().startswith('epsg:'):
-                            s_srs.ImportFromEPSG(int(kwargs['srs'].split(':')[1]))
-                        else:
-                            s_srs.ImportFromProj4(kwargs['srs'])
-                    else:
-                        s_srs = kwargs['srs']
-
+                    s_srs = spatial_reference(kwargs['srs'])
                     t_srs = self.resource.srs
 
-                    if s_srs.ExportToProj4() != t_srs.ExportToProj4():
-                        crx = osr.CoordinateTransformation(s_srs, t_srs)
+                    if proj4(s_srs) != proj4(t_srs):
+                        crx = transformation(s_srs, t_srs)
                         minx, miny, _ = crx.TransformPoint(minx, miny)
                         maxx, maxy, _ = crx.TransformPoint(maxx, maxy)
-                        xrc = osr.CoordinateTransformation(t_srs, s_srs)
+                        xrc = transformation(t_srs, s_srs)
 
                 lyr.SetSpatialFilterRect(minx, miny, maxx, maxy)
             elif 'boundary' in kwargs:
@@ -215,59 +247,24 @@ class ShapefileDriver(Driver):
 
 
             if 'query' in kwargs:
-                if isinstance(kwargs['query'], basestring):
-                    query = json.loads(kwargs['query'])
-                else:
-                    query = kwargs['query']
-
-                for key, value in query.items():
-                    attrq= self.attrquery(key, value) if '__' in key else key, '='
-                    lyr.SetAttributeFilter(attrq)
+                set_attribute_filter(lyr, kwargs['query'])
 
             start = kwargs['start'] if 'start' in kwargs else 0
-            count = kwargs['count'] if 'count' in kwargs else len(lyr) - start
-
-            records = []
-            for i in range(start):
-                lyr.next()
+            count = kwargs['count'] if 'count' in kwargs else None
 
-            for i in range(count):
-                f = lyr.next()
-                if f.geometry():
-                    records.append(dict(fid=i, geometry=wkb.loads(transform(f.geometry(), xrc).ExportToWkb()), **f.items()))
-
-            df = DataFrame.from_records(
-                data=records,
-                index='fid'
-            )
+            df = layer_as_dataframe(lyr, start=start, count=count, crx=xrc, lazy_geometry=lazy_geometry, columns=columns)
 
             if 'sort_by' in kwargs:
                 df = df.sort_index(by=kwargs['sort_by'])
 
             return df
 
-        elif hasattr(self, '_df'):
-            return self._df
-
-        elif os.path.exists(dfx_path) and os.stat(dfx_path).st_mtime >= os.stat(shp_path).st_mtime:
-            if self.resource.big:
-                self._df = pandas.read_hdf(dfx_path, 'df')
-            else:
-                self._df = pandas.read_pickle(dfx_path)
-            return self._df
         else:
-            ds = ogr.Open(shp_path)
-            lyr = ds.GetLayerByIndex(0)
-            df= DataFrame.from_records(
-                data=[dict(fid=f.GetFID(), geometry=wkb.loads(f.geometry().ExportToWkb()), **f.items()) for f in lyr if f.geometry()],
-                index='fid'
-            )
-            if self.resource.big:
-                df.to_hdf(dfx_path, 'df')
-            else:
-                df.to_pickle(dfx_path)
-            self._df = df
-            return self._df
+            def load():
+                ds = ogr.Open(shp_path)
+                return layer_as_dataframe(ds.GetLayerByIndex(0), lazy_geometry=True)
+
+            return self.cached_dataframe(load, source=shp_path, columns=columns, lazy_geometry=lazy_geometry)
 
     @classmethod
     def from_dataframe(cls, df, shp, srs):
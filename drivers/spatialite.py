@@ -3,20 +3,27 @@ from tarfile import TarFile
 from uuid import uuid4
 from zipfile import ZipFile
 import json
+import math
+import random
+import threading
 
+from django.conf import settings
 from django.contrib.gis.geos import Polygon, GEOSGeometry
 from django.core.files import File
 import numpy
 import os
-from osgeo import osr
-from . import Driver
-from pandas import DataFrame
+from . import Driver, dataframe_from_cursor, features_from_cursor, round_coordinates, zoom_tolerance, DATAFRAME_BATCH_SIZE, SUMMARY_SAMPLE_ROWS, \
+    GENERALIZED_ZOOMS
+from .sql import attribute_filter, quote_identifier
+from ga_resources.spatialrefs import proj4, spatial_reference, transformation
+from ga_resources import sketches
 import sh
 from shapely import geometry, wkb
 import pandas
 from pysqlite2 import dbapi2 as db
 import geojson
 import shapely
+import shapely.wkt
 
 
 def identity(x):
@@ -29,6 +36,33 @@ def transform(geom, crx):
     return geom
 
 
+def is_point_type(geometry_type):
+    """Whether a geometry_columns geometry type, a code in spatialite 4 or a name in earlier versions, is (multi)point"""
+    if isinstance(geometry_type, basestring):
+        return geometry_type.upper().endswith('POINT')
+    return geometry_type is not None and geometry_type % 1000 in (1, 4)
+
+
+def find_generalized_tables(connection, table):
+    """
+    The (zoom, table name) pairs of the generalized copies of a table's geometry, from the coarsest to the finest.
+    Copies are recorded in ga_generalized_tables as they are made, so tables that merely look like copies are never
+    taken for them.
+    """
+    if not connection.execute("select 1 from sqlite_master where type = 'table' and name = 'ga_generalized_tables'").fetchone():
+        return []
+    return sorted((zoom, name) for zoom, name in connection.execute(
+        'select zoom, name from ga_generalized_tables where lower(source) = ?', [table.lower()]).fetchall())
+
+
+STATEMENT_CACHE_SIZE = getattr(settings, 'GA_RESOURCES_SPATIALITE_STATEMENT_CACHE_SIZE', 200)  # compiled statements kept per connection
+SAMPLE_BLOCKS = getattr(settings, 'GA_RESOURCES_SPATIALITE_SAMPLE_BLOCKS', 64)  # most ROWID ranges in a sampling where clause
+
+# database filename -> ((inode, mtime), {metadata key: value}).  shared by all driver instances in the process
+_table_metadata = {}
+_table_metadata_lock = threading.Lock()
+
+
 class SpatialiteDriver(Driver):
     """
     Config Parameters:
@@ -37,7 +71,14 @@ class SpatialiteDriver(Driver):
         * tables : dict of layer names -> tables, must all be in the same coordinate system for now.  Can also be select queries. paired with the geometry field name.
         * estimate_extent : see mapnik documentation
         * srid : the native srid of the tables
+        * use_spatial_index : boolean (default true). prefilter spatial queries against the SpatialIndex R*Tree
+        * generalize : boolean (default true). at ingest, copy the geometry into a table {table}_z{zoom} simplified for
+          each of GA_RESOURCES_GENERALIZED_ZOOMS.  Maps and queries at a zoom level read the coarsest copy that is fine
+          enough instead of the full detail geometry.  Triggers keep the copies current through edits.
     """
+
+    _key_field = 'OGC_FID'  # the integer key of the rows in the REST data API
+
     def __init__(self, data_resource):
         super(SpatialiteDriver, self).__init__(data_resource)
         self._conn = None # lazily open the connection
@@ -57,39 +98,37 @@ class SpatialiteDriver(Driver):
         }
 
         if 'table' not in cfg:
-            table, geometry_field, _, _, srid, _ = connection.execute("select * from geometry_columns").fetchone() # grab the first layer with a geometry
+            table, geometry_field, _, _, srid, _ = self._metadata('geometry_columns', lambda:
+                tuple(connection.execute("select * from geometry_columns").fetchone())) # grab the first layer with a geometry
             geometry_field = 'GEOMETRY' if geometry_field == 'geometry' else geometry_field
             self._tablename = table
             self._geometry_field = geometry_field
-            srs = osr.SpatialReference()
-            srs.ImportFromEPSG(srid)
+            srs = spatial_reference(srid)
             self._srid = srid # srs.ExportToProj4()
         elif 'sublayer' in kwargs:
             table, geometry_field = cfg['tables']['sublayer']
             table = table if not table.lower().startswith('select') else '(' + table + ')'
-            srid = connection.execute(
+            srid = self._metadata(('srid', table, geometry_field), lambda: connection.execute(
                 "select srid({geometry_field}) from {table} limit 1".format(
                     geometry_field=geometry_field,
                     table = table if not table.lower().startswith('select') else '(' + table + ')',
-                )).fetchone()[0] # grab the first layer with a geometry
+                )).fetchone()[0]) # grab the first layer with a geometry
 
             self._tablename = table
             self._geometry_field = geometry_field
-            srs = osr.SpatialReference()
-            srs.ImportFromEPSG(srid)
+            srs = spatial_reference(srid)
             self._srid = srid # srs.ExportToProj4()
         else:
             table, geometry_field = cfg['table']
             table = table if not table.lower().startswith('select') else '(' + table + ')'
-            srid = connection.execute(
+            srid = self._metadata(('srid', table, geometry_field), lambda: connection.execute(
                 "select srid({geometry_field}) from {table} limit 1".format(
                     geometry_field=geometry_field,
                     table=table if not table.lower().startswith('select') else '(' + table + ')',
-                )).fetchone()[0]
+                )).fetchone()[0])
             self._tablename = table
             self._geometry_field = geometry_field
-            srs = osr.SpatialReference()
-            srs.ImportFromEPSG(srid)
+            srs = spatial_reference(srid)
             self._srid = srid # srs.ExportToProj4()
 
         def addcfg(k):
@@ -104,18 +143,129 @@ class SpatialiteDriver(Driver):
         self._index_name = table if 'index' not in cfg else cfg['index']
         self._geometry_field = conn['geometry_field'] = geometry_field
 
+        generalized = self.generalized_table(kwargs['zoom']) if kwargs.get('zoom', None) is not None and 'sublayer' not in kwargs else None
+        if generalized:
+            # draw the generalized geometry with the full table's attributes.  mapnik searches the generalized table's
+            # spatial index and joins it back on OGC_FID, its rowid.
+            attributes = [k for k in self.schema() if k.lower() not in ('ogc_fid', geometry_field.lower())]
+            conn['table'] = '(select g.OGC_FID as OGC_FID, g.{geometry_field} as {geometry_field}{attributes} from {generalized} as g join {table} as w on w.OGC_FID = g.OGC_FID)'.format(
+                geometry_field=geometry_field,
+                attributes=''.join(', w.' + k for k in attributes),
+                generalized=generalized,
+                table=table
+            )
+            conn['geometry_table'] = generalized
+            conn['key_field'] = 'OGC_FID'
+
         return slug, srs, conn
 
+    def _connection_filename(self):
+        return self.get_filename('sqlite') if 'filename' not in self.resource.driver_config else self.resource.driver_config['filename']
+
+    def _metadata(self, key, compute):
+        """Look up a piece of table metadata (geometry columns, srids, column names) for this resource's database,
+        calling compute() only if it isn't cached.  Entries are kept per database file for as long as the file's inode
+        and modification time stay the same, so a write from any process or a re-ingest retires them."""
+        filename = self._connection_filename()
+        try:
+            st = os.stat(filename)
+            signature = (st.st_ino, st.st_mtime)
+        except OSError:
+            signature = None
+
+        with _table_metadata_lock:
+            cached = _table_metadata.get(filename)
+            if cached is None or cached[0] != signature:
+                cached = _table_metadata[filename] = (signature, {})
+            entries = cached[1]
+
+        if key not in entries:
+            entries[key] = compute()
+        return entries[key]
+
+    def _forget_metadata(self):
+        with _table_metadata_lock:
+            _table_metadata.pop(self._connection_filename(), None)
+
     def _connection(self):
         # create a database connection, or use the
         if self._conn is None:
-            conn = db.connect(self.get_filename('sqlite') if 'filename' not in self.resource.driver_config else self.resource.driver_config['filename'])
+            conn = db.connect(self._connection_filename(), cached_statements=STATEMENT_CACHE_SIZE)
             conn.enable_load_extension(True)
             conn.execute("select load_extension('libspatialite.so')")
             conn.execute("select load_extension('/usr/lib/sqlite3/pcre.so')")
             self._conn = conn
         return self._conn
 
+    def _generalized_tables(self):
+        table = self._tablename
+        return self._metadata(('generalized', table), lambda: find_generalized_tables(self._connection(), table))
+
+    def generalized_table(self, zoom):
+        """
+        The generalized copy of the geometry to use at a zoom level: the coarsest one simplified for that zoom or a
+        closer one.  None if there is no such copy, in which case the full detail geometry should be used.
+        """
+        if not hasattr(self, '_tablename'):
+            self.ready_data_resource()
+        for generalized_zoom, generalized in self._generalized_tables():
+            if generalized_zoom >= zoom:
+                return generalized
+        return None
+
+    def _drop_generalized_tables(self, connection, table, geometry_field):
+        c = connection.cursor()
+        for _, generalized in find_generalized_tables(connection, table):
+            for event in ('insert', 'update', 'delete'):
+                c.execute('drop trigger if exists {generalized}_{event}'.format(generalized=generalized, event=event))
+            c.execute('select DisableSpatialIndex(?, ?)', [generalized, geometry_field])
+            c.execute('select DiscardGeometryColumn(?, ?)', [generalized, geometry_field])
+            c.execute('drop table if exists idx_{generalized}_{geometry_field}'.format(generalized=generalized, geometry_field=geometry_field))
+            c.execute('drop table if exists {generalized}'.format(generalized=generalized))
+            c.execute('delete from ga_generalized_tables where name = ?', [generalized])
+        c.close()
+        connection.commit()
+
+    def _build_generalized_tables(self, connection, table, geometry_field, geometry_type, dimension, srid, crs,
+                                  zooms=GENERALIZED_ZOOMS):
+        """
+        Copy the geometry of table into {table}_z{zoom} for each zoom, simplified to the detail visible at that zoom
+        and spatially indexed.  Each copy is keyed on OGC_FID, kept current by triggers on table, and recorded in
+        ga_generalized_tables.  A copy whose name is taken by another table gets a numbered suffix.  Points have nothing
+        to simplify, so they get no copies.
+        """
+        self._drop_generalized_tables(connection, table, geometry_field)
+        if is_point_type(geometry_type) or not self.resource.driver_config.get('generalize', True):
+            return
+
+        c = connection.cursor()
+        c.execute('create table if not exists ga_generalized_tables (source TEXT, zoom INTEGER, name TEXT PRIMARY KEY)')
+        taken = set(row[0].lower() for row in c.execute("select name from sqlite_master where type = 'table'").fetchall())
+        for zoom in zooms:
+            generalized = '{table}_z{zoom}'.format(table=table, zoom=zoom)
+            suffix = 1
+            while generalized.lower() in taken:
+                generalized = '{table}_z{zoom}_{suffix}'.format(table=table, zoom=zoom, suffix=suffix)
+                suffix += 1
+            c.execute('insert into ga_generalized_tables (source, zoom, name) values (?, ?, ?)', [table, zoom, generalized])
+            tolerance = zoom_tolerance(zoom, crs)
+            simplified = 'SimplifyPreserveTopology({geometry}, {tolerance})'
+            old, new = simplified.format(geometry=geometry_field, tolerance=tolerance), simplified.format(geometry='NEW.' + geometry_field, tolerance=tolerance)
+
+            c.execute('create table {generalized} (OGC_FID INTEGER PRIMARY KEY)'.format(generalized=generalized))
+            c.execute("select AddGeometryColumn(?, ?, ?, 'GEOMETRY', ?)", [generalized, geometry_field, srid, dimension])
+            c.execute('insert into {generalized} (OGC_FID, {geometry_field}) select OGC_FID, {old} from {table}'.format(**locals()))
+            c.execute('select CreateSpatialIndex(?, ?)', [generalized, geometry_field])
+
+            c.execute('''create trigger {generalized}_insert after insert on {table} begin
+                insert or replace into {generalized} (OGC_FID, {geometry_field}) values (NEW.OGC_FID, {new}); end'''.format(**locals()))
+            c.execute('''create trigger {generalized}_update after update of {geometry_field} on {table} begin
+                update {generalized} set {geometry_field} = {new} where OGC_FID = NEW.OGC_FID; end'''.format(**locals()))
+            c.execute('''create trigger {generalized}_delete after delete on {table} begin
+                delete from {generalized} where OGC_FID = OLD.OGC_FID; end'''.format(**locals()))
+        c.close()
+        connection.commit()
+
     def compute_fields(self):
         """Other keyword args get passed in as a matter of course, like BBOX, time, and elevation, but this basic driver
         ignores them"""
@@ -146,8 +296,7 @@ class SpatialiteDriver(Driver):
 
             if not projection_found:
                 with open(self.cached_basename + '.prj', 'w') as f:
-                    srs = osr.SpatialReference()
-                    srs.ImportFromEPSG(4326)
+                    srs = spatial_reference(4326)
                     f.write(srs.ExportToWkt())
 
             in_filename = self.get_filename('shp')
@@ -184,8 +333,7 @@ class SpatialiteDriver(Driver):
 
             if not projection_found:
                 with open(self.cached_basename + '.prj', 'w') as f:
-                    srs = osr.SpatialReference()
-                    srs.ImportFromEPSG(4326)
+                    srs = spatial_reference(4326)
                     f.write(srs.ExportToWkt())
 
             in_filename = self.get_filename('shp')
@@ -225,12 +373,10 @@ class SpatialiteDriver(Driver):
             self.resource.resource_file = File(open(out_filename), name=self.resource.slug.split('/')[-1] + '.sqlite')
 
         connection = self._connection()
-        table, geometry_field, _, _, srid, _ = connection.execute("select * from geometry_columns").fetchone() # grab the first layer with a geometry
+        table, geometry_field, geometry_type, dimension, srid, _ = connection.execute("select * from geometry_columns").fetchone() # grab the first layer with a geometry
         self._srid = srid if srid else 3857
 
-        dataframe = self.get_filename('dfx')
-        if os.path.exists(dataframe):
-            os.unlink(dataframe)
+        self.clear_dataframe_cache()
 
         c = connection.cursor()
         c.execute("select AsText(Extent(w.{geom_field})) from {table} as w".format(
@@ -244,15 +390,13 @@ class SpatialiteDriver(Driver):
         except TypeError:
             xmin = ymin = xmax = ymax = 0.0
 
-        crs = osr.SpatialReference()
-        crs.ImportFromEPSG(srid)
+        crs = spatial_reference(srid)
         self.resource.native_srs = crs.ExportToProj4()
         c.execute("create index if not exists {table}_ogc_fid on {table} (OGC_FID)".format(table=table))
         c.close()
+        self._build_generalized_tables(connection, table, geometry_field, geometry_type, dimension, srid, crs)
 
-        e4326 = osr.SpatialReference()
-        e4326.ImportFromEPSG(4326)
-        crx = osr.CoordinateTransformation(crs, e4326)
+        crx = transformation(crs, 4326)
         x04326, y04326, _ = crx.TransformPoint(xmin, ymin)
         x14326, y14326, _ = crx.TransformPoint(xmax, ymax)
         self.resource.bounding_box = Polygon.from_bbox((x04326, y04326, x14326, y14326))
@@ -260,6 +404,8 @@ class SpatialiteDriver(Driver):
         self.resource.three_d = False
 
         self.resource.save()
+        self._forget_metadata()
+        self.data_changed()
 
     def _table(self, **kwargs):
         if not hasattr(self, '_geometry_field'):
@@ -273,49 +419,145 @@ class SpatialiteDriver(Driver):
 
         return table, geometry_field
 
+    def _uses_spatial_index(self, table):
+        """True if queries against this table should be prefiltered through the SpatialIndex virtual table. Select
+        queries configured as tables have no R*Tree of their own."""
+        return self.resource.driver_config.get('use_spatial_index', True) and not table.strip().startswith('(')
+
+    def _spatial_index_clause(self, table, index, search_frame):
+        """A where clause restricting the table to rows whose MBR intersects the MBR of search_frame"""
+        return "{table}.ROWID IN (SELECT ROWID FROM SpatialIndex WHERE f_table_name = '{index}' AND search_frame = {search_frame})".format(
+            table=table,
+            index=index,
+            search_frame=search_frame
+        )
+
+    def _estimated_rows(self, table):
+        if table.strip().startswith('('):
+            return self._connection().execute('select count(*) from {table}'.format(table=table)).fetchone()[0]
+        lo, hi = self._connection().execute(  # each subquery is a single b-tree lookup
+            'select (select min(ROWID) from {table}), (select max(ROWID) from {table})'.format(table=table)).fetchone()
+        return 0 if lo is None else hi - lo + 1
+
+    def _sample_ranges(self, table, fraction, block_size=256, most=None):
+        """
+        Random blocks of block_size consecutive ROWIDs of table, covering about fraction of its rows, as a sorted list
+        of inclusive (first, last) ROWID ranges.  Blocks grow past block_size as needed to keep to at most ranges, and
+        neighbouring blocks are merged into one range.
+        """
+        lo, hi = self._connection().execute(
+            'select (select min(ROWID) from {table}), (select max(ROWID) from {table})'.format(table=table)).fetchone()
+        if lo is None:
+            return []
+        sampled_rows = (hi - lo + 1) * fraction
+        if most:
+            count = int(min(most, max(1, round(sampled_rows / block_size))))
+            block_size = max(block_size, int(math.ceil(sampled_rows / count)))
+        blocks = (hi - lo) // block_size + 1
+        count = int(min(blocks, max(1, round(sampled_rows / block_size))))
+        chosen = sorted(random.sample(xrange(blocks), count))
+
+        ranges = []
+        for b in chosen:
+            if ranges and ranges[-1][1] == b:
+                ranges[-1][1] = b + 1
+            else:
+                ranges.append([b, b + 1])
+        return [(lo + first * block_size, lo + last * block_size - 1) for first, last in ranges]
+
+    def _sample_clause(self, table, fraction, alias='w', block_size=256):
+        """
+        A where clause selecting about fraction of the rows of table.  For real tables it picks at most SAMPLE_BLOCKS
+        random ranges of ROWIDs, so sqlite seeks straight to the sampled rows instead of scanning the table.  Select
+        queries configured as tables have no ROWID, and are sampled row by row.
+        """
+        if table.strip().startswith('('):
+            return '(abs(random()) % 1000000) < {n}'.format(n=int(fraction * 1000000))
+
+        ranges = self._sample_ranges(table, fraction, block_size, most=SAMPLE_BLOCKS)
+        if not ranges:
+            return '0'
+        return '(' + ' OR '.join('{alias}.ROWID BETWEEN {first} AND {last}'.format(
+            alias=alias, first=first, last=last) for first, last in ranges) + ')'
+
+    def attribute_batches(self, sample=None, batch_size=None):
+        table, geometry_column = self._table()
+        if table.strip().lower().startswith('select'):
+            table = '(' + table + ')'
+        columns = [k for k in self.schema() if k.lower() != geometry_column.lower()]
+
+        if sample is None:
+            rows = self._estimated_rows(table)
+            sample = min(1.0, SUMMARY_SAMPLE_ROWS / float(rows)) if rows else 1.0
+
+        select = 'select {columns} from {table} as w'.format(columns=','.join('w.' + k for k in columns), table=table)
+        connection = self._connection()
+
+        if sample < 1.0 and not table.startswith('('):
+            # many small blocks, read one at a time, so the summary's errors can be estimated between blocks
+            ranges = self._sample_ranges(table, sample)
+
+            def blocks():
+                for first, last in ranges:
+                    yield sketches.Block(connection.execute(select + ' where w.ROWID BETWEEN ? AND ?', [first, last]))
+
+            return columns, sample, blocks()
+
+        cursor = connection.cursor()
+        cursor.execute(select + (' where ' + self._sample_clause(table, sample) if sample < 1.0 else ''))
+
+        def batches():
+            while True:
+                rows = cursor.fetchmany(batch_size or DATAFRAME_BATCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+            cursor.close()
+
+        return columns, sample, batches()
+
+    def select_column(self, column):
+        table, _ = self._table()
+        if table.strip().lower().startswith('select'):
+            table = '(' + table + ')'
+        if column not in self.schema():
+            raise ValueError('unknown column {column}'.format(column=column))
+
+        cursor = self._connection().cursor()
+        cursor.execute('select "{column}" from {table}'.format(column=column, table=table))
+        values = []
+        while True:
+            rows = cursor.fetchmany(DATAFRAME_BATCH_SIZE)
+            if not rows:
+                break
+            values.extend(row[0] for row in rows)
+        cursor.close()
+        return pandas.Series(values).values
+
     def get_data_for_point(self, wherex, wherey, srs, fuzziness=0, **kwargs):
         result, x1, y1, epsilon = super(SpatialiteDriver, self).get_data_for_point(wherex, wherey, srs, fuzziness, **kwargs)
-        cfg = self.resource.driver_config
         table, geometry_field = self._table(**kwargs)
 
-        if epsilon == 0:
-            geometry = "GeomFromText('POINT({x} {y})', {srid})".format(
-                x=x1,
-                y=y1,
-                srid=self._srid
-            )
-        else:
-            geometry = "ST_Buffer(GeomFromText('POINT({x} {y})', {srid}), {epsilon})".format(
-                x=x1,
-                y=y1,
-                srid=self._srid,
-                epsilon=epsilon
-            )
+        geometry = 'MakePoint(?, ?, {srid})'.format(srid=int(self._srid))
+        point = [float(x1), float(y1)]
+        if epsilon != 0:
+            geometry = 'ST_Buffer({geometry}, ?)'.format(geometry=geometry)
+            point.append(float(epsilon))
 
         cursor = self._cursor(**kwargs)
         if table.strip().lower().startswith('select'):
             table = '(' + table + ")"
 
         cursor.execute("""
-        SELECT * FROM {table} as w WHERE ST_Intersects({geometry}, w.{geometry_field}) = 1 
-	    AND w.OGC_FID in (
-             SELECT ROWID FROM SpatialIndex WHERE f_table_name = '{index}' and search_frame = {geometry})
-        """.format(
-            geometry=geometry,
-            table=table,
-            index=table if 'index' not in self.resource.driver_config else self.resource.driver_config['index'],
-            geometry_field=geometry_field
-        ))
-        print """
         SELECT * FROM {table} as w WHERE ST_Intersects({geometry}, w.{geometry_field}) = 1
-	    AND w.OGC_FID in (
+        AND w.OGC_FID in (
              SELECT ROWID FROM SpatialIndex WHERE f_table_name = '{index}' and search_frame = {geometry})
         """.format(
             geometry=geometry,
             table=table,
             index=table if 'index' not in self.resource.driver_config else self.resource.driver_config['index'],
             geometry_field=geometry_field
-        )
+        ), point + point)
 
         rows = [list(r) for r in cursor.fetchall()]
         if len(rows):
@@ -329,42 +571,47 @@ class SpatialiteDriver(Driver):
 
         return [dict(zip(keys, r)) for r in rows]
 
+    def get_data_for_points(self, points, srs, fuzziness=0, **kwargs):
+        """Look up all the points with one join against the spatial index.  The points are loaded into a temporary
+        table and each one probes the R*Tree for the features near it."""
+        result, x1, y1, epsilon = self.native_points(points, srs, fuzziness, **kwargs)
+        table, geometry_field = self._table(**kwargs)
+        if table.strip().lower().startswith('select'):
+            table = '(' + table + ")"
+        index = table if 'index' not in self.resource.driver_config else self.resource.driver_config['index']
+
+        point = 'MakePoint(p.x, p.y, {srid})'.format(srid=self._srid)
+        where_clauses = ['ST_Intersects(CASE WHEN p.r > 0 THEN ST_Buffer({point}, p.r) ELSE {point} END, w.{geometry_field}) = 1'.format(
+            point=point,
+            geometry_field=geometry_field
+        )]
+        if self._uses_spatial_index(table):
+            where_clauses.append(self._spatial_index_clause('w', index, 'BuildMbr(p.x - p.r, p.y - p.r, p.x + p.r, p.y + p.r)'))
+
+        cursor = self._connection().cursor()
+        cursor.execute('drop table if exists temp.points_query')
+        cursor.execute('create temp table points_query (id INTEGER PRIMARY KEY, x REAL, y REAL, r REAL)')
+        cursor.executemany('insert into temp.points_query (id, x, y, r) values (?, ?, ?, ?)',
+                           [(i, float(x), float(y), float(r)) for i, (x, y, r) in enumerate(zip(x1, y1, epsilon))])
+        cursor.execute('select p.id, w.* from temp.points_query as p, {table} as w where {where_clauses} order by p.id'.format(
+            table=table,
+            where_clauses=' and '.join(where_clauses)
+        ))
+
+        keys = [c[0] for c in cursor.description][1:]
+        results = [[] for _ in range(len(x1))]
+        for row in cursor.fetchall():
+            results[row[0]].append(dict((k, v) for k, v in zip(keys, row[1:]) if k != geometry_field))
+        cursor.execute('drop table if exists temp.points_query')
+        cursor.close()
+        return results
+
     def attrquery(self, key, value):
-        if '__' not in key:
-            return key + '=' + value
-
-        key, op = key.split('__')
-        op = {
-            'gt': ">",
-            'gte': ">=",
-            'lt': "<",
-            'lte': '<=',
-            'startswith': 'LIKE',
-            'endswith': 'LIKE',
-            'istartswith': 'ILIKE',
-            'iendswith': 'ILIKE',
-            'icontains': "ILIKE",
-            'contains': "LIKE",
-            'in': 'IN',
-            'ne': "<>"
-        }[op]
-
-        value = {
-            'gt': identity,
-            'gte': identity,
-            'lt': identity,
-            'lte': identity,
-            'startswith': lambda x: '%' + x,
-            'endswith': lambda x: x + '%',
-            'istartswith': lambda x: '%' + x,
-            'iendswith': lambda x: x + '%',
-            'icontains': lambda x: '%' + x + '%',
-            'contains': lambda x: '%' + x + '%',
-            'in': lambda x: x if isinstance(x, basestring) else '(' + ','.join(identity(a) for a in x) + ')',
-            'ne': identity
-        }[op](value)
-
-        return ' '.join([key, op, value])
+        """
+        A where clause for one django style filter, column__op = value, as sql and a list of query parameters.  sqlite's
+        LIKE is case insensitive already.
+        """
+        return attribute_filter(key, value, placeholder='?', ilike='LIKE')
 
     def _cursor(self, **kwargs):
         self.ready_data_resource()
@@ -378,155 +625,117 @@ class SpatialiteDriver(Driver):
         return cursor
 
 
-    def as_dataframe(self, **kwargs):
-        """
-        Creates a dataframe object for a shapefile's main layer using layer_as_dataframe. This object is cached on disk for
-        layer use, but the cached copy will only be picked up if the shapefile's mtime is older than the dataframe's mtime.
-
-        :param shp: The shapefile
-        :return:
-        """
-
-        dfx_path = self.get_filename('dfx')
-        if os.path.exists(dfx_path):
-            try:
-                self._df = pandas.read_pickle(dfx_path)
-            except:
-                os.unlink(self.get_filename('dfx'))
-
-        if len(kwargs) != 0:
-            cfg = self.resource.driver_config
-            lyr = {}
-            crx = xrc = None
-
-            if 'bbox' in kwargs:
-                minx, miny, maxx, maxy = kwargs['bbox']
-
-                if 'srs' in kwargs:
-                    if isinstance(kwargs['srs'], basestring):
-                        s_srs = osr.SpatialReference()
-                        if kwargs['srs'].lower().startswith('epsg:'):
-                            s_srs.ImportFromEPSG(int(kwargs['srs'].split(':')[1]))
-                        else:
-                            s_srs.ImportFromProj4(kwargs['srs'])
-                    else:
-                        s_srs = kwargs['srs']
-
-                    t_srs = self.resource.srs
-
-                    if s_srs.ExportToProj4() != t_srs.ExportToProj4():
-                        crx = osr.CoordinateTransformation(s_srs, t_srs)
-                        minx, miny, _ = crx.TransformPoint(minx, miny)
-                        maxx, maxy, _ = crx.TransformPoint(maxx, maxy)
-                        xrc = osr.CoordinateTransformation(t_srs, s_srs)
-
-                lyr['bbox'] = (minx, miny, maxx, maxy)
-            elif 'boundary' in kwargs:
-                lyr['boundary'] = kwargs['boundary']
-
-            if 'query' in kwargs:
-                lyr['query'] = []
-
-                if isinstance(kwargs['query'], basestring):
-                    query = json.loads(kwargs['query'])
-                else:
-                    query = kwargs['query']
-
-                lyr['query'] = ' AND '.join(self.attrquery(key, value) for key, value in query.items())
+    def _filtered_cursor(self, **kwargs):
+        """A cursor over the rows selected by the as_dataframe filters, as "SELECT AsBinary(geometry), * ...", the name
+        of the geometry column, and the number of leading rows to skip"""
+        lyr = {}
 
-            start = kwargs['start'] if 'start' in kwargs else 0
-            count = start + kwargs['count'] if 'count' in kwargs else -1
+        if 'bbox' in kwargs:
+            minx, miny, maxx, maxy = kwargs['bbox']
 
+            if 'srs' in kwargs:
+                s_srs = spatial_reference(kwargs['srs'])
+                t_srs = self.resource.srs
 
-            # contsruct query
+                if proj4(s_srs) != proj4(t_srs):
+                    crx = transformation(s_srs, t_srs)
+                    minx, miny, _ = crx.TransformPoint(minx, miny)
+                    maxx, maxy, _ = crx.TransformPoint(maxx, maxy)
 
-            cursor = self.connection # _cursor(**kwargs)
+            lyr['bbox'] = (minx, miny, maxx, maxy)
+        elif 'boundary' in kwargs:
+            lyr['boundary'] = kwargs['boundary']
 
-            q = "SELECT AsBinary({geometry_column}), * FROM {table} AS w WHERE "
-            addand = False
-            if 'bbox' in lyr:
-                q += "MBRIntersects(GeomFromText('BBOX({xmin} {ymin} {xax} {ymax})'), w.{geometry_column})"
-                q += """ AND w.ROWID in (
-                  SELECT ROWID FROM SpatialIndex WHERE f_table_name = '{index}' and search_frame = GeomFromText('BBOX({xmin} {ymin} {xax} {ymax})'))
-                """
-                addand = True
+        if 'query' in kwargs:
+            if isinstance(kwargs['query'], basestring):
+                query = json.loads(kwargs['query'])
+            else:
+                query = kwargs['query']
 
-            if 'boundary' in lyr:
-                q += "ST_Intersects(GeomFromText('{boundary}', w.{geometry_column}))"
-                q += """ AND w.ROWID in (
-                  SELECT ROWID FROM SpatialIndex WHERE f_table_name = '{index}' and search_frame = GeomFromText('BBOX({xmin} {ymin} {xax} {ymax})'))
-                """
-                addand = True
+            lyr['query'] = [self.attrquery(key, value) for key, value in sorted(query.items())]
 
-            if 'query' in lyr:
-                if addand:
-                    q += ' AND '
-                q += lyr['query']
+        start = kwargs['start'] if 'start' in kwargs else 0
+        count = start + kwargs['count'] if 'count' in kwargs else -1
 
-            if count > 0:
-                q += ' LIMIT {count}'.format(count=count)
+        # construct the query
+        table, geometry_column = self._table(**kwargs)
+        if table.strip().lower().startswith('select'):
+            table = '(' + table + ")"
 
-            table, geometry_column = self._table(**kwargs)
-            if table.strip().lower().startswith('select'):
-                table = '(' + table + ")"
+        q = "SELECT AsBinary(w.{geometry_column}), * FROM {table} AS w"
+        where = []
+        params = []
+        if 'bbox' in lyr:
+            where.append("MBRIntersects(BuildMbr(?, ?, ?, ?), w.{geometry_column})")
+            params.extend(float(b) for b in lyr['bbox'])
+            if self._uses_spatial_index(table):
+                where.append(self._spatial_index_clause('w', self._index_name, 'BuildMbr(?, ?, ?, ?)'))
+                params.extend(float(b) for b in lyr['bbox'])
+
+        if 'boundary' in lyr:
+            where.append("ST_Intersects(GeomFromText(?), w.{geometry_column})")
+            params.append(getattr(lyr['boundary'], 'wkt', lyr['boundary']))
+
+        for clause, values in lyr.get('query', []):
+            where.append(clause.replace('{', '{{').replace('}', '}}'))
+            params.extend(values)
+
+        if 'sample' in kwargs:
+            where.append(self._sample_clause(table, float(kwargs['sample'])))
+
+        if where:
+            q += ' WHERE ' + ' AND '.join(where)
+
+        if 'sort_by' in kwargs:
+            sort_by = kwargs['sort_by']
+            if isinstance(sort_by, basestring):
+                sort_by = sort_by.split(',')
+            q += ' ORDER BY ' + ','.join(quote_identifier(column.strip()) for column in sort_by)
+
+        if count > 0:
+            q += ' LIMIT ?'
+            params.append(count)
+
+        cursor = self._connection().cursor()
+        cursor.execute(q.format(
+            geometry_column=geometry_column,
+            table=table
+        ), params)
+        return cursor, geometry_column, start
 
-            cursor.execute(q.format(
-                boundary=cfg.get('boundary', None),
-                geometry_column=geometry_column,
-                table=table,
-                index = table if 'index' not in self.resource.driver_config else self.resource.driver_config['index']
-                **lyr.get('bbox', [None, None, None, None])
-            ))
-            for i in range(start):
-                cursor.fetchone()
-
-            names = [c[0] for c in cursor.description]
-            throwaway_ix = names[1:].index(geometry_column) + 1
-            records = []
-            for record in cursor:
-                records.append({name: value for i, (name, value) in enumerate(zip(names, record)) if i != throwaway_ix})
-                records[-1]['geometry'] = wkb.loads(record['asbinary'])
-
-            df = DataFrame.from_records(
-                data=records,
-                index='fid'
-            )
+    def feature_rows(self, **kwargs):
+        """Stream the rows selected by the as_dataframe filters straight from the cursor, without building a dataframe"""
+        cursor, geometry_column, start = self._filtered_cursor(**kwargs)
+        return features_from_cursor(cursor, geometry_column, start=start)
 
-            if 'sort_by' in kwargs:
-                df = df.sort_index(by=kwargs['sort_by'])
+    def as_dataframe(self, **kwargs):
+        """
+        Creates a dataframe object for a shapefile's main layer using layer_as_dataframe. This object is cached on disk for
+        layer use, but the cached copy will only be picked up if the shapefile's mtime is older than the dataframe's mtime.
 
-            return df
+        :param lazy_geometry: leave the geometry column as raw WKB.  see ga_resources.drivers.decode_geometry
+        :param columns: only read these columns of the cached dataframe
+        :param sample: read only about this fraction of the rows, in random blocks.  for previews of big datasets
+        :return:
+        """
 
-        elif hasattr(self, '_df'):
-            return self._df
+        lazy_geometry = kwargs.pop('lazy_geometry', False)
+        columns = kwargs.pop('columns', None)
 
+        if len(kwargs) != 0:
+            cursor, geometry_column, start = self._filtered_cursor(**kwargs)
+            return dataframe_from_cursor(cursor, geometry_column, start=start, lazy_geometry=lazy_geometry)
 
         else:
-            table, geometry_column = self._table(**kwargs)
-
-            query = "SELECT AsBinary({geometry_column}), * FROM {table}".format(table=table if not table.lower().startswith('select') else '(' + table + ')',
-                                                                                geometry_column=geometry_column)
-            cursor = self._cursor(**kwargs)
-            cursor.execute("select load_extension('libspatialite.so')")
-
+            def load():
+                table, geometry_column = self._table()
+                query = "SELECT AsBinary({geometry_column}), * FROM {table}".format(table=table if not table.lower().startswith('select') else '(' + table + ')',
+                                                                                    geometry_column=geometry_column)
+                cursor = self._cursor()
+                cursor.execute(query)
+                return dataframe_from_cursor(cursor, geometry_column, lazy_geometry=True)
 
-            cursor.execute(query)
-            names = [c[0] for c in cursor.description]
-
-            throwaway_ix = names[1:].index(geometry_column) + 1
-            records = []
-            for record in cursor:
-                records.append({name: value for i, (name, value) in enumerate(zip(names, record)) if i != throwaway_ix})
-                try:
-                    records[-1]['geometry'] = wkb.loads(str(records[-1]['AsBinary(GEOMETRY)']))
-                except:
-                    pass
-                del records[-1]['AsBinary(GEOMETRY)']
-
-            df = DataFrame.from_records(data=records)
-            df.to_pickle(dfx_path)
-            self._df = df
-            return self._df
+            return self.cached_dataframe(load, columns=columns, lazy_geometry=lazy_geometry)
 
     def add_column(self, name, field_type):
         c = self._cursor()
@@ -537,15 +746,43 @@ class SpatialiteDriver(Driver):
         ))
         c.close()
         self._conn.commit()
+        self._forget_metadata()
+        self.data_changed()
+
+    def _old_rows(self, keys, columns=None):
+        """The current values of rows that are about to be updated or deleted, for folding into the cached summary.
+        Empty if there is no cached summary to fold them into."""
+        if not self.has_cached_summary():
+            return []
+
+        keys = [int(k) for k in keys]
+        columns = [k for k in (columns or self.schema()) if k not in (self._geometry_field, 'OGC_FID')]
+        c = self._cursor()
+        rows = []
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            c.execute('select {columns} from {table} where OGC_FID in ({keys})'.format(
+                columns=','.join(['OGC_FID'] + columns),
+                table=self._tablename,
+                keys=','.join('?' for _ in chunk)
+            ), chunk)
+            rows.extend(dict(zip(['OGC_FID'] + columns, row)) for row in c.fetchall())
+        c.close()
+        return rows
+
+    def _new_row(self, values, ogc_fid):
+        """An inserted row as it is stored, with every column, for folding into the cached summary"""
+        row = dict((k, values.get(k, None)) for k in self.schema() if k != self._geometry_field)
+        row['OGC_FID'] = ogc_fid
+        return row
 
     def delete_row(self, key):
+        removed = self._old_rows([key])
         c = self._cursor()
-        c.execute('delete from {table} where ogc_fid={key}'.format(
-            table=self._tablename,
-            key=key
-        ))
+        c.execute('delete from {table} where OGC_FID=?'.format(table=self._tablename), [int(key)])
         c.close()
         self._conn.commit()
+        self.data_changed(removed=removed)
 
     def add_row(self, **values):
         c = self._cursor()
@@ -560,40 +797,164 @@ class SpatialiteDriver(Driver):
             values=parms
         )
         c.execute(insert_stmt, vals)
-        c.execute('SELECT max(OGC_FID) from {table}'.format(table=self._tablename))
-        new_id = c.fetchone()[0]
+        new_id = c.lastrowid
         c.close()
         self._conn.commit()
+        self.data_changed(added=[self._new_row(values, new_id)])
         return self.get_row(ogc_fid=new_id, geometry_format='wkt')
 
     def update_row(self, ogc_fid, **values):
         c = self._cursor()
-        insert_stmt = 'update {table} set {set_clause} where OGC_FID={ogc_fid}'
+        insert_stmt = 'update {table} set {set_clause} where OGC_FID=:OGC_FID'
         table = self._tablename
         if 'OGC_FID' in values:
             del values['OGC_FID']
+        changed = [k for k in values.keys() if k not in ('srid', self._geometry_field)]
+        removed = [dict((k, row[k]) for k in changed) for row in self._old_rows([ogc_fid], changed)]
 
         set_clause = ','.join(["{key}=:{key}".format(key=key) if key != self._geometry_field else '{key}=GeomFromText(:{key}, {srid})'.format(key=key, srid=self._srid if "srid" not in values else
-        values['srid']) for key in values.keys()])
+        values['srid']) for key in sorted(values.keys()) if key != 'srid'])
 
-        c.execute(insert_stmt.format(**locals()), values)
+        c.execute(insert_stmt.format(**locals()), dict(values, OGC_FID=int(ogc_fid)))
         c.close()
         self._conn.commit()
+        self.data_changed(added=[dict((k, values[k]) for k in changed)] if removed else [], removed=removed)
         return self.get_row(ogc_fid=ogc_fid, geometry_format='wkt')
 
+    def add_rows(self, rows, srid=None):
+        """
+        Insert many rows in a single transaction.
+
+        :param rows: a list of dicts of column name to value.  Geometries are WKT.
+        :param srid: the srid of the geometries, if not the native srid of the table.
+        :return: the new OGC_FIDs, in the same order as rows.
+        """
+        if not rows:
+            return []
+
+        c = self._cursor()
+        keys = sorted(set(k for row in rows for k in row.keys() if k not in {'srid', 'OGC_FID'}))
+        parms = ','.join(['?' if key != self._geometry_field else 'GeomFromText(?, {srid})'.format(srid=srid or self._srid) for key in keys])
+        insert_stmt = 'insert into {table} ({keys}) values ({values})'.format(
+            table=self._tablename,
+            keys=','.join(keys),
+            values=parms
+        )
+
+        try:
+            c.executemany(insert_stmt, [[row.get(key, None) for key in keys] for row in rows])
+            # sqlite allocates rowids sequentially from max(ROWID) and we hold the write lock until commit, so the new
+            # rows are the last len(rows) ids ending at the last inserted one.
+            last_id = c.execute('select last_insert_rowid()').fetchone()[0]
+            self._conn.commit()
+        except:
+            self._conn.rollback()
+            raise
+        finally:
+            c.close()
+
+        fids = range(last_id - len(rows) + 1, last_id + 1)
+        self.data_changed(added=[self._new_row(row, fid) for row, fid in zip(rows, fids)])
+        return fids
+
+    def update_rows(self, rows, srid=None):
+        """
+        Update many rows in a single transaction.  Rows are grouped by the set of columns they change so that each
+        group is written with one statement, compiled once and executed for each row.
+
+        :param rows: a list of dicts of column name to value.  Each one must contain OGC_FID.
+        :param srid: the srid of the geometries, if not the native srid of the table.
+        :return: the OGC_FIDs that were updated.  Rows that matched nothing or had nothing to change are left out.
+        """
+        groups = {}
+        for row in rows:
+            keys = tuple(sorted(k for k in row.keys() if k not in {'srid', 'OGC_FID'}))
+            if keys:
+                groups.setdefault(keys, []).append(row)
+
+        changed = dict((int(row['OGC_FID']), [k for k in row.keys() if k not in ('srid', 'OGC_FID', self._geometry_field)]) for row in rows)
+        old = self._old_rows(changed.keys(), sorted(set(k for keys in changed.values() for k in keys)))
+
+        updated = []
+        c = self._cursor()
+        try:
+            for keys, group in groups.items():
+                set_clause = ','.join(["{key}=?".format(key=key) if key != self._geometry_field else '{key}=GeomFromText(?, {srid})'.format(key=key, srid=srid or self._srid) for key in keys])
+                update_stmt = 'update {table} set {set_clause} where OGC_FID=?'.format(
+                    table=self._tablename,
+                    set_clause=set_clause
+                )
+                for row in group:  # one at a time, since executemany only reports the total rowcount
+                    c.execute(update_stmt, [row[key] for key in keys] + [int(row['OGC_FID'])])
+                    if c.rowcount > 0:
+                        updated.append(int(row['OGC_FID']))
+            self._conn.commit()
+        except:
+            self._conn.rollback()
+            raise
+        finally:
+            c.close()
+
+        updated_set = set(updated)
+        removed = [dict((k, row[k]) for k in changed[row['OGC_FID']]) for row in old if row['OGC_FID'] in updated_set]
+        added = [dict((k, row[k]) for k in changed[int(row['OGC_FID'])]) for row in rows if int(row['OGC_FID']) in updated_set] if old else []
+        if updated:
+            self.data_changed(added=added, removed=removed)
+        return updated
+
+    def delete_rows(self, keys):
+        """Delete many rows by OGC_FID in a single transaction"""
+        removed = self._old_rows(keys)
+        c = self._cursor()
+        try:
+            c.executemany('delete from {table} where OGC_FID=?'.format(table=self._tablename), [[int(key)] for key in keys])
+            self._conn.commit()
+        except:
+            self._conn.rollback()
+            raise
+        finally:
+            c.close()
+
+        self.data_changed(removed=removed)
+
+    def extent_of_rows(self, keys):
+        """
+        The union bounding box of a set of rows in native coordinates.
+
+        :param keys: OGC_FIDs
+        :return: an (xmin, ymin, xmax, ymax) tuple, or None if none of the rows has a geometry.
+        """
+        keys = [int(k) for k in keys]
+        c = self._cursor()
+        xmin = ymin = float('inf')
+        xmax = ymax = float('-inf')
+        for i in range(0, len(keys), 500):  # stay under sqlite's limit on bound parameters
+            chunk = keys[i:i+500]
+            c.execute('select MbrMinX(Extent({geometry})), MbrMinY(Extent({geometry})), MbrMaxX(Extent({geometry})), MbrMaxY(Extent({geometry})) from {table} where OGC_FID in ({keys})'.format(
+                geometry=self._geometry_field,
+                table=self._tablename,
+                keys=','.join('?' for _ in chunk)
+            ), chunk)
+            x0, y0, x1, y1 = c.fetchone()
+            if x0 is not None:
+                xmin, ymin, xmax, ymax = min(xmin, x0), min(ymin, y0), max(xmax, x1), max(ymax, y1)
+        c.close()
+
+        if xmin > xmax:
+            return None
+        return xmin, ymin, xmax, ymax
+
     def get_row(self, ogc_fid, geometry_format='geojson'):
         c = self._cursor()
         keys = self.schema()
         table = self._tablename
         geometry = self._geometry_field
 
-        select = 'select * from {table} where OGC_FID={ogc_fid}'.format(**locals())
-        select2 = 'select AsBinary({geometry}) from {table} where OGC_FID={ogc_fid}'.format(**locals())
+        select = 'select * from {table} where OGC_FID=?'.format(**locals())
+        select2 = 'select AsBinary({geometry}) from {table} where OGC_FID=?'.format(**locals())
 
-        c.execute("select load_extension('libspatialite.so')")
-        values = c.execute(select).fetchone()
-        record = dict(p for p in zip(keys, c.execute(select).fetchone()) if p[0] != geometry)
-        geo = c.execute(select2).fetchone()
+        record = dict(p for p in zip(keys, c.execute(select, [int(ogc_fid)]).fetchone()) if p[0] != geometry)
+        geo = c.execute(select2, [int(ogc_fid)]).fetchone()
         # gj = { 'type' : 'feature', 'geometry' : json.loads(geojson.dumps(wkb.loads(str(geo[0])))), 'properties' : record }
         gj = record
         if geometry_format.lower() == 'geojson':
@@ -610,25 +971,25 @@ class SpatialiteDriver(Driver):
         geometry = self._geometry_field
 
         if ogc_fid_end:
-            select = 'select * from {table} where OGC_FID >= {ogc_fid_start} and OGC_FID <= {ogc_fid_end};'.format(**locals())
-            select2 ='select AsBinary({geometry}) from {table} where OGC_FID >= {ogc_fid_start} and OGC_FID <= {ogc_fid_end}'.format(**locals())
+            select = 'select * from {table} where OGC_FID >= ? and OGC_FID <= ?'.format(**locals())
+            select2 ='select AsBinary({geometry}) from {table} where OGC_FID >= ? and OGC_FID <= ?'.format(**locals())
+            params = [int(ogc_fid_start), int(ogc_fid_end)]
         elif limit > -1:
-            select = 'select * from {table} where OGC_FID >= {ogc_fid_start} LIMIT {limit};'.format(
-                **locals())
-            select2 = 'select AsBinary({geometry}) from {table} where OGC_FID >= {ogc_fid_start} LIMIT {limit};'.format(
-                **locals())
+            select = 'select * from {table} where OGC_FID >= ? LIMIT ?'.format(**locals())
+            select2 = 'select AsBinary({geometry}) from {table} where OGC_FID >= ? LIMIT ?'.format(**locals())
+            params = [int(ogc_fid_start), int(limit)]
         else:
-            select = 'select * from {table} where OGC_FID >= {ogc_fid_start}'.format(**locals())
-            select2 = 'select AsBinary({geometry}) from {table} where OGC_FID >= {ogc_fid_start}'.format(**locals())
+            select = 'select * from {table} where OGC_FID >= ?'.format(**locals())
+            select2 = 'select AsBinary({geometry}) from {table} where OGC_FID >= ?'.format(**locals())
+            params = [int(ogc_fid_start)]
 
-        c.execute("select load_extension('libspatialite.so')")
-        c.execute(select)
+        c.execute(select, params)
 
         records = []
         for row in c.fetchall():
             records.append( dict(p for p in zip(keys, row) if p[0] != geometry) )
 
-        c.execute(select2)
+        c.execute(select2, params)
         if geometry_format.lower() == 'geojson':
             geo = [json.loads(geojson.dumps(wkb.loads(str(g[0])))) for g in c.fetchall()]
         elif geometry_format.lower() == 'wkt':
@@ -652,49 +1013,56 @@ class SpatialiteDriver(Driver):
             fields=','.join(fields)
         ))
 
-    def query(
+    query_operators = {
+        'eq': '=',
+        '=': '=',
+        'gt': '>',
+        'ge': '>=',
+        'lt': '<',
+        'le': '<=',
+        'contains': 'like',
+        'startswith': 'like',
+        'endswith': 'like',
+        'isnull': '',
+        'notnull': '',
+        'ne': '!=',
+        'regexp': 'regexp',
+        'glob': 'glob',
+        'match': 'match',
+        'between': 'between',
+        'like': 'like'
+    }
+    geom_operators = {
+        'equals','disjoint','touches','within','overlaps','crosses','intersects','contains',
+        'mbrequal','mbrdisjoint','mbrtouches','mbrwithin','mbroverlaps','mbrintersects','mbrcontains'
+    }
+
+    # operators for which a result must overlap the MBR of the query geometry.  disjoint and relate can match
+    # features anywhere in the table, so they can't be prefiltered against the spatial index.
+    indexable_operators = geom_operators - {'disjoint', 'mbrdisjoint'}
+
+    def _query_where(
             self,
             geometry_operator='intersects',
             query_geometry=None,
             query_mbr=None,
             query_geometry_srid=None,
-            only=None,
             start=None,
             end=None,
-            limit=None,
-            geometry_format='geojson',
-            order_by=None,
+            alias=None,
             **kwargs
     ):
-        operators = {
-            'eq': '=',
-            '=': '=',
-            'gt': '>',
-            'ge': '>=',
-            'lt': '<',
-            'le': '<=',
-            'contains': 'like',
-            'startswith': 'like',
-            'endswith': 'like',
-            'isnull': '',
-            'notnull': '',
-            'ne': '!=',
-            'regexp': 'regexp',
-            'glob': 'glob',
-            'match': 'match',
-            'between': 'between',
-            'like': 'like'
-        }
-        geom_operators = {
-            'equals','disjoint','touches','within','overlaps','crosses','intersects','contains',
-            'mbrequal','mbrdisjoint','mbrtouches','mbrwithin','mbroverlaps','mbrintersects','mbrcontains'
-        }
+        """
+        Parse the filter arguments to query() into SQL.
 
-        c = self._cursor()
-        keys = self.schema() if not only else only
+        :param alias: if the table is aliased in the statement, qualify column names with the alias
+        :return: a list of where clauses to be and-ed together and the list of values bound to their placeholders
+        """
+        operators = self.query_operators
         table = self._tablename
         index = self._index_name
-        geometry = self._geometry_field
+        column = lambda name: alias + '.' + name if alias else name
+        geometry_column = column(self._geometry_field)
         geometry_operator = geometry_operator.lower() if geometry_operator else None
 
         if query_geometry and not isinstance(query_geometry, basestring):
@@ -703,75 +1071,332 @@ class SpatialiteDriver(Driver):
             query_mbr = shapely.geometry.box(*query_mbr)
             query_geometry = query_mbr.wkt
 
-        limit_clause = 'LIMIT {limit}'.format(**locals()) if limit else ''
-        start_clause = 'OGC_FID >= {start}'.format(**locals()) if start else False
-        end_clause = 'OGC_FID >= {end}'.format(**locals()) if end else False
-        columns = ','.join(keys)
-        checks = [key.split('__') if '__' in key else [key, '='] for key in kwargs.keys()]
-        where_clauses = ['{variable} {op} ?'.format(variable=v, op=operators[o]) for v, o in checks]
-        where_values = ["%" + x + '%' if checks[i][1] == 'contains' else x for i, x in enumerate(kwargs.values())]
+        filters = sorted(kwargs.items())  # sorted, so the same filters always make the same statement
+        checks = [key.split('__') if '__' in key else [key, '='] for key, _ in filters]
+        where_clauses = ['{variable} {op} ?'.format(variable=column(v), op=operators[o]) for v, o in checks]
+        where_values = ["%" + x + '%' if checks[i][1] == 'contains' else x for i, (_, x) in enumerate(filters)]
         where_values = [x + '%' if checks[i][1] == 'startswith' else x for i, x in enumerate(where_values)]
         where_values = ['%' + x if checks[i][1] == 'endswith' else x for i, x in enumerate(where_values)]
 
-        if start_clause:
-            where_clauses.append(start_clause)
-        if end_clause:
-            where_clauses.append(end_clause)
+        if start:
+            where_clauses.append('{fid} >= ?'.format(fid=column('OGC_FID')))
+            where_values.append(int(start))
+        if end:
+            where_clauses.append('{fid} <= ?'.format(fid=column('OGC_FID')))
+            where_values.append(int(end))
 
         if query_geometry:
             qg = "GeomFromText(?, {srid})".format(srid=int(query_geometry_srid)) if query_geometry_srid else "GeomFromText(?)"
-            if geometry_operator not in geom_operators and \
+            if geometry_operator not in self.geom_operators and \
                     not geometry_operator.startswith('distance') and \
                     not geometry_operator.startswith('relate'):
                 raise NotImplementedError('unsupported query operator for geometry')
 
+            # the search frame is in native coordinates; its MBR is what gets matched against the R*Tree
+            if query_geometry_srid and self._srid and int(query_geometry_srid) != int(self._srid):
+                search_frame = "Transform({qg}, {native_srid})".format(qg=qg, native_srid=int(self._srid))
+            else:
+                search_frame = qg
+            search_frame_values = [query_geometry]
+
             if geometry_operator.startswith('relate'):
                 geometry_operator, matrix = geometry_operator.split(':')
-                geometry_where = "relate({geometry}, {qg}, '{matrix}')"
+                geometry_where = "relate({geometry_column}, {qg}, ?)".format(**locals())
+                geometry_values = [query_geometry, matrix]
+                search_frame = None
 
             elif geometry_operator.startswith('distance'):
                 geometry_operator, srid, comparator, val = geometry_operator.split(":")
                 op = operators[comparator]
                 val = float(val)
-                geometry_where = "distance(transform({geometry}, {srid}), {qg}) {op} {val}".format(**locals()) if len(srid)>0 else "distance({geometry}, {qg}) {op} {val}".format(
+                geometry_where = "distance(transform({geometry_column}, {srid}), {qg}) {op} ?".format(**locals()) if len(srid)>0 else "distance({geometry_column}, {qg}) {op} ?".format(
                     **locals())
+                geometry_values = [query_geometry, val]
+
+                # only "closer than" comparisons in native units bound the result to an area around the query geometry
+                if len(srid) == 0 and comparator in {'lt', 'le'}:
+                    search_frame = "ST_Buffer({search_frame}, ?)".format(**locals())
+                    search_frame_values = [query_geometry, val]
+                else:
+                    search_frame = None
             else:
-                geometry_where = """{geometry_operator}({geometry}, {qg})""".format(**locals())
+                geometry_where = """{geometry_operator}({geometry_column}, {qg})""".format(**locals())
+                geometry_values = [query_geometry]
+                if geometry_operator not in self.indexable_operators:
+                    search_frame = None
 
-            where_values.append(query_geometry)
+            where_values.extend(geometry_values)
             where_clauses.append(geometry_where)
 
+            if search_frame and self._uses_spatial_index(table):
+                where_values.extend(search_frame_values)
+                where_clauses.append(self._spatial_index_clause(alias or table, index, search_frame))
+
+        return where_clauses, where_values
+
+    def nearest(self, n, query_geometry, query_geometry_srid=None, **kwargs):
+        """
+        The n rows nearest to a geometry, among those matching the attribute filters of _query_where in kwargs.
+
+        The search grows a box around the query geometry, matched against the spatial index, until it holds n rows
+        within its radius.  Every row closer than the radius is in the box, so those n are the nearest.  The first
+        radius would hold about n rows if they were spread evenly over the extent, and it doubles from there, so the
+        cost follows n and the local density of rows rather than the size of the table.
+
+        :return: a list of (OGC_FID, distance) pairs, nearest first.  Distances are in native units.
+        """
+        self.ready_data_resource()
+        table, index, geometry_column = self._tablename, self._index_name, self._geometry_field
+        if not isinstance(query_geometry, basestring):
+            query_geometry = query_geometry.wkt
+
+        c = self._cursor()
+        qg = "GeomFromText(?, {srid})".format(srid=int(query_geometry_srid)) if query_geometry_srid else "GeomFromText(?)"
+        if query_geometry_srid and self._srid and int(query_geometry_srid) != int(self._srid):
+            qg = "Transform({qg}, {native_srid})".format(qg=qg, native_srid=int(self._srid))
+        origin = wkb.loads(str(c.execute('select AsBinary({qg})'.format(qg=qg), [query_geometry]).fetchone()[0]))
+        native = "GeomFromText(?, {srid})".format(srid=int(self._srid)) if self._srid else "GeomFromText(?)"
+        x0, y0, x1, y1 = origin.bounds
+
+        where_clauses, where_values = self._query_where(geometry_operator=None, **kwargs)
+        extent = self.resource.native_bounding_box.extent if self.resource.native_bounding_box else None
+        if extent:
+            xmin, ymin, xmax, ymax = extent
+            area = max((xmax - xmin) * (ymax - ymin), 1e-12)
+            radius = math.sqrt(area * n / max(self._estimated_rows(table), 1)) / 2
+        searchable = extent and self._uses_spatial_index(table)
+
+        while True:
+            covers = not searchable or (x0 - radius <= xmin and y0 - radius <= ymin and x1 + radius >= xmax and y1 + radius >= ymax)
+            clauses, values = list(where_clauses), list(where_values)
+            if not covers:
+                clauses.append(self._spatial_index_clause(table, index, 'BuildMBR({0}, {1}, {2}, {3})'.format(
+                    x0 - radius, y0 - radius, x1 + radius, y1 + radius)))
+
+            c.execute('''select OGC_FID, d from (select OGC_FID, Distance({geometry}, {native}) as d from {table}{where})
+                where d is not null{within} order by d limit {n}'''.format(
+                geometry=geometry_column,
+                native=native,
+                table=table,
+                where=' where ' + ' and '.join(clauses) if clauses else '',
+                within='' if covers else ' and d <= {radius}'.format(radius=radius),
+                n=int(n)
+            ), [origin.wkt] + values)
+            nearest = c.fetchall()
+            if covers or len(nearest) >= n:
+                c.close()
+                return nearest
+            radius *= 2
+
+    def query(
+            self,
+            geometry_operator='intersects',
+            query_geometry=None,
+            query_mbr=None,
+            query_geometry_srid=None,
+            only=None,
+            start=None,
+            end=None,
+            limit=None,
+            geometry_format='geojson',
+            order_by=None,
+            tolerance=None,
+            zoom=None,
+            precision=None,
+            **kwargs
+    ):
+        """
+        Query the dataset.  Besides the filters of _query_where:
+
+        :param geometry_operator: also nearest:N, for the N rows nearest to the query geometry in order of distance
+        :param tolerance: simplify geometries with SimplifyPreserveTopology to this tolerance in native units
+        :param zoom: simplify geometries to the detail visible at this web map zoom level, if tolerance isn't given.
+            Geometries are read from the generalized table for the zoom if there is one.
+        :param precision: round output coordinates to this many decimal places
+        """
+        c = self._cursor()
+        keys = self.schema() if not only else only
+        table = self._tablename
+        geometry_column = self._geometry_field
+        generalized = self.generalized_table(int(zoom)) if zoom is not None and not tolerance else None
+        if zoom is not None and not tolerance and not generalized:
+            tolerance = zoom_tolerance(int(zoom), self.resource.srs)
+
+        if generalized:
+            geometry_expression = '(select g.{geometry} from {generalized} as g where g.OGC_FID = {table}.OGC_FID)'.format(
+                geometry=geometry_column,
+                generalized=generalized,
+                table=table)
+        else:
+            geometry_expression = geometry_column if not tolerance else 'SimplifyPreserveTopology({geometry}, {tolerance})'.format(
+                geometry=geometry_column,
+                tolerance=float(tolerance))
+        precision = int(precision) if precision is not None else None
+
+        limit_clause = 'LIMIT {limit}'.format(**locals()) if limit else ''
+        order_clause = ''
+        columns = ','.join(keys)
+        if geometry_operator and geometry_operator.lower().startswith('nearest'):
+            if not query_geometry and query_mbr:
+                query_geometry = shapely.geometry.box(*query_mbr).wkt
+            elif not query_geometry:
+                raise ValueError('{op} needs a query geometry, as g or a bounding box'.format(op=geometry_operator))
+            nearest = self.nearest(int(geometry_operator.split(':')[1]), query_geometry, query_geometry_srid, start=start, end=end, **kwargs)
+            where_clauses = ['OGC_FID IN ({fids})'.format(fids=','.join(str(int(fid)) for fid, _ in nearest))]
+            where_values = []
+            if nearest:
+                order_clause = 'ORDER BY CASE OGC_FID {ranks} END'.format(
+                    ranks=' '.join('WHEN {fid} THEN {rank}'.format(fid=int(fid), rank=rank) for rank, (fid, _) in enumerate(nearest)))
+        else:
+            where_clauses, where_values = self._query_where(
+                geometry_operator=geometry_operator,
+                query_geometry=query_geometry,
+                query_mbr=query_mbr,
+                query_geometry_srid=query_geometry_srid,
+                start=start,
+                end=end,
+                **kwargs
+            )
+
         where_clauses = ' where ' +  ' and '.join(where_clauses) if len(where_clauses) > 0 else ''
 
-        query1 = 'select {columns} from {table} {where_clauses} {limit_clause}'.format(**locals())
-        query2 = 'select AsBinary({geometry}) from {table} {where_clauses} {limit_clause}'.format(**locals())
+        query1 = 'select {columns} from {table} {where_clauses} {order_clause} {limit_clause}'.format(**locals())
+        query2 = 'select AsBinary({geometry_expression}) from {table} {where_clauses} {order_clause} {limit_clause}'.format(**locals())
 
         c.execute("select load_extension('libspatialite.so')")
         c.execute(query1, where_values)
 
         records = []
         for row in c.fetchall():
-            records.append(dict(p for p in zip(keys, row) if p[0] != geometry))
+            records.append(dict(p for p in zip(keys, row) if p[0] != geometry_column))
 
         geo = []
-        if (not only) or (geometry in only):
+        if (not only) or (geometry_column in only):
             c.execute(query2, where_values)
 
             if geometry_format.lower() == 'geojson':
                 geo = [json.loads(geojson.dumps(wkb.loads(str(g[0])))) for g in c.fetchall()]
+                if precision is not None:
+                    geo = [round_coordinates(g, precision) for g in geo]
             elif geometry_format.lower() == 'wkt':
-                geo = [wkb.loads(str(g[0])).wkt for g in c.fetchall()]
+                if precision is not None:
+                    geo = [shapely.wkt.dumps(wkb.loads(str(g[0])), rounding_precision=precision) for g in c.fetchall()]
+                else:
+                    geo = [wkb.loads(str(g[0])).wkt for g in c.fetchall()]
             else:
                 geo = [None for g in c.fetchall()]
 
         gj = []
         for i, record in enumerate(records):
-            if (not only) or (geometry in only):
-                record[geometry] = geo[i]
+            if (not only) or (geometry_column in only):
+                record[geometry_column] = geo[i]
             gj.append(record)
 
         return gj
 
+    aggregate_functions = {'count', 'sum', 'avg', 'min', 'max'}
+
+    def aggregate(
+            self,
+            aggregates=(('count', '*'),),
+            group_by=(),
+            grid=None,
+            zones=None,
+            zone_key=None,
+            **kwargs
+    ):
+        """
+        Aggregate the rows matching a query in the database, so that only the aggregated rows are returned.
+
+        :param aggregates: a list of (function, column) pairs.  function is one of count, sum, avg, min, or max. Each
+            aggregate is returned under the key function_column, or just "count" for count(*)
+        :param group_by: a list of columns to group by
+        :param grid: if present, the size in native coordinate units of square grid cells.  Features are grouped by
+            the cell their centroid falls in, returned as cell_x, cell_y and the cell's bounds as cell.
+        :param zones: if present, a spatialite DataResource of polygons.  Features are grouped by the zone they
+            intersect, returned under zone_key.  A feature intersecting more than one zone is counted in each.
+        :param zone_key: the column of the zones dataset that identifies a zone (default its OGC_FID)
+        :param kwargs: the same filter arguments that query() accepts
+        :return: a list of dicts, one per group
+        """
+        schema = set(self.schema())
+        table = self._tablename
+        geometry_column = self._geometry_field
+        for column in group_by:
+            if column not in schema:
+                raise ValueError('cannot group by unknown column {column}'.format(column=column))
+
+        select = ['w.' + column for column in group_by]
+        names = list(group_by)
+        for function, column in aggregates:
+            function = function.lower()
+            if function not in self.aggregate_functions or (column != '*' and column not in schema):
+                raise ValueError('unsupported aggregate {function}({column})'.format(function=function, column=column))
+            select.append('{function}({column})'.format(function=function, column=column if column == '*' else 'w.' + column))
+            names.append(function if column == '*' else function + '_' + column)
+
+        group_clauses = ['w.' + column for column in group_by]
+        from_clause = '{table} AS w'.format(table=table)
+
+        if grid:
+            grid = float(grid)
+            for axis in ('X', 'Y'):
+                select.append('CAST(floor({axis}(Centroid(w.{geometry})) / {grid}) AS INTEGER)'.format(axis=axis, geometry=geometry_column, grid=grid))
+                group_clauses.append(select[-1])
+            names.extend(['cell_x', 'cell_y'])
+
+        if zones:
+            zone_driver = zones.driver_instance
+            zone_driver.ready_data_resource()
+            zone_key = zone_key or 'OGC_FID'
+            if zone_key not in zone_driver.schema():
+                raise ValueError('zones have no column {zone_key}'.format(zone_key=zone_key))
+
+            zone_geometry = 'z.' + zone_driver._geometry_field
+            if zone_driver._srid and self._srid and int(zone_driver._srid) != int(self._srid):
+                zone_geometry = 'Transform({zone_geometry}, {srid})'.format(zone_geometry=zone_geometry, srid=int(self._srid))
+
+            c = self._cursor()
+            c.execute("ATTACH DATABASE ? AS zones", [zone_driver._connection_filename()])
+            c.close()
+
+            # each zone probes this table's R*Tree, so the join costs one index search per zone
+            from_clause += ' JOIN zones.{zone_table} AS z ON ST_Intersects({zone_geometry}, w.{geometry}) = 1'.format(
+                zone_table=zone_driver._tablename,
+                zone_geometry=zone_geometry,
+                geometry=geometry_column
+            )
+            if self._uses_spatial_index(table):
+                from_clause += ' AND ' + self._spatial_index_clause('w', self._index_name, zone_geometry)
+
+            select.append('z.' + zone_key)
+            group_clauses.append('z.' + zone_key)
+            names.append(zone_key)
+
+        where_clauses, where_values = self._query_where(alias='w', **kwargs)
+
+        statement = 'select {select} from {from_clause} {where} {group}'.format(
+            select=','.join(select),
+            from_clause=from_clause,
+            where=' where ' + ' and '.join(where_clauses) if where_clauses else '',
+            group=' group by ' + ','.join(group_clauses) if group_clauses else ''
+        )
+
+        c = self._cursor()
+        try:
+            rows = [dict(zip(names, row)) for row in c.execute(statement, where_values).fetchall()]
+        finally:
+            c.close()
+            if zones:
+                self._connection().execute('DETACH DATABASE zones')
+
+        if grid:
+            for row in rows:
+                x, y = row['cell_x'], row['cell_y']
+                row['cell'] = [x * grid, y * grid, (x + 1) * grid, (y + 1) * grid]
+
+        return rows
+
 
     @classmethod
     def create_dataset(cls, title, parent=None, geometry_column_name='GEOMETRY', srid=4326, geometry_type='GEOMETRY', owner=None, columns_definitions=()):
@@ -965,8 +1590,9 @@ class SpatialiteDriver(Driver):
     def schema(self):
         self.ready_data_resource()
         conn = self._connection()
-        names = [c[0] for c in conn.cursor().execute('select * from {table} limit 1'.format(table=self._tablename)).description]
-        return names
+        names = self._metadata(('columns', self._tablename), lambda:
+            [c[0] for c in conn.cursor().execute('select * from {table} limit 1'.format(table=self._tablename)).description])
+        return list(names)
 
     def full_schema(self):
         self.ready_data_resource()
@@ -986,7 +1612,8 @@ class SpatialiteDriver(Driver):
         return dict(
             [(name, human_names.get(typename, '*')) for
                 _, name, typename, _, _, _ in
-                conn.execute('pragma table_info({table})'.format(table=self._index_name)).fetchall()])
+                self._metadata(('table_info', self._index_name), lambda:
+                    conn.execute('pragma table_info({table})'.format(table=self._index_name)).fetchall())])
 
 driver = SpatialiteDriver
 
@@ -0,0 +1,133 @@
+"""
+Parameterized sql for the database drivers.  Filters are built as a where clause and a list of values to bind to it,
+so a value never becomes part of the statement.  Besides keeping quotes in the data from breaking (or rewriting) a
+query, this makes the text of a statement depend only on its shape -- the table, columns and operators -- so the
+database can reuse the parse and plan of a statement it has already seen.  sqlite keeps compiled statements per
+connection keyed on their text, and PostGISDriver keeps server side prepared statements the same way.
+
+OGR's attribute filters take no parameters.  For them the same filters are rendered with each value as a properly
+quoted literal.
+"""
+
+import re
+
+ATTRIBUTE_OPERATORS = {
+    'eq': '=',
+    'gt': ">",
+    'gte': ">=",
+    'lt': "<",
+    'lte': '<=',
+    'startswith': 'LIKE',
+    'endswith': 'LIKE',
+    'contains': "LIKE",
+    'istartswith': 'ILIKE',
+    'iendswith': 'ILIKE',
+    'icontains': "ILIKE",
+    'ne': "<>"
+}
+
+LIKE_PATTERNS = {
+    'startswith': '{0}%',
+    'endswith': '%{0}',
+    'contains': '%{0}%',
+    'istartswith': '{0}%',
+    'iendswith': '%{0}',
+    'icontains': '%{0}%',
+}
+
+_format_markers = re.compile(r'%(s|%)')
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def escape_like(value):
+    """Escape the wildcards in a value that is to be matched literally by LIKE ... ESCAPE '\\'"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def literal(value):
+    """A value as an sql literal, for OGR attribute filters, which cannot bind parameters"""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, long, float)):
+        return repr(value)
+    if not isinstance(value, basestring):
+        value = str(value)
+    return "'" + value.replace("'", "''") + "'"
+
+
+def attribute_filter(key, value, placeholder='%s', ilike='ILIKE', arrays=False):
+    """
+    A where clause for one django style filter, column__op = value, as sql and a list of values to bind to it.
+
+    :param placeholder: the parameter marker of the database module, '%s' for psycopg2 and '?' for sqlite.  A function
+        of the value is called instead to render it into the clause, as literal does for OGR.
+    :param ilike: the case insensitive LIKE operator.  sqlite and OGR's LIKE is already case insensitive.
+    :param arrays: bind the values of an __in filter as a single array, so the statement is the same however many
+        values there are.  For PostgreSQL.
+    :return: (clause, values)
+    """
+    column, _, op = key.partition('__')
+    column = quote_identifier(column)
+    op = op or 'eq'
+
+    def marker(v):
+        return placeholder(v) if callable(placeholder) else placeholder
+
+    def bound(v):
+        return [] if callable(placeholder) else [v]
+
+    if op == 'in':
+        if isinstance(value, basestring):
+            value = [v.strip() for v in value.strip('()').split(',')]
+        value = list(value)
+        if not value:
+            return '1 = 0', []
+        if arrays and not callable(placeholder):
+            return column + ' = ANY(' + placeholder + ')', [value]
+        return column + ' IN (' + ', '.join(marker(v) for v in value) + ')', [] if callable(placeholder) else value
+
+    if op not in ATTRIBUTE_OPERATORS:
+        raise ValueError('unknown filter {key}'.format(key=key))
+
+    operator = ATTRIBUTE_OPERATORS[op]
+    if op in LIKE_PATTERNS:
+        value = LIKE_PATTERNS[op].format(escape_like(value))
+        if operator == 'ILIKE':
+            operator = ilike
+        return column + ' ' + operator + ' ' + marker(value) + " ESCAPE '\\'", bound(value)
+
+    return column + ' ' + operator + ' ' + marker(value), bound(value)
+
+
+def attribute_filters(query, **kwargs):
+    """All the filters of a query dict joined by AND, as (clause, values).  Keyword arguments are as attribute_filter"""
+    clauses = []
+    values = []
+    for key, value in sorted(query.items()):  # sorted, so the same filters always make the same statement
+        clause, bound = attribute_filter(key, value, **kwargs)
+        clauses.append(clause)
+        values.extend(bound)
+    return ' AND '.join(clauses), values
+
+
+def numbered_parameters(sql):
+    """
+    Rewrite a psycopg2 statement's %s markers as PostgreSQL's $1, $2 ... for PREPARE, returning the statement and the
+    number of parameters, or None if it uses named %(name)s parameters.
+    """
+    if '%(' in sql.replace('%%', ''):
+        return None
+    count = [0]
+
+    def number(match):
+        if match.group(1) == '%':
+            return '%'
+        count[0] += 1
+        return '$' + str(count[0])
+
+    return _format_markers.sub(number, sql), count[0]
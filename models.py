@@ -13,7 +13,8 @@ from mezzanine.pages.page_processors import processor_for
 from timedelta.fields import TimedeltaField
 import sh
 import os
-from osgeo import osr
+from ga_resources.cache import WFSResultCache
+from ga_resources.spatialrefs import spatial_reference
 import importlib
 
 
@@ -266,9 +267,7 @@ class DataResource(Page, RichText, PagePermissionsMixin):
     def srs(self):
         if not self.native_srs:
             self.driver_instance.compute_fields()
-        srs = osr.SpatialReference()
-        srs.ImportFromProj4(self.native_srs.encode('ascii'))
-        return srs
+        return spatial_reference(self.native_srs)
 
     @property
     def dataframe(self):
@@ -288,7 +287,9 @@ class DataResource(Page, RichText, PagePermissionsMixin):
     def modified(self):
         self.last_refresh = datetime.datetime.utcnow().replace(tzinfo=utc)
         self.driver_instance.clear_cache()
-        
+        self.driver_instance.data_changed()
+        WFSResultCache.get().invalidate(self.slug)
+
     @property
     def cache_path(self):
         p = os.path.join(s.MEDIA_ROOT, ".cache", "resources", *os.path.split(self.slug))
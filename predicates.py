@@ -1,5 +1,7 @@
 import math
 
+import numpy
+
 
 def unique(series):
     return series.unique().size == series.size
@@ -28,4 +30,127 @@ def continuous(series):
 
 
 def uniform(series):
-    return series.unique().size == 1
\ No newline at end of file
+    return series.unique().size == 1
+
+# Single pass column statistics.  column_state scans a series once and keeps enough running totals to answer all of
+# the predicates above plus describe()-style statistics, and update_column_state folds added and removed values into
+# those totals so that a summary can follow edits without rescanning the data.
+
+COUNTS_LIMIT = 1000  # keep exact value counts for columns with at most this many (or sqrt(n)) distinct values
+
+
+def _is_null(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def column_state(series):
+    size = series.size
+    counts = series.value_counts()
+    count = int(counts.sum())
+    numeric = series.dtype.kind in 'iuf'
+    state = {
+        'numeric': numeric,
+        'size': size,
+        'count': count,
+        'distinct': counts.size,
+        'top': counts.index[0] if counts.size else None,
+        'freq': int(counts.iloc[0]) if counts.size else None,
+        'counts': dict(counts.iteritems()) if counts.size <= max(COUNTS_LIMIT, math.sqrt(size)) else None,
+    }
+
+    if numeric:
+        values = series.dropna().values.astype(float)
+        state['sum'] = float(values.sum()) if count else 0.0
+        state['sumsq'] = float((values * values).sum()) if count else 0.0
+        state['min'] = float(values.min()) if count else None
+        state['max'] = float(values.max()) if count else None
+        if count:
+            state['25%'], state['50%'], state['75%'] = [float(q) for q in numpy.percentile(values, [25, 50, 75])]
+
+    return state
+
+
+def update_column_state(state, added=(), removed=()):
+    """
+    Fold added and removed values into a column state in place.
+
+    :return: False if the state can't be kept exact, for instance because the column's minimum or maximum was
+        removed, in which case the state should be recomputed from the data.
+    """
+    counts = state['counts']
+    for sign, values in ((-1, removed), (1, added)):
+        for value in values:
+            state['size'] += sign
+            if _is_null(value):
+                continue
+
+            if state['numeric']:
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    return False
+                if sign < 0 and value in (state['min'], state['max']):
+                    return False
+                state['sum'] += sign * value
+                state['sumsq'] += sign * value * value
+                if sign > 0:
+                    state['min'] = value if state['min'] is None else min(state['min'], value)
+                    state['max'] = value if state['max'] is None else max(state['max'], value)
+
+            state['count'] += sign
+            if counts is not None:
+                counts[value] = counts.get(value, 0) + sign
+                if counts[value] <= 0:
+                    del counts[value]
+            else:
+                # too many distinct values to count exactly. edits to high cardinality columns are assumed to add
+                # and remove distinct values, which is what keys and identifiers do.
+                state['distinct'] += sign
+
+    if counts is not None:
+        state['distinct'] = len(counts)
+        if counts:
+            state['top'], state['freq'] = max(counts.iteritems(), key=lambda kv: kv[1])
+        else:
+            state['top'] = state['freq'] = None
+    return True
+
+
+def column_summary(name, state):
+    """The summary of one column, as returned by Driver.summary, from its column state"""
+    size = state['size']
+    count = state['count']
+    distinct = state['distinct'] + (1 if count < size else 0)  # series.unique() counts null as a value
+    is_categorical = distinct < math.sqrt(size)
+
+    summary = {'name': name, 'kind': 'number' if state['numeric'] else 'text'}
+    summary['tags'] = [tag for tag in [
+        'unique' if distinct == size else None,
+        'not null' if count == size else None,
+        'null' if count < size else None,
+        'empty' if count == 0 else None,
+        'categorical' if is_categorical else None,
+        'open ended' if state['numeric'] and not is_categorical else None,
+        'mostly null' if count < size / 2 else None,
+        'uniform' if distinct == 1 else None
+    ] if tag]
+    if is_categorical and state['counts'] is not None:
+        summary['uniques'] = state['counts'].keys() + ([None] if count < size else [])
+
+    summary['count'] = count
+    if state['numeric']:
+        if count:
+            summary['mean'] = state['sum'] / count
+            variance = (state['sumsq'] - state['sum'] * state['sum'] / count) / (count - 1) if count > 1 else float('nan')
+            summary['std'] = math.sqrt(max(variance, 0)) if count > 1 else variance
+            summary['min'] = state['min']
+            summary['max'] = state['max']
+            for q in ('25%', '50%', '75%'):  # quantiles are as of the last full scan
+                if q in state:
+                    summary[q] = state[q]
+    else:
+        summary['unique'] = state['distinct']
+        summary['top'] = state['top']
+        summary['freq'] = state['freq']
+
+    return summary
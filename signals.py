@@ -4,6 +4,7 @@ from django.db.models.signals import post_save, pre_delete, pre_save
 from django.conf import settings as s
 from django.utils.timezone import utc
 from . import tasks, dispatch, drivers
+from .cache import WFSResultCache
 from .models import DataResource, Style, RenderedLayer
 import os
 
@@ -41,7 +42,12 @@ def purge_resource_data(sender, instance, *args, **kwargs):
 
 
 def shave_tile_caches(sender, instance, bbox, *args, **kwargs):
-    drivers.CacheManager.get().shave_caches(instance, bbox)
+    if bbox is not None:  # batches of features without geometry touch no tiles
+        drivers.CacheManager.get().shave_caches(instance, bbox)
+
+
+def purge_wfs_results(sender, instance, *args, **kwargs):
+    WFSResultCache.get().invalidate(instance.slug)
 
 
 def trim_tile_caches(sender, instance, *args, **kwargs):
@@ -62,6 +68,10 @@ pre_delete.connect(purge_resource_data, sender=DataResource, weak=False)
 dispatch.features_updated.connect(shave_tile_caches, weak=False)
 dispatch.features_created.connect(shave_tile_caches, weak=False)
 dispatch.features_deleted.connect(shave_tile_caches, weak=False)
+dispatch.features_updated.connect(purge_wfs_results, weak=False)
+dispatch.features_created.connect(purge_wfs_results, weak=False)
+dispatch.features_deleted.connect(purge_wfs_results, weak=False)
+pre_delete.connect(purge_wfs_results, sender=DataResource, weak=False)
 post_save.connect(trim_tile_caches, sender=Style, weak=False)
 pre_delete.connect(trim_tile_caches, sender=DataResource, weak=False)
 pre_delete.connect(trim_tile_caches, sender=Style, weak=False)
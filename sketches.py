@@ -0,0 +1,305 @@
+"""
+Bounded memory sketches for summarizing columns too large to load into a dataframe.  Each sketch takes values a batch
+at a time and never holds more than a fixed amount of state, however many rows are streamed through it:
+
+    * HyperLogLog estimates the number of distinct values with a relative standard error of 1.04/sqrt(2**p).
+    * Reservoir keeps a uniform random sample for quantiles, whose rank error is bounded by the DKW inequality.
+    * FrequentItems is a Misra-Gries summary for the most common values, undercounting each by at most .error.
+
+ColumnSketch combines them with exact running totals to produce the same summary entries as
+predicates.column_summary, plus the error bounds of the approximate figures.  Rows sampled a block at a time are not
+independent, so drivers that sample whole blocks yield each one as a Block, and the bounds are estimated from the
+variation between blocks instead.
+"""
+
+from collections import Counter
+from decimal import Decimal
+from hashlib import md5
+import math
+import numbers
+
+import numpy
+
+from ga_resources import predicates
+
+_U64 = numpy.uint64
+
+
+def _mix(x):
+    """splitmix64 finalizer over an array of uint64"""
+    x = x + _U64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> _U64(30))) * _U64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> _U64(27))) * _U64(0x94D049BB133111EB)
+    return x ^ (x >> _U64(31))
+
+
+def hash_numbers(values):
+    """64 bit hashes of a float array.  Equal numbers hash equally whatever type they were read as."""
+    values = numpy.asarray(values, dtype=numpy.float64) + 0.0  # + 0.0 folds -0.0 into 0.0
+    return _mix(values.view(_U64))
+
+
+def hash_strings(values):
+    """64 bit hashes of a sequence of strings.  Each distinct value is hashed once."""
+    hashes = dict((v, int(md5(v.encode('utf-8') if isinstance(v, unicode) else v).hexdigest()[:16], 16)) for v in set(values))
+    return numpy.fromiter((hashes[v] for v in values), dtype=_U64, count=len(values))
+
+
+class HyperLogLog(object):
+    def __init__(self, p=12):
+        self.p = p
+        self.m = 1 << p
+        self.registers = numpy.zeros(self.m, dtype=numpy.uint8)
+
+    def add_hashes(self, hashes):
+        if not len(hashes):
+            return
+        index = (hashes >> _U64(64 - self.p)).astype(numpy.int64)
+        w = (hashes << _U64(self.p)) | _U64(1 << (self.p - 1))  # the guard bit bounds the run of zeros
+
+        # count leading zeros of w by binary search, a bit width at a time
+        zeros = numpy.zeros(len(w), dtype=numpy.uint8)
+        for width in (32, 16, 8, 4, 2, 1):
+            short = w < (_U64(1) << _U64(64 - width))
+            zeros[short] += width
+            w[short] <<= _U64(width)
+
+        numpy.maximum.at(self.registers, index, zeros + 1)
+
+    def estimate(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / numpy.sum(2.0 ** -self.registers.astype(numpy.float64))
+        empty = int(numpy.sum(self.registers == 0))
+        if estimate <= 2.5 * self.m and empty:  # small range correction
+            estimate = self.m * math.log(float(self.m) / empty)
+        return estimate
+
+    @property
+    def relative_error(self):
+        return 1.04 / math.sqrt(self.m)
+
+
+class Reservoir(object):
+    """A uniform sample of at most k values from a stream (Vitter's algorithm R, applied a batch at a time)"""
+
+    def __init__(self, k=10000, seed=None):
+        self.k = k
+        self.seen = 0
+        self.values = numpy.empty(k, dtype=numpy.float64)
+        self.random = numpy.random.RandomState(seed)
+
+    def add(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        fill = min(max(self.k - self.seen, 0), len(values))
+        self.values[self.seen:self.seen + fill] = values[:fill]
+
+        rest = values[fill:]
+        if len(rest):
+            t = self.seen + fill + numpy.arange(1, len(rest) + 1)
+            slots = (self.random.random_sample(len(rest)) * t).astype(numpy.int64)
+            keep = slots < self.k
+            self.values[slots[keep]] = rest[keep]
+        self.seen += len(values)
+
+    def quantiles(self, percents):
+        sample = self.values[:min(self.seen, self.k)]
+        return [float(q) for q in numpy.percentile(sample, percents)] if len(sample) else [None] * len(percents)
+
+    def rank_error(self, confidence=0.95, sampled=False, design_effect=1.0):
+        """
+        The largest error in the rank of a quantile, as a fraction of the rows, at the given confidence.
+
+        :param sampled: whether the stream was itself a sample of the rows, so that even a reservoir holding all of it
+            has an error.
+        :param design_effect: the factor by which the sampling design inflates variance over independent rows, which
+            shrinks the effective size of the sample.
+        """
+        if not sampled and self.seen <= self.k:
+            return 0.0
+        n = min(self.seen, self.k) / max(design_effect, 1.0)
+        return math.sqrt(math.log(2 / (1 - confidence)) / (2 * n)) if n else None
+
+
+class FrequentItems(object):
+    """Misra-Gries summary of the at most k most frequent values"""
+
+    def __init__(self, k=100):
+        self.k = k
+        self.counts = {}
+        self.error = 0
+
+    def add(self, values):
+        for value, count in Counter(values).iteritems():
+            self.counts[value] = self.counts.get(value, 0) + count
+        if len(self.counts) > self.k:
+            cut = sorted(self.counts.values(), reverse=True)[self.k]
+            self.error += cut
+            self.counts = dict((value, count - cut) for value, count in self.counts.iteritems() if count > cut)
+
+    @property
+    def exact(self):
+        return self.error == 0
+
+    def top(self):
+        if not self.counts:
+            return None, None
+        return max(self.counts.iteritems(), key=lambda kv: kv[1])
+
+
+class Block(list):
+    """The rows of one block of a cluster sample, as yielded by attribute_batches of drivers that sample whole blocks"""
+
+
+class ColumnSketch(object):
+    def __init__(self, p=12, reservoir_size=10000, frequent_items=100):
+        self.size = 0
+        self.count = 0
+        self.numeric = True
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.min = None
+        self.max = None
+        self.distinct = HyperLogLog(p)
+        self.reservoir = Reservoir(reservoir_size)
+        self.frequent = FrequentItems(frequent_items)
+
+        # rows, values and sum of the current block, and running sums of squares and products over finished blocks
+        self.blocks = 0
+        self.block = [0, 0, 0.0]
+        self.between = dict.fromkeys(['nn', 'cc', 'cn', 'ss', 'sc'], 0.0)
+
+    def add(self, values):
+        self.size += len(values)
+        present = [v for v in values if not predicates._is_null(v)]
+        self.count += len(present)
+        self.block[0] += len(values)
+        self.block[1] += len(present)
+        if not present:
+            return
+
+        if self.numeric and all(isinstance(v, (numbers.Real, Decimal)) for v in present):
+            array = numpy.asarray(present, dtype=numpy.float64)
+            self.block[2] += float(array.sum())
+            self.sum += float(array.sum())
+            self.sumsq += float((array * array).sum())
+            self.min = float(array.min()) if self.min is None else min(self.min, float(array.min()))
+            self.max = float(array.max()) if self.max is None else max(self.max, float(array.max()))
+            self.reservoir.add(array)
+            self.distinct.add_hashes(hash_numbers(array))
+        else:
+            self.numeric = False
+            present = [v if isinstance(v, basestring) else unicode(v) for v in present]
+            self.distinct.add_hashes(hash_strings(present))
+
+        self.frequent.add(present)
+
+    def end_block(self):
+        """Close the block of a cluster sample that the values added since the last call belong to"""
+        n, c, s = self.block
+        for key, value in (('nn', n * n), ('cc', c * c), ('cn', c * n), ('ss', s * s), ('sc', s * c)):
+            self.between[key] += value
+        self.blocks += 1
+        self.block = [0, 0, 0.0]
+
+    def _ratio_variance(self, y, x, ratio, total):
+        """
+        The variance of a ratio sum(y) / sum(x) estimated from a cluster sample, from the spread between blocks of the
+        residuals y - ratio * x.  total is sum(x).
+        """
+        k = self.blocks
+        between = self.between
+        residuals = between[y + y] - 2 * ratio * between[y + x] + ratio * ratio * between[x + x]
+        return k * max(residuals, 0.0) / ((k - 1) * total * total)
+
+    def summary(self, name, fraction=1.0, confidence=0.95):
+        """
+        A summary entry in the format of predicates.column_summary, with 'approximate', 'sample' and 'error' keys.
+
+        :param fraction: the fraction of the dataset's rows that were streamed through this sketch.  Counts are scaled
+            up by 1/fraction and given confidence intervals.  The distinct count is of the sampled rows only, so it is
+            a lower bound for the whole dataset.  If the rows were streamed as Blocks of a cluster sample, the bounds of
+            the count, mean and quantiles come from the variation between blocks, and are None from a single block.
+        """
+        z = 1.959964 if confidence == 0.95 else _z(confidence)
+        sampled = fraction < 1.0
+        clustered = sampled and self.blocks > 0
+        size = self.size / fraction
+        count = self.count / fraction
+        distinct = min(self.distinct.estimate(), self.count)
+        errors = {
+            'distinct': self.distinct.relative_error,
+            'freq': self.frequent.error / fraction,
+        }
+        if sampled and self.size:
+            p = float(self.count) / self.size
+            if not clustered:
+                errors['count'] = z * math.sqrt(p * (1 - p) / self.size) * size
+            elif self.blocks > 1:
+                errors['count'] = z * math.sqrt(self._ratio_variance('c', 'n', p, self.size)) * size
+            else:
+                errors['count'] = None
+
+        distinct_all = distinct + (1 if count < size else 0)
+        tolerance = 3 * self.distinct.relative_error
+        is_unique = self.size - self.count <= 1 and distinct_all >= self.size * (1 - tolerance)
+        is_categorical = distinct_all < math.sqrt(size)
+
+        summary = {
+            'name': name,
+            'kind': 'number' if self.numeric and self.count else 'text',
+            'approximate': True,
+            'sample': fraction,
+            'error': errors,
+            'count': int(round(count)),
+        }
+        summary['tags'] = [tag for tag in [
+            'unique' if is_unique else None,
+            'not null' if self.count == self.size else None,
+            'null' if self.count < self.size else None,
+            'empty' if self.count == 0 else None,
+            'categorical' if is_categorical else None,
+            'open ended' if summary['kind'] == 'number' and not is_categorical else None,
+            'mostly null' if self.count < self.size / 2.0 else None,
+            'uniform' if distinct_all < 1.5 else None
+        ] if tag]
+        if is_categorical and self.frequent.exact:
+            summary['uniques'] = self.frequent.counts.keys() + ([None] if self.count < self.size else [])
+
+        top, freq = self.frequent.top()
+        design_effect = 1.0
+        if summary['kind'] == 'number':
+            mean = self.sum / self.count
+            variance = (self.sumsq - self.sum * self.sum / self.count) / (self.count - 1) if self.count > 1 else float('nan')
+            std = math.sqrt(max(variance, 0)) if self.count > 1 else variance
+            summary.update({'mean': mean, 'std': std, 'min': self.min, 'max': self.max})
+            summary['25%'], summary['50%'], summary['75%'] = self.reservoir.quantiles([25, 50, 75])
+            if sampled and self.count > 1:
+                if not clustered:
+                    errors['mean'] = z * std / math.sqrt(self.count)
+                elif self.blocks > 1:
+                    spread = self._ratio_variance('s', 'c', mean, self.count)
+                    errors['mean'] = z * math.sqrt(spread)
+                    design_effect = spread * self.count / variance if variance > 0 else 1.0
+                else:
+                    errors['mean'] = None
+        else:
+            summary.update({'unique': int(round(distinct)), 'top': top, 'freq': int(round(freq / fraction)) if freq else freq})
+
+        if clustered and self.blocks < 2:
+            errors['quantile_rank'] = None
+        else:
+            errors['quantile_rank'] = self.reservoir.rank_error(confidence, sampled, design_effect)
+
+        return summary
+
+
+def _z(confidence):
+    """The two sided normal critical value for a confidence level, by bisection on erf"""
+    lo, hi = 0.0, 10.0
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if math.erf(mid / math.sqrt(2)) < confidence:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
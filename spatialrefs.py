@@ -0,0 +1,131 @@
+"""
+A process wide registry of osr SpatialReference and CoordinateTransformation objects.  Looking up an EPSG code or
+parsing a PROJ.4 string, and setting up a transformation between two systems, each cost far more than transforming a
+handful of points, so each is built once per definition and reused from then on.
+
+SpatialReferences are shared by every thread and must not be modified by callers.  GDAL's coordinate transformations
+are not thread safe, so each thread builds and keeps its own copy of each transformation.  EPSG codes are kept for
+good; only the SPATIAL_REFERENCE_CACHE_SIZE most recently defined PROJ.4 and WKT definitions are, as clients can send
+any number of them.
+"""
+
+from collections import OrderedDict
+import re
+import threading
+
+from django.conf import settings
+import numpy
+from osgeo import osr
+
+SPATIAL_REFERENCE_CACHE_SIZE = getattr(settings, 'GA_RESOURCES_SPATIAL_REFERENCE_CACHE_SIZE', 256)  # PROJ.4 and WKT definitions kept
+
+_references = {}  # definition -> SpatialReference
+_reference_keys = {}  # id(SpatialReference) -> definition, for the references in _references
+_defined = OrderedDict()  # the definitions in _references that aren't EPSG codes, oldest first
+_proj4 = {}  # definition -> PROJ.4 string
+_references_lock = threading.Lock()
+_transformations = threading.local()
+
+# urn:ogc:def:crs:EPSG::4326, http://www.opengis.net/def/crs/EPSG/0/4326 and http://www.opengis.net/gml/srs/epsg.xml#4326
+_epsg_uri = re.compile(
+    r'^(?:urn:(?:x-)?ogc:def:crs:epsg:(?:[\d.]*:)?|https?://www\.opengis\.net/(?:def/crs/epsg/[\d.]+/|gml/srs/epsg\.xml#))(\d+)$',
+    re.IGNORECASE
+)
+
+
+def _key(definition):
+    if isinstance(definition, (int, long)):
+        return 'EPSG:{srid}'.format(srid=definition)
+    definition = definition.strip()
+    if definition.lower().startswith('epsg:'):
+        return 'EPSG:' + definition.split(':')[-1]
+    uri = _epsg_uri.match(definition)
+    if uri:
+        return 'EPSG:' + uri.group(1)
+    return definition
+
+
+def _reference_key(srs):
+    if isinstance(srs, osr.SpatialReference):
+        return _reference_keys.get(id(srs), None) or srs.ExportToWkt()
+    return _key(srs)
+
+
+def spatial_reference(definition):
+    """
+    The SpatialReference for a definition.
+
+    :param definition: an EPSG code as an int, EPSG:####, or an OGC URN or URL naming one, a PROJ.4 string, or WKT.
+        A SpatialReference is returned as it is.
+    :raises ValueError: if GDAL can't make sense of the definition
+    """
+    if isinstance(definition, osr.SpatialReference):
+        return definition
+
+    key = _key(definition)
+    srs = _references.get(key, None)
+    if srs is None:
+        srs = osr.SpatialReference()
+        try:
+            if key.startswith('EPSG:'):
+                error = srs.ImportFromEPSG(int(key[5:]))
+            elif key.startswith('+'):
+                error = srs.ImportFromProj4(key.encode('ascii'))
+            else:
+                error = srs.ImportFromWkt(key.encode('ascii'))
+        except RuntimeError as e:  # osr.UseExceptions() is on
+            raise ValueError('unrecognized spatial reference {key}: {e}'.format(key=key, e=e))
+        if error:
+            raise ValueError('unrecognized spatial reference {key}'.format(key=key))
+
+        with _references_lock:
+            if key not in _references and not key.startswith('EPSG:'):
+                _defined[key] = None
+                while len(_defined) > SPATIAL_REFERENCE_CACHE_SIZE:
+                    evicted, _ = _defined.popitem(last=False)
+                    del _reference_keys[id(_references.pop(evicted))]
+                    _proj4.pop(evicted, None)
+            srs = _references.setdefault(key, srs)
+            _reference_keys[id(srs)] = key
+    return srs
+
+
+def proj4(definition):
+    """The PROJ.4 string of anything spatial_reference accepts, for comparing coordinate systems"""
+    key = _reference_key(definition)
+    if key not in _proj4:
+        _proj4[key] = spatial_reference(definition).ExportToProj4()
+    return _proj4[key]
+
+
+def transformation(source, target):
+    """The CoordinateTransformation from source to target, each anything spatial_reference accepts"""
+    cache = getattr(_transformations, 'cache', None)
+    if cache is None:
+        cache = _transformations.cache = {}
+
+    key = (_reference_key(source), _reference_key(target))
+    crx = cache.get(key, None)
+    if crx is None:
+        if len(cache) >= SPATIAL_REFERENCE_CACHE_SIZE:
+            cache.clear()
+        crx = cache[key] = osr.CoordinateTransformation(spatial_reference(source), spatial_reference(target))
+    return crx
+
+
+def transform_point(x, y, source, target):
+    """Transform one point, returning the transformed x and y"""
+    x, y, _ = transformation(source, target).TransformPoint(x, y)
+    return x, y
+
+
+def transform_points(xs, ys, source, target):
+    """Transform arrays of x and y coordinates in one call, returning arrays of the transformed x and y"""
+    xs = numpy.asarray(xs, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    if not len(xs):
+        return xs.copy(), ys.copy()
+
+    points = transformation(source, target).TransformPoints(numpy.column_stack([xs, ys]).tolist())
+    transformed = numpy.array(points, dtype=numpy.float64).reshape(-1, 3)
+    return transformed[:, 0], transformed[:, 1]
@@ -0,0 +1,159 @@
+"""
+Feature collections written a feature at a time, so that a response can be sent while the driver is still reading
+rows instead of after the whole result has been built.  Features are (properties, shapely geometry) pairs, as
+Driver.iter_features yields them.
+"""
+
+from collections import OrderedDict
+import datetime
+import decimal
+import json
+import math
+import re
+
+import numpy
+from osgeo import ogr
+
+from ga_resources.spatialrefs import spatial_reference
+
+STREAM_BATCH_SIZE = 100  # features encoded per chunk of the response
+
+
+def _jsonable(value):
+    """The default for json.dumps, for the values databases return that json doesn't know"""
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if hasattr(value, 'item'):  # numpy scalars
+        return value.item()
+    return None  # blobs
+
+
+def _null_nan(value):
+    """None for the NaN that dataframes hold in place of missing numbers, which JSON and GML can't represent"""
+    return None if isinstance(value, (float, numpy.floating)) and math.isnan(value) else value
+
+
+def _text(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _batches(encoded, batch_size):
+    batch = []
+    for text in encoded:
+        batch.append(text)
+        if len(batch) >= batch_size:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def geojson_collection(features, batch_size=STREAM_BATCH_SIZE):
+    """A GeoJSON FeatureCollection of features, as an iterator of strings"""
+    from shapely.geometry import mapping
+
+    def encoded():
+        separator = ''
+        for properties, geometry in features:
+            yield separator + json.dumps({
+                'type': 'Feature',
+                'geometry': mapping(geometry) if geometry is not None else None,
+                'properties': OrderedDict((k, _null_nan(v)) for k, v in properties.items())
+            }, default=_jsonable)
+            separator = ','
+
+    yield '{"type": "FeatureCollection", "features": ['
+    for chunk in _batches(encoded(), batch_size):
+        yield chunk
+    yield ']}'
+
+
+def xml_name(name):
+    """A column name made into a valid XML element name"""
+    name = re.sub(r'[^\w.-]', '_', name)
+    return name if re.match(r'[A-Za-z_]', name) else '_' + name
+
+
+def gml_collection(features, type_name, namespace, srs=None, batch_size=STREAM_BATCH_SIZE):
+    """
+    A GML feature collection of features, as an iterator of strings.  The document has the same layout as one written
+    by OGR's GML driver, with each feature a gml:featureMember in namespace, but it is written as the features arrive.
+
+    :param srs: the coordinate system of the geometries, named in their srsName
+    """
+    from xml.sax.saxutils import escape, quoteattr
+
+    reference = spatial_reference(srs) if srs is not None else None
+    element = 'ga_resources:' + xml_name(type_name)
+
+    def encoded():
+        names = None
+        for n, (properties, geometry) in enumerate(features):
+            if names is None:
+                names = dict((k, 'ga_resources:' + xml_name(k)) for k in properties)
+            parts = ['<gml:featureMember><{element} fid={fid}>'.format(
+                element=element, fid=quoteattr('{0}.{1}'.format(type_name, n)))]
+            if geometry is not None:
+                g = ogr.CreateGeometryFromWkb(geometry.wkb)
+                if reference is not None:
+                    g.AssignSpatialReference(reference)
+                parts.append('<ga_resources:geometryProperty>' + g.ExportToGML() + '</ga_resources:geometryProperty>')
+            for k, v in properties.items():
+                if _null_nan(v) is not None:
+                    parts.append('<{name}>{value}</{name}>'.format(name=names[k], value=escape(_text(v))))
+            parts.append('</{element}></gml:featureMember>\n'.format(element=element))
+            yield ''.join(parts)
+
+    yield '<?xml version="1.0" encoding="utf-8" ?>\n' \
+          '<ga_resources:FeatureCollection xmlns:ga_resources={namespace} xmlns:gml="http://www.opengis.net/gml">\n'.format(
+              namespace=quoteattr(namespace))
+    for chunk in _batches(encoded(), batch_size):
+        yield chunk
+    yield '</ga_resources:FeatureCollection>\n'
+
+
+def ogr_datasource(features, type_name, srs=None):
+    """
+    Load features into an in-memory OGR datasource with a single layer, for output formats that only OGR can write.
+    The fields are typed by the values of the first feature.
+    """
+    ds = ogr.GetDriverByName('Memory').CreateDataSource(str(type_name))
+    layer = ds.CreateLayer(str(type_name), spatial_reference(srs) if srs is not None else None, ogr.wkbUnknown)
+    defn = None
+    for properties, geometry in features:
+        if defn is None:
+            for k, v in properties.items():
+                if isinstance(v, (bool, int, long)):
+                    field_type = getattr(ogr, 'OFTInteger64', ogr.OFTInteger)
+                elif isinstance(v, (float, decimal.Decimal)):
+                    field_type = ogr.OFTReal
+                else:
+                    field_type = ogr.OFTString
+                layer.CreateField(ogr.FieldDefn(str(k), field_type))
+            defn = layer.GetLayerDefn()
+
+        feature = ogr.Feature(defn)
+        for k, v in properties.items():
+            if _null_nan(v) is None or isinstance(v, buffer):
+                continue
+            field = defn.GetFieldIndex(str(k))
+            field_type = defn.GetFieldDefn(field).GetType()
+            try:
+                if field_type == ogr.OFTString:
+                    feature.SetField(field, _text(v))
+                elif field_type == ogr.OFTReal:
+                    feature.SetField(field, float(v))
+                else:
+                    feature.SetField(field, int(v))
+            except (TypeError, ValueError):  # a value that doesn't fit the type of the first feature's
+                pass
+        if geometry is not None:
+            feature.SetGeometry(ogr.CreateGeometryFromWkb(geometry.wkb))
+        layer.CreateFeature(feature)
+    return ds
@@ -0,0 +1,152 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from ga_resources.cache import QueryResultCache, WFSResultCache, dataset_version, bump_dataset_version, read_columnar_frame, \
+    write_columnar_frame, columnar_frame_columns
+import pandas
+from shapely.geometry import Point
+
+
+class QueryResultCacheTest(TestCase):
+    def test_version_invalidates(self):
+        cache = QueryResultCache(max_entries=4)
+        slug = 'tests/query-result-cache'
+        params = {'county__eq': 'Alamance', '_limit': 10}
+
+        cache.set(slug, params, [{'OGC_FID': 1}])
+        self.assertEqual(cache.get(slug, params), [{'OGC_FID': 1}])
+        self.assertIsNone(cache.get(slug, dict(params, _limit=11)), msg='different parameters should not hit')
+
+        v = dataset_version(slug)
+        bump_dataset_version(slug)
+        self.assertEqual(dataset_version(slug), v + 1)
+        self.assertIsNone(cache.get(slug, params), msg='bumping the dataset version should invalidate old results')
+
+    def test_edit_during_query(self):
+        cache = QueryResultCache(max_entries=4)
+        slug = 'tests/query-result-cache-race'
+        params = {'county__eq': 'Wake'}
+
+        version = dataset_version(slug)
+        self.assertIsNone(cache.get(slug, params, version))
+        bump_dataset_version(slug)  # an edit commits while the query runs
+        cache.set(slug, params, [{'OGC_FID': 1}], version)
+        self.assertIsNone(cache.get(slug, params), msg='rows read before the edit should not be stored under its version')
+
+    def test_lru_bound(self):
+        cache = QueryResultCache(max_entries=2)
+        slug = 'tests/query-result-cache-lru'
+        cache.set(slug, {'i': 1}, 1)
+        cache.set(slug, {'i': 2}, 2)
+        cache.get(slug, {'i': 1})
+        cache.set(slug, {'i': 3}, 3)
+
+        self.assertEqual(cache.get(slug, {'i': 1}), 1)
+        self.assertIsNone(cache.get(slug, {'i': 2}), msg='least recently used entry should have been evicted')
+        self.assertEqual(cache.get(slug, {'i': 3}), 3)
+
+
+class WFSResultCacheTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = WFSResultCache(path=self.path, max_bytes=100, max_entry_bytes=60)
+        self.slug = 'tests/wfs-result-cache'
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def fetch(self, params, chunks=('abc', 'def')):
+        f = self.cache.open(self.slug, params)
+        if f is not None:
+            with f:
+                return 'hit', f.read()
+        return 'miss', ''.join(self.cache.store(self.slug, params, iter(chunks)))
+
+    def cached(self, params):
+        f = self.cache.open(self.slug, params)
+        if f is not None:
+            f.close()
+        return f is not None
+
+    def test_hit_and_invalidate(self):
+        params = {'typename': 'x', 'outputformat': 'json'}
+        self.assertEqual(self.fetch(params), ('miss', 'abcdef'))
+        self.assertEqual(self.fetch(params), ('hit', 'abcdef'))
+        self.assertEqual(self.fetch(dict(params, bbox='0,0,1,1'))[0], 'miss')
+
+        self.cache.invalidate(self.slug)
+        self.assertEqual(self.fetch(params)[0], 'miss', msg='invalidating the dataset should remove its entries')
+
+        bump_dataset_version(self.slug)
+        self.assertFalse(self.cached(params), msg='a new dataset version should not hit')
+
+    def test_size_bound(self):
+        self.fetch({'i': 1}, ['a' * 40])
+        self.fetch({'i': 2}, ['b' * 40])
+        self.fetch({'i': 1})
+        self.fetch({'i': 3}, ['c' * 40])
+
+        self.assertTrue(self.cached({'i': 1}))
+        self.assertFalse(self.cached({'i': 2}), msg='least recently used entry should have been evicted')
+        self.assertTrue(self.cached({'i': 3}))
+
+        self.assertEqual(self.fetch({'i': 4}, ['d' * 40, 'd' * 40]), ('miss', 'd' * 80))
+        self.assertFalse(self.cached({'i': 4}), msg='entries bigger than the limit are not stored')
+
+    def test_abandoned_response(self):
+        response = self.cache.store(self.slug, {'i': 5}, iter(['abc', 'def']))
+        next(response)
+        response.close()
+        self.assertFalse(self.cached({'i': 5}))
+        self.assertFalse([f for d, _, fs in os.walk(self.path) for f in fs if '.tmp' in f])
+
+
+class ColumnarFrameTest(TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'frame.dfx')
+        self.df = pandas.DataFrame({
+            'i': [1, 2, 3],
+            'x': [0.5, None, 2.5],
+            'name': [u'Alamance', None, u'Wake'],
+            'geometry': [Point(0, 0), Point(1, 1), None]
+        }, index=pandas.Index([10, 20, 30], name='fid'))
+        write_columnar_frame(self.path, self.df)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_round_trip(self):
+        df = read_columnar_frame(self.path)
+
+        self.assertListEqual(list(df.columns), list(self.df.columns))
+        self.assertListEqual(list(df.index), [10, 20, 30])
+        self.assertEqual(df.index.name, 'fid')
+        self.assertListEqual(list(df['i']), [1, 2, 3])
+        self.assertEqual(df['name'][10], u'Alamance')
+        self.assertIsNone(df['name'][20])
+        self.assertTrue(df['geometry'][20].equals(Point(1, 1)))
+        self.assertIsNone(df['geometry'][30])
+
+    def test_column_subset(self):
+        df = read_columnar_frame(self.path, columns=['i'])
+        self.assertListEqual(list(df.columns), ['i'])
+        self.assertListEqual(columnar_frame_columns(self.path), list(self.df.columns))
+
+    def test_lazy_geometry(self):
+        df = read_columnar_frame(self.path, columns=['geometry'], lazy_geometry=True)
+        self.assertEqual(df['geometry'][10], Point(0, 0).wkb)
+
+    def test_bytes_that_are_not_utf8(self):
+        df = pandas.DataFrame({'latin': ['Caf\xe9', None, 'plain'], 'mixed': [u'Caf\xe9', 'Caf\xe9', None]})
+        write_columnar_frame(self.path, df)
+
+        df = read_columnar_frame(self.path)
+        self.assertListEqual(list(df['latin']), ['Caf\xe9', None, 'plain'])
+        self.assertListEqual(list(df['mixed']), [u'Caf\xe9', 'Caf\xe9', None])
+
+    def test_replace(self):
+        write_columnar_frame(self.path, self.df[['i']])
+        self.assertListEqual(columnar_frame_columns(self.path), ['i'])
+        self.assertListEqual(os.listdir(os.path.dirname(self.path)), ['frame.dfx'], msg='nothing should be left behind')
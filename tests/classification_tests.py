@@ -0,0 +1,29 @@
+from unittest import TestCase
+
+import numpy
+
+from ga_resources.classification import distribution, jenks_breaks
+
+
+class ClassificationTest(TestCase):
+    def test_jenks_breaks(self):
+        values = numpy.array([1, 2, 3, 10, 11, 12, 30, 31, 32, 33], dtype=float)
+        self.assertListEqual(jenks_breaks(values, 3), [1.0, 3.0, 12.0, 33.0])
+
+    def test_distribution(self):
+        values = numpy.concatenate([numpy.arange(100, dtype=float), [numpy.nan] * 5])
+        result = distribution(values, bins=4, classes=4, top=3)
+
+        self.assertEqual(result['count'], 100)
+        self.assertEqual(result['nulls'], 5)
+        self.assertListEqual(result['histogram']['counts'], [25, 25, 25, 25])
+        self.assertEqual(len(result['top']), 3)
+        for method in ('equal_interval', 'quantile', 'jenks'):
+            breaks = result['breaks'][method]
+            self.assertEqual(breaks[0], 0)
+            self.assertEqual(breaks[-1], 99)
+
+    def test_text_distribution(self):
+        result = distribution(['a', 'b', 'a', None])
+        self.assertListEqual(result['top'], [['a', 2], ['b', 1]])
+        self.assertNotIn('breaks', result)
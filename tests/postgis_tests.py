@@ -0,0 +1,334 @@
+from unittest import TestCase
+import json
+import threading
+
+from django.conf import settings
+import numpy
+import psycopg2
+from psycopg2.pool import PoolError
+
+from ga_resources.drivers import dataframe_from_cursor, postgis
+
+
+def local_config():
+    """A PostGIS driver_config for the local database django is configured with, or None if it isn't PostgreSQL"""
+    db = settings.DATABASES['default']
+    if 'postgis' not in db['ENGINE'] and 'postgresql' not in db['ENGINE']:
+        return None
+    cfg = {'dbname': db['NAME']}
+    for key, setting in (('host', 'HOST'), ('user', 'USER'), ('password', 'PASSWORD'), ('port', 'PORT')):
+        if db.get(setting):
+            cfg[key] = db[setting]
+    return cfg
+
+
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        self.cfg = local_config()
+        if self.cfg is None:
+            self.skipTest('no local PostgreSQL database configured')
+
+    def tearDown(self):
+        postgis.release_connections()
+
+    def test_connections_are_shared_and_bounded(self):
+        pool = postgis.ConnectionPool(dict(postgis.connection_parameters(self.cfg)), min_size=1, max_size=2, timeout=0.1)
+        a = pool.getconn()
+        b = pool.getconn()
+        self.assertIsNot(a, b)
+        self.assertRaises(PoolError, pool.getconn)
+
+        pool.putconn(a)
+        self.assertIs(pool.getconn(), a)
+
+        b.close()
+        pool.putconn(b)
+        self.assertEqual(pool.size, 1)
+        pool.putconn(a)
+        pool.closeall()
+        self.assertEqual(pool.size, 0)
+
+    def test_stale_connections_are_replaced(self):
+        pool = postgis.ConnectionPool(dict(postgis.connection_parameters(self.cfg)), min_size=1, check_interval=0)
+        a = pool.getconn()
+        a.close()
+        pool.idle.append((a, 0))
+        b = pool.getconn()
+        self.assertIsNot(a, b)
+        self.assertFalse(b.closed)
+        pool.putconn(b)
+        pool.closeall()
+        self.assertEqual(pool.size, 0)
+
+    def test_thread_connections(self):
+        cfg = dict(self.cfg, statement_timeout=1000)
+        connection = postgis.pooled_connection(cfg)
+        self.assertIs(postgis.pooled_connection(cfg), connection)
+
+        c = connection.cursor()
+        c.execute('show statement_timeout')
+        self.assertEqual(c.fetchone()[0], '1s')
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(postgis.pooled_connection(cfg)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], connection)
+
+        postgis.release_connections()
+        self.assertIs(postgis.pooled_connection(cfg), connection)
+
+
+    def test_failed_transactions_are_rolled_back(self):
+        connection = postgis.pooled_connection(self.cfg)
+        c = connection.cursor()
+        self.assertRaises(psycopg2.Error, c.execute, 'select * from no_such_table')
+
+        self.assertIs(postgis.pooled_connection(self.cfg), connection)
+        c = connection.cursor()
+        c.execute('select 1')
+        self.assertEqual(c.fetchone()[0], 1)
+
+    def test_released_after_tasks(self):
+        from celery.signals import task_postrun
+
+        connection = postgis.pooled_connection(self.cfg)
+        task_postrun.send(sender=None)
+        self.assertEqual(postgis._checked_out.connections, {})
+        self.assertIs(postgis.pooled_connection(self.cfg), connection)
+
+
+class DataframeFromCursorTest(TestCase):
+    def setUp(self):
+        self.cfg = local_config()
+        if self.cfg is None:
+            self.skipTest('no local PostgreSQL database configured')
+        self.connection = postgis.pooled_connection(self.cfg)
+
+    def tearDown(self):
+        postgis.release_connections()
+
+    def test_typed_columns(self):
+        c = self.connection.cursor()
+        c.execute('create temporary table typed (n integer, m integer, x float8, b boolean, s text)')
+        c.executemany('insert into typed values (%s, %s, %s, %s, %s)', [
+            (i, i if i % 3 else None, i / 2.0 if i % 5 else None, bool(i % 2) if i % 7 else None, str(i))
+            for i in range(25)
+        ])
+
+        cursor = self.connection.cursor('typed')
+        cursor.execute('select NULL::bytea, * from typed order by n')
+        df = dataframe_from_cursor(cursor, 'none', lazy_geometry=True, batch_size=10, type_codes=postgis.POSTGRES_DTYPES)
+
+        self.assertEqual(len(df), 25)
+        self.assertEqual(df['n'].dtype, numpy.int32)
+        self.assertEqual(list(df['n']), range(25))
+        self.assertEqual(df['m'].dtype, numpy.float64)
+        self.assertTrue(numpy.isnan(df['m'][3]))
+        self.assertTrue(numpy.isnan(df['x'][5]))
+        self.assertEqual(df['x'][3], 1.5)
+        self.assertIsNone(df['b'][7])
+        self.assertEqual(df['s'][24], '24')
+
+
+class PostGISDataAPITest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ds = None
+        if postgis.DATASETS_CONFIG:
+            cls.ds = postgis.PostGISDriver.create_dataset('postgis dataset', columns_definitions=(
+                ('name', 'text'),
+                ('i', 'integer'),
+            ))
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.ds is not None:
+            c = cls.ds.resource._connection().cursor()
+            c.execute('drop table {table}'.format(table=cls.ds.resource._tablename))
+            c.connection.commit()
+            cls.ds.delete()
+        postgis.release_connections()
+
+    def setUp(self):
+        if self.ds is None:
+            self.skipTest('GA_RESOURCES_POSTGIS_DATASETS is not configured')
+        self.driver = self.ds.resource
+
+    def test_schema(self):
+        self.assertListEqual(['ogc_fid', 'geometry', 'name', 'i'], self.driver.schema())
+        self.assertEqual(self.driver.full_schema()['name'], 'Text')
+
+    def test_crud(self):
+        row = self.driver.add_row(name='first', i='1', geometry='POINT(-79 35)')
+        key = row['ogc_fid']
+        self.assertEqual(row['geometry'], 'POINT(-79 35)')
+        self.assertEqual(self.driver.get_row(key)['geometry']['type'], 'Point')
+
+        self.driver.update_row(key, name="it's renamed")
+        self.assertEqual(self.driver.get_row(key, geometry_format='wkt')['name'], "it's renamed")
+
+        self.driver.delete_row(key)
+        self.assertIsNone(self.driver.get_row(key))
+
+    def test_bulk_and_query(self):
+        keys = self.driver.add_rows([
+            {'name': 'p{0}'.format(n), 'i': n, 'geometry': 'POINT({0} {0})'.format(n)} for n in range(20)
+        ])
+        self.assertEqual(len(keys), 20)
+        self.assertEqual(self.driver.extent_of_rows(keys), (0.0, 0.0, 19.0, 19.0))
+
+        rows = self.driver.query(query_mbr=(4.5, 4.5, 8.5, 8.5), geometry_format='wkt')
+        self.assertEqual(sorted(r['i'] for r in rows), [5, 6, 7, 8])
+
+        rows = self.driver.query(geometry_operator=None, i__ge=15, name__startswith='p1')
+        self.assertEqual(sorted(r['i'] for r in rows), [15, 16, 17, 18, 19])
+
+        rows = self.driver.query(geometry_operator='nearest:3', query_geometry='POINT(10.1 10.1)')
+        self.assertEqual([r['i'] for r in rows], [10, 11, 9])
+        self.assertRaises(ValueError, self.driver.query, geometry_operator='nearest:3')
+
+        rows = self.driver.query(geometry_operator='distance::le:1.5', query_geometry='POINT(3 3)', only=['i'])
+        self.assertEqual(sorted(r['i'] for r in rows), [2, 3, 4])
+
+        counts = self.driver.aggregate(aggregates=(('count', '*'), ('sum', 'i')), grid=10)
+        self.assertEqual(sorted((r['cell_x'], r['cell_y'], r['count']) for r in counts), [(0, 0, 10), (1, 1, 10)])
+
+        zone = self.driver.add_row(name='zone', i=100, geometry='POLYGON((-1 -1, 4.5 -1, 4.5 4.5, -1 4.5, -1 -1))')['ogc_fid']
+        by_zone = dict((r['ogc_fid'], r['count']) for r in self.driver.aggregate(zones=self.ds))
+        self.assertEqual(by_zone[zone], 6, msg='zones should be keyed on their key field by default')
+        self.driver.delete_row(zone)
+
+        self.driver.update_rows([{'ogc_fid': k, 'name': 'renamed'} for k in keys[:5]])
+        self.assertEqual(len(self.driver.query(geometry_operator=None, name='renamed')), 5)
+
+        self.driver.delete_rows(keys)
+        self.assertEqual(self.driver.get_rows(min(keys)), [])
+
+    def test_extent(self):
+        keys = self.driver.add_rows([{'geometry': 'POINT({0} {1})'.format(n, -n)} for n in range(10)])
+        table = self.driver._tablename
+        self.assertEqual(self.driver._extent(table, 'geometry'), (0.0, -9.0, 9.0, 0.0))
+
+        c = self.driver._connection().cursor()
+        c.execute('analyze {table}'.format(table=table))
+        xmin, ymin, xmax, ymax = self.driver._extent(table, 'geometry', estimate=True)
+        self.assertTrue(xmin <= 0 and ymin <= -9 and xmax >= 9 and ymax >= 0)
+
+        self.assertEqual(self.driver._geometry_srid(table, 'geometry'), 4326)
+        self.assertEqual(self.driver._metadata(table, 'answer', lambda: 42), 42)
+        self.driver.delete_rows(keys)
+
+    def test_detected_srid(self):
+        ds = postgis.PostGISDriver.create_dataset('postgis mercator dataset', srid=3857)
+        driver = ds.resource
+        try:
+            cfg = ds.driver_config
+            del cfg['srid']
+            ds.resource_config = json.dumps(cfg)
+            self.assertEqual(driver._srid, 3857)
+
+            driver.add_rows([{'geometry': 'POINT(1000 1000)'}])
+            self.assertEqual(len(driver.as_dataframe(bbox=(0, 0, 2000, 2000))), 1)
+
+            driver.compute_fields()
+            self.assertEqual(ds.driver_config['srid'], 3857)
+        finally:
+            c = driver._connection().cursor()
+            c.execute('drop table {table}'.format(table=driver._tablename))
+            c.connection.commit()
+            ds.delete()
+
+    def test_vector_tile(self):
+        keys = self.driver.add_rows([{'name': 'p{0}'.format(n), 'geometry': 'POINT({0} {0})'.format(n)} for n in range(10)])
+        tile = self.driver.vector_tile(0, 0, 0, layer_name='points')
+        self.assertIn('points', tile)
+        self.assertIn('p9', tile)
+        self.assertEqual(self.driver.vector_tile(2, 0, 3), '')
+        self.driver.delete_rows(keys)
+
+
+class PreparedStatementTest(TestCase):
+    def setUp(self):
+        self.cfg = local_config()
+        if self.cfg is None:
+            self.skipTest('no local PostgreSQL database configured')
+        self.connection = postgis.pooled_connection(self.cfg)
+        self.cursor = self.connection.cursor()
+
+    def tearDown(self):
+        postgis.release_connections()
+
+    def test_statements_are_prepared_once(self):
+        for n in range(3):
+            postgis.execute(self.cursor, 'select %s::integer + 1, 1 %% 2', [n])
+            self.assertEqual(self.cursor.fetchone(), (n + 1, 1))
+        name = self.connection.prepared['select %s::integer + 1, 1 %% 2']
+        self.cursor.execute('select count(*) from pg_prepared_statements where name = %s', [name])
+        self.assertEqual(self.cursor.fetchone()[0], 1)
+
+    def test_unpreparable_statements(self):
+        postgis.execute(self.cursor, 'select %s', ['untyped'])  # PostgreSQL can't tell what type $1 is
+        self.assertEqual(self.cursor.fetchone()[0], 'untyped')
+        self.assertIsNone(self.connection.prepared['select %s'])
+        self.cursor.execute('select 1')  # the transaction is still usable
+
+    def test_star_selects_are_not_prepared(self):
+        self.cursor.execute('create temporary table prepared_star (n integer)')
+        postgis.execute(self.cursor, 'select * from prepared_star where n = %s', [1])
+        self.assertNotIn('select * from prepared_star where n = %s', self.connection.prepared)
+
+        self.cursor.execute('alter table prepared_star add column m integer')
+        postgis.execute(self.cursor, 'select * from prepared_star where n = %s', [1])
+        self.assertEqual([c.name for c in self.cursor.description], ['n', 'm'])
+
+    def test_altered_table(self):
+        sql = 'select n from prepared_altered where n = %s'
+        self.cursor.execute('create temporary table prepared_altered (n integer)')
+        self.cursor.execute('insert into prepared_altered values (1)')
+        self.connection.commit()
+        postgis.execute(self.cursor, sql, [1])
+        self.assertIsNotNone(self.connection.prepared[sql])
+        self.connection.commit()
+
+        self.cursor.execute('alter table prepared_altered alter column n type bigint')
+        self.connection.commit()
+        postgis.execute(self.cursor, sql, [1])  # "cached plan must not change result type", retried as it began the transaction
+        self.assertEqual(self.cursor.fetchone()[0], 1)
+        self.assertNotIn(sql, self.connection.prepared)
+
+        postgis.execute(self.cursor, sql, [1])  # prepared again against the new table
+        self.assertIsNotNone(self.connection.prepared[sql])
+        self.connection.commit()
+
+        self.cursor.execute('alter table prepared_altered alter column n type integer')
+        self.connection.commit()
+        self.cursor.execute('select 1')
+        self.assertRaises(psycopg2.NotSupportedError, postgis.execute, self.cursor, sql, [1])
+        self.connection.rollback()
+        postgis.execute(self.cursor, sql, [1])
+        self.assertEqual(self.cursor.fetchone()[0], 1)
+
+    def test_schema_changes_deallocate(self):
+        sql = 'select n from prepared_changed where n = %s'
+        self.cursor.execute('create temporary table prepared_changed (n integer)')
+        self.cursor.execute('insert into prepared_changed values (1)')
+        postgis.execute(self.cursor, sql, [1])
+        name = self.connection.prepared[sql]
+
+        self.cursor.execute('alter table prepared_changed alter column n type bigint')
+        postgis.schema_changed()
+        postgis.execute(self.cursor, sql, [1])  # inside the transaction, and without a savepoint
+        self.assertEqual(self.cursor.fetchone()[0], 1)
+        self.cursor.execute('select count(*) from pg_prepared_statements where name = %s', [name])
+        self.assertEqual(self.cursor.fetchone()[0], 0)
+
+    def test_least_recently_used_are_deallocated(self):
+        limit, postgis.PREPARED_STATEMENTS = postgis.PREPARED_STATEMENTS, 2
+        try:
+            for n in range(3):
+                postgis.execute(self.cursor, 'select %s::integer + {n}'.format(n=n), [n])
+            self.assertEqual(len(self.connection.prepared), 2)
+            self.assertNotIn('select %s::integer + 0', self.connection.prepared)
+        finally:
+            postgis.PREPARED_STATEMENTS = limit
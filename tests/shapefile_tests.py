@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+
+from osgeo import ogr
+from shapely.geometry import Point
+
+from ga_resources.drivers.shapefile import layer_as_dataframe, set_attribute_filter
+from ga_resources.streaming import ogr_datasource
+
+
+def features(n):
+    for i in range(n):
+        yield OrderedDict([('name', 'feature {0}'.format(i)), ('n', i), ('x', i / 2.0)]), Point(i, -i)
+
+
+class LayerAsDataframeTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        memory = ogr_datasource(features(20), 'points', srs=4326)
+        ogr.GetDriverByName('ESRI Shapefile').CopyDataSource(memory, os.path.join(self.path, 'points.shp')).Destroy()
+        self.ds = ogr.Open(os.path.join(self.path, 'points.shp'))
+        self.lyr = self.ds.GetLayerByIndex(0)
+
+    def tearDown(self):
+        self.lyr = self.ds = None
+        shutil.rmtree(self.path)
+
+    def test_paging(self):
+        df = layer_as_dataframe(self.lyr, start=5, count=3)
+        self.assertListEqual(list(df['n']), [5, 6, 7])
+        self.assertEqual(df['geometry'][6].x, 6)
+
+        self.assertEqual(len(layer_as_dataframe(self.lyr, start=18)), 2)
+        self.assertEqual(len(layer_as_dataframe(self.lyr, start=25)), 0)
+
+    def test_filters_compose(self):
+        set_attribute_filter(self.lyr, {'n__gte': 4, 'n__lt': 10, 'name': 'feature 7'})
+        self.assertListEqual(list(layer_as_dataframe(self.lyr)['n']), [7])
+
+        set_attribute_filter(self.lyr, '{"n__gte": 10}')
+        df = layer_as_dataframe(self.lyr, start=2, count=3)
+        self.assertListEqual(list(df['n']), [12, 13, 14], msg='paging should count only features that pass the filter')
+
+    def test_columns(self):
+        df = layer_as_dataframe(self.lyr, columns=['x', 'n'])
+        self.assertListEqual(list(df.columns), ['x', 'n'])
+        self.assertEqual(len(df), 20)
+        self.assertEqual(df['x'][3], 1.5)
+
+        df = layer_as_dataframe(self.lyr, count=2, columns=['geometry', 'name'], lazy_geometry=True)
+        self.assertListEqual(list(df.columns), ['geometry', 'name'])
+        self.assertIsInstance(df['geometry'][0], str)
+
+        self.assertRaises(KeyError, layer_as_dataframe, self.lyr, columns=['nope'])
@@ -0,0 +1,77 @@
+from decimal import Decimal
+from unittest import TestCase
+import random
+
+import numpy
+
+from ga_resources.sketches import ColumnSketch, FrequentItems, HyperLogLog, Reservoir, hash_numbers, hash_strings
+
+
+class SketchesTest(TestCase):
+    def test_hyperloglog(self):
+        hll = HyperLogLog()
+        hll.add_hashes(hash_numbers(numpy.arange(50000)))
+        hll.add_hashes(hash_numbers(numpy.arange(50000)))  # repeats don't count
+        self.assertLess(abs(hll.estimate() - 50000) / 50000, 4 * hll.relative_error)
+
+        hll = HyperLogLog()
+        hll.add_hashes(hash_strings([unicode(i % 300) for i in range(10000)]))
+        self.assertLess(abs(hll.estimate() - 300) / 300, 4 * hll.relative_error)
+
+    def test_reservoir_quantiles(self):
+        reservoir = Reservoir(k=2000)
+        for i in range(100):
+            reservoir.add(numpy.arange(i * 1000, (i + 1) * 1000))
+
+        median, = reservoir.quantiles([50])
+        self.assertLess(abs(median - 50000) / 100000.0, 3 * reservoir.rank_error())
+
+    def test_frequent_items(self):
+        frequent = FrequentItems(k=10)
+        frequent.add(['a'] * 500 + range(300))
+        frequent.add(['b'] * 200 + range(300, 500))
+
+        top, freq = frequent.top()
+        self.assertEqual(top, 'a')
+        self.assertLessEqual(500 - freq, frequent.error)
+
+    def test_column_summary(self):
+        sketch = ColumnSketch()
+        for i in range(10):
+            sketch.add(range(i * 100, (i + 1) * 100) + [None])
+
+        summary = sketch.summary('x', fraction=0.5)
+        self.assertEqual(summary['kind'], 'number')
+        self.assertEqual(summary['count'], 2000, msg='counts should be scaled up by the sampling fraction')
+        self.assertIn('count', summary['error'])
+        self.assertEqual(summary['min'], 0)
+        self.assertEqual(summary['max'], 999)
+        self.assertIn('null', summary['tags'])
+
+    def test_decimals_are_numbers(self):
+        sketch = ColumnSketch()
+        sketch.add([Decimal('1.5'), Decimal('2.5'), 5, None])
+
+        summary = sketch.summary('x')
+        self.assertEqual(summary['kind'], 'number')
+        self.assertEqual(summary['mean'], 3.0)
+
+    def test_block_sample(self):
+        blocks, rows = ColumnSketch(), ColumnSketch()
+        for b in random.sample(range(2000), 40):  # rows of a block are alike, so 40 blocks say less than 2000 rows
+            values = [b + random.random() for _ in range(50)]
+            blocks.add(values)
+            blocks.end_block()
+            rows.add(values)
+
+        clustered, independent = blocks.summary('x', fraction=0.02), rows.summary('x', fraction=0.02)
+        self.assertEqual(clustered['mean'], independent['mean'])
+        self.assertGreater(clustered['error']['mean'], 3 * independent['error']['mean'])
+        self.assertGreater(clustered['error']['quantile_rank'], 3 * independent['error']['quantile_rank'])
+
+        single = ColumnSketch()
+        single.add([1, 2, 3])
+        single.end_block()
+        errors = single.summary('x', fraction=0.5)['error']
+        self.assertIsNone(errors['mean'], msg='one block gives no estimate of the variation between blocks')
+        self.assertIsNone(errors['count'])
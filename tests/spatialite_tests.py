@@ -1,7 +1,8 @@
 from unittest import TestCase
 
 from . import utils
-from ga_resources.drivers.spatialite import SpatialiteDriver
+from ga_resources.drivers import decode_geometry
+from ga_resources.drivers.spatialite import SpatialiteDriver, find_generalized_tables
 from ga_resources.models import DataResource
 from osgeo import osr
 import pandas
@@ -36,14 +37,86 @@ class SpatialiteTest(TestCase):
         self.assertIsInstance(df, pandas.DataFrame, msg='dataframe is wrong type {df}'.format(df=type(df)))
         self.assertGreaterEqual(df.shape[0], 100, msg='shape of dataframe is wrong: {shape}'.format(shape=df.shape))
 
+    def test_lazy_geometry_dataframe(self):
+        df = self.ds.resource.as_dataframe()
+        lazy = self.ds.resource.as_dataframe(lazy_geometry=True)
+
+        self.assertEqual(df.shape, lazy.shape)
+        decode_geometry(lazy)
+        self.assertTrue(lazy['geometry'][0].equals(df['geometry'][0]))
+
+    def test_iter_features(self):
+        df = self.ds.resource.as_dataframe(count=20)
+        features = list(self.ds.resource.iter_features(count=20))
+
+        self.assertEqual(len(features), len(df))
+        properties, geometry = features[0]
+        self.assertTrue(geometry.equals(df['geometry'][0]))
+        self.assertEqual(properties.keys(), [c for c in df.columns if c != 'geometry'])
+
+        rounded = list(self.ds.resource.iter_features(count=1, precision=0))[0][1]
+        self.assertEqual(rounded.bounds, tuple(round(b) for b in rounded.bounds))
+
+    def test_iter_features_reprojected(self):
+        from shapely.ops import transform
+        from ga_resources.spatialrefs import transform_points
+
+        native = self.ds.srs
+        minx, miny, maxx, maxy = list(self.ds.resource.iter_features(count=1))[0][1].buffer(1000).bounds
+        xs, ys = transform_points([minx, maxx], [miny, maxy], native, 4326)
+        bbox = (xs[0], ys[0], xs[1], ys[1])
+
+        expected = list(self.ds.resource.iter_features(bbox=(minx, miny, maxx, maxy)))
+        features = list(self.ds.resource.iter_features(srs=4326, bbox=bbox))
+        self.assertGreater(len(features), 0)
+        self.assertGreaterEqual(len(features), len(expected))
+
+        by_properties = dict((tuple(p.items()), g) for p, g in features)
+        for properties, geometry in expected:
+            once = transform(lambda x, y: transform_points(x, y, native, 4326), geometry)
+            self.assertTrue(by_properties[tuple(properties.items())].almost_equals(once, decimal=6),
+                            msg='features should be reprojected exactly once')
+
     def test_summary(self):
         summary = self.ds.resource.summary()
         self.assertIsNotNone(summary)
 
+    def test_approximate_summary(self):
+        exact = dict((c['name'], c) for c in self.ds.resource.summary())
+        approximate = dict((c['name'], c) for c in self.ds.resource.approximate_summary(sample=1.0))
+
+        self.assertSetEqual(set(exact.keys()), set(approximate.keys()))
+        for name, column in approximate.items():
+            self.assertTrue(column['approximate'])
+            self.assertEqual(column['count'], exact[name]['count'])
+
+        sampled = self.ds.resource.approximate_summary(sample=0.5)
+        self.assertTrue(all(column['sample'] == 0.5 for column in sampled))
+
+    def test_sample_clause_is_bounded(self):
+        from ga_resources.drivers.spatialite import SAMPLE_BLOCKS
+
+        table = self.ds.resource._table()[0]
+        total = self.ds.resource._connection().execute('select count(*) from {table}'.format(table=table)).fetchone()[0]
+        clause = self.ds.resource._sample_clause(table, 1.0, block_size=1)
+        self.assertLessEqual(clause.count(' OR ') + 1, SAMPLE_BLOCKS)
+
+        sampled = self.ds.resource._connection().execute('select count(*) from {table} as w where {clause}'.format(
+            table=table, clause=self.ds.resource._sample_clause(table, 0.5, block_size=1))).fetchone()[0]
+        self.assertGreater(sampled, 0)
+        self.assertLess(sampled, total)
+
     def test_add_column(self):
         self.ds.resource.add_column('new_column', 'TEXT')
         self.assertIn('new_column', self.ds.resource.schema())
 
+    def test_schema_cache(self):
+        self.ds.resource.schema()
+        self.ds.resource.full_schema()
+        self.ds.resource.add_column('cached_column', 'TEXT')
+        self.assertIn('cached_column', self.ds.resource.schema(), msg='add_column should invalidate the cached schema')
+        self.assertIn('cached_column', self.ds.resource.full_schema())
+
     def test_get_row(self):
         row = self.ds.resource.get_row(1, geometry_format='geojson')
         wkt_row = self.ds.resource.get_row(1, geometry_format='wkt')
@@ -96,6 +169,17 @@ class SpatialiteTest(TestCase):
 
         self.ds.resource.get_data_for_point(0, 0, self.ds.srs, 0) # shouldn't throw an exception just because we don't get data
 
+    def test_get_data_for_points(self):
+        centroids = [geom_from_wkt(self.ds.resource.get_row(fid, geometry_format='wkt')['GEOMETRY']).representative_point() for fid in (1, 2, 3)]
+        points = [(p.x, p.y) for p in centroids] + [(0, 0)]
+
+        batch = self.ds.resource.get_data_for_points(points, self.ds.srs)
+        self.assertEqual(len(batch), len(points))
+        for (x, y), found in zip(points, batch):
+            single = self.ds.resource.get_data_for_point(x, y, self.ds.srs, 0)
+            self.assertListEqual(sorted(r['OGC_FID'] for r in found), sorted(r['OGC_FID'] for r in single))
+        self.assertListEqual(batch[-1], [], msg='a point off the layer should match nothing')
+
     def test_get_rows(self):
         rc1_10 = self.ds.resource.get_rows(ogc_fid_start=1, ogc_fid_end=10, limit=None, geometry_format='wkt')
         rc91_100 = self.ds.resource.get_rows(ogc_fid_start=91, ogc_fid_end=100, limit=None, geometry_format='wkt')
@@ -269,6 +353,37 @@ class SpatialiteTest(TestCase):
         self.assertGreaterEqual(len(geom_only), 1, msg='no results from the geometry query')
 
 
+    def test_simplified_query(self):
+        full = self.ds.resource.query(OGC_FID__eq=1, geometry_format='wkt')[0]['GEOMETRY']
+        simplified = self.ds.resource.query(OGC_FID__eq=1, geometry_format='wkt', zoom=4)[0]['GEOMETRY']
+        self.assertLess(len(geom_from_wkt(simplified).wkb), len(geom_from_wkt(full).wkb),
+                        msg='simplifying at a low zoom should drop vertices')
+
+        rounded = self.ds.resource.query(OGC_FID__eq=1, geometry_format='geojson', precision=2)[0]['GEOMETRY']
+        x = rounded['coordinates'][0][0][0] if rounded['type'] == 'Polygon' else rounded['coordinates'][0][0][0][0]
+        self.assertEqual(x, round(x, 2))
+
+    def test_generalized_tables(self):
+        generalized = self.ds.resource.generalized_table(4)
+        self.assertIsNotNone(generalized, msg='ingest should build generalized tables for polygons')
+        self.assertIsNone(self.ds.resource.generalized_table(30), msg='no table is generalized for very close zooms')
+
+        _, _, conn = self.ds.resource.ready_data_resource(zoom=4)
+        self.assertEqual(conn['geometry_table'], generalized)
+
+        full = self.ds.resource.query(OGC_FID__eq=2, geometry_format='wkt')[0]['GEOMETRY']
+        coarse = self.ds.resource.query(OGC_FID__eq=2, geometry_format='wkt', zoom=4)[0]['GEOMETRY']
+        self.assertLessEqual(len(geom_from_wkt(coarse).wkb), len(geom_from_wkt(full).wkb))
+
+        connection = self.ds.resource._connection()
+        table = self.ds.resource._tablename
+        connection.execute('create table {table}_z99 (OGC_FID INTEGER PRIMARY KEY)'.format(table=table))
+        try:
+            self.assertNotIn(99, dict(find_generalized_tables(connection, table)),
+                             msg='only tables made as generalized copies should be taken for them')
+        finally:
+            connection.execute('drop table {table}_z99'.format(table=table))
+
     def test_mbr_query(self):
         row = self.ds.resource.get_row(1, geometry_format='wkt')
         geom = geom_from_wkt(row['GEOMETRY'])
@@ -299,6 +414,60 @@ class SpatialiteTest(TestCase):
         self.assertEqual(should_be_row1[0]['objectid'], 1, msg='limited query should have returned FID 1, returned {n}'.format(n=should_be_row1[0]['objectid']))
         self.assertGreaterEqual(len(objects), 1, msg='unlimited query returned only one object. should have returned several')
 
+    def test_indexed_distance_query(self):
+        row1 = self.ds.resource.get_row(1, geometry_format='wkt')
+        row2 = self.ds.resource.get_row(2, geometry_format='wkt')
+        g1 = geom_from_wkt(row1['GEOMETRY'])
+        g2 = geom_from_wkt(row2['GEOMETRY']).centroid
+        min_d = g2.distance(g1)
+
+        nearby = self.ds.resource.query(
+            query_geometry=g2.wkt,
+            geometry_operator='distance::le:{d}'.format(d=min_d + 1)
+        )
+        self.assertIn(1, [r['OGC_FID'] for r in nearby], msg='index-prefiltered distance query lost a row within range')
+        self.assertIn(2, [r['OGC_FID'] for r in nearby], msg='index-prefiltered distance query lost the containing row')
+
+    def test_nearest_query(self):
+        g2 = geom_from_wkt(self.ds.resource.get_row(2, geometry_format='wkt')['GEOMETRY']).centroid
+        everything = self.ds.resource.query(only=['OGC_FID', 'GEOMETRY'], geometry_format='wkt')
+        expected = sorted(everything, key=lambda r: g2.distance(geom_from_wkt(r['GEOMETRY'])))[:5]
+
+        nearest = self.ds.resource.query(query_geometry=g2.wkt, geometry_operator='nearest:5', geometry_format='wkt')
+        self.assertEqual(len(nearest), 5)
+        self.assertEqual(nearest[0]['OGC_FID'], 2, msg='the feature containing the point should be nearest')
+        distances = [g2.distance(geom_from_wkt(r['GEOMETRY'])) for r in nearest]
+        self.assertListEqual(distances, sorted(distances), msg='nearest rows should be ordered by distance')
+        self.assertAlmostEqual(distances[-1], g2.distance(geom_from_wkt(expected[-1]['GEOMETRY'])))
+
+        self.assertRaises(ValueError, self.ds.resource.query, geometry_operator='nearest:5')
+
+
+    def test_aggregate(self):
+        total = self.ds.resource.aggregate()
+        self.assertEqual(len(total), 1, msg='ungrouped aggregate should return one row, returned {n}'.format(n=len(total)))
+        self.assertGreaterEqual(total[0]['count'], 100)
+
+        by_county = self.ds.resource.aggregate(
+            aggregates=(('count', '*'), ('sum', 'shape_area')),
+            group_by=['county'],
+            county__startswith='Al'
+        )
+        self.assertListEqual(
+            sorted(r['county'] for r in by_county),
+            ['Alamance', 'Alexander', 'Alleghany'],
+            msg='grouped aggregate returned {r}'.format(r=by_county)
+        )
+        self.assertIn('sum_shape_area', by_county[0])
+
+        cells = self.ds.resource.aggregate(grid=100000)
+        self.assertEqual(sum(r['count'] for r in cells), total[0]['count'], msg='grid cells should partition the rows')
+
+    def test_column_distribution(self):
+        result = self.ds.resource.column_distribution('shape_area', classes=4)
+        self.assertGreaterEqual(result['count'], 100)
+        self.assertEqual(len(result['breaks']['jenks']), 5)
+        self.assertEqual(sum(result['histogram']['counts']), result['count'])
 
     def test_schema(self):
         schema = self.ds.resource.schema()
@@ -406,6 +575,57 @@ class SpatialiteTest(TestCase):
             name=row['name']
         ))
 
+    def test_summary_follows_edits(self):
+        ds2 = SpatialiteDriver.create_dataset('summary test dataset', columns_definitions=(
+            ('name', "TEXT"),
+            ('i', 'INTEGER'),
+        ))
+        ds2.resource.add_rows([
+            {'name': 'a', 'i': 1, 'GEOMETRY': 'POINT(0 0)'},
+            {'name': 'b', 'i': 2, 'GEOMETRY': 'POINT(1 1)'},
+            {'name': 'c', 'i': 3, 'GEOMETRY': 'POINT(2 2)'},
+        ])
+        ds2.resource.summary()
+
+        ds2.resource.add_row(name='d', i=4, GEOMETRY='POINT(3 3)')
+        ds2.resource.update_row(2, i=5)
+        self.assertTrue(ds2.resource.has_cached_summary(), msg='edits should update the cached summary, not drop it')
+
+        summary = dict((c['name'], c) for c in ds2.resource.summary())
+        self.assertEqual(summary['i']['count'], 4)
+        self.assertEqual(summary['i']['max'], 5)
+        self.assertAlmostEqual(summary['i']['mean'], (1 + 5 + 3 + 4) / 4.0)
+        self.assertIn('unique', summary['name']['tags'])
+
+        ds2.resource.delete_row(1)  # removes the minimum, which can't be folded in
+        self.assertFalse(ds2.resource.has_cached_summary())
+        summary = dict((c['name'], c) for c in ds2.resource.summary())
+        self.assertEqual(summary['i']['min'], 3)
+
+    def test_bulk_rows(self):
+        ds2 = SpatialiteDriver.create_dataset('bulk test dataset', columns_definitions=(
+            ('name', "TEXT"),
+            ('i', 'INTEGER'),
+        ))
+        new_ids = ds2.resource.add_rows([
+            {'name': 'a', 'i': 1, 'GEOMETRY': 'POINT(0 0)'},
+            {'name': 'b', 'i': 2, 'GEOMETRY': 'POINT(1 1)'},
+            {'name': 'c', 'i': 3, 'GEOMETRY': 'POINT(2 2)'},
+        ])
+        self.assertListEqual(new_ids, [1, 2, 3], msg='bulk add returned ids {ids}'.format(ids=new_ids))
+        self.assertEqual(ds2.resource.get_row(2)['name'], 'b')
+        self.assertEqual(ds2.resource.extent_of_rows(new_ids), (0.0, 0.0, 2.0, 2.0))
+
+        updated = ds2.resource.update_rows([{'OGC_FID': 1, 'name': 'aa'}, {'OGC_FID': 3, 'i': 30}, {'OGC_FID': 2},
+                                            {'OGC_FID': 99, 'name': 'nobody'}])
+        self.assertListEqual(sorted(updated), [1, 3], msg='only rows that changed should be reported as updated')
+        self.assertEqual(ds2.resource.get_row(1)['name'], 'aa')
+        self.assertEqual(ds2.resource.get_row(3)['i'], 30)
+
+        ds2.resource.delete_rows([1, 2])
+        rs = ds2.resource.get_rows(1, limit=100)
+        self.assertEqual(len(rs), 1, msg='bulk delete left {n} rows'.format(n=len(rs)))
+
 
 
 
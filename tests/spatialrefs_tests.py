@@ -0,0 +1,80 @@
+from unittest import TestCase
+import threading
+
+from osgeo import osr
+
+from ga_resources import spatialrefs
+from ga_resources.spatialrefs import proj4, spatial_reference, transformation, transform_point, transform_points
+
+
+class SpatialReferenceRegistryTest(TestCase):
+    def test_memoized(self):
+        self.assertIs(spatial_reference(4326), spatial_reference('EPSG:4326'))
+        self.assertIs(spatial_reference('epsg:4326'), spatial_reference(4326))
+        self.assertIs(transformation(4326, 3857), transformation('EPSG:4326', spatial_reference(3857)))
+
+        merc = spatial_reference(3857).ExportToProj4()
+        self.assertIs(spatial_reference(merc), spatial_reference(merc))
+        self.assertEqual(proj4(merc), merc)
+
+    def test_transformations_are_per_thread(self):
+        other = []
+        thread = threading.Thread(target=lambda: other.append(transformation(4326, 3857)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], transformation(4326, 3857))
+
+    def test_transform_points(self):
+        xs, ys = transform_points([-79.0, -78.5, 0.0], [35.9, 35.7, 0.0], 4326, 3857)
+        for x, y, lon, lat in zip(xs, ys, [-79.0, -78.5, 0.0], [35.9, 35.7, 0.0]):
+            x1, y1 = transform_point(lon, lat, 4326, 3857)
+            self.assertAlmostEqual(x, x1)
+            self.assertAlmostEqual(y, y1)
+
+        xs, ys = transform_points([], [], 4326, 3857)
+        self.assertEqual(len(xs), 0)
+
+    def test_foreign_references(self):
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+        self.assertIs(spatial_reference(srs), srs)
+        x, y = transform_point(-79.0, 35.9, srs, 3857)
+        x1, y1 = transform_point(-79.0, 35.9, 4326, 3857)
+        self.assertAlmostEqual(x, x1)
+        self.assertAlmostEqual(y, y1)
+
+    def test_epsg_uris(self):
+        for uri in ('urn:ogc:def:crs:EPSG::3857', 'urn:x-ogc:def:crs:EPSG:3857', 'http://www.opengis.net/def/crs/EPSG/0/3857',
+                    'http://www.opengis.net/gml/srs/epsg.xml#3857'):
+            self.assertIs(spatial_reference(uri), spatial_reference(3857))
+
+    def test_unrecognized(self):
+        self.assertRaises(ValueError, spatial_reference, 'not a coordinate system')
+        self.assertRaises(ValueError, spatial_reference, 'EPSG:999999')
+        self.assertNotIn('not a coordinate system', spatialrefs._references, msg='failures should not be cached')
+
+    def test_definitions_are_bounded(self):
+        size, spatialrefs.SPATIAL_REFERENCE_CACHE_SIZE = spatialrefs.SPATIAL_REFERENCE_CACHE_SIZE, 2
+        try:
+            spatial_reference(4326)
+            definitions = ['+proj=longlat +datum=WGS84 +lon_0={0} +no_defs'.format(n) for n in range(3)]
+            for definition in definitions:
+                spatial_reference(definition)
+            self.assertNotIn(definitions[0], spatialrefs._references)
+            self.assertIn(definitions[2], spatialrefs._references)
+            self.assertIn('EPSG:4326', spatialrefs._references, msg='EPSG codes are kept')
+        finally:
+            spatialrefs.SPATIAL_REFERENCE_CACHE_SIZE = size
+
+
+class ZoomUnitsTest(TestCase):
+    def test_feet(self):
+        from ga_resources.drivers import scale_zoom, zoom_tolerance
+
+        metres = spatial_reference(32617)  # UTM 17N
+        feet = spatial_reference(2264)  # North Carolina state plane, US survey feet
+        self.assertAlmostEqual(zoom_tolerance(10, feet), zoom_tolerance(10, metres) / feet.GetLinearUnits())
+
+        width = 256 * 156543.03 / 2 ** 10  # a zoom 10 tile, in metres
+        self.assertEqual(scale_zoom((0, 0, width, width), 256, 32617), 10)
+        self.assertEqual(scale_zoom((0, 0, width / feet.GetLinearUnits(), 1), 256, 2264), 10)
@@ -0,0 +1,49 @@
+from unittest import TestCase
+import sqlite3
+
+from ga_resources.drivers.sql import attribute_filter, attribute_filters, literal, numbered_parameters
+
+
+class AttributeFilterTest(TestCase):
+    def test_values_are_bound(self):
+        self.assertEqual(attribute_filter('name', "o'brien"), ('"name" = %s', ["o'brien"]))
+        self.assertEqual(attribute_filter('n__gte', 3, placeholder='?'), ('"n" >= ?', [3]))
+        self.assertEqual(attribute_filter('name__icontains', '50%_off'),
+                         ('"name" ILIKE %s ESCAPE \'\\\'', ['%50\\%\\_off%']))
+        self.assertEqual(attribute_filter('name__istartswith', 'a', placeholder='?', ilike='LIKE')[0],
+                         '"name" LIKE ? ESCAPE \'\\\'')
+        self.assertRaises(ValueError, attribute_filter, 'name__regex', 'a')
+
+    def test_in(self):
+        self.assertEqual(attribute_filter('n__in', [1, 2, 3], arrays=True), ('"n" = ANY(%s)', [[1, 2, 3]]))
+        self.assertEqual(attribute_filter('n__in', '(a, b)', placeholder='?'), ('"n" IN (?, ?)', ['a', 'b']))
+        self.assertEqual(attribute_filter('n__in', []), ('1 = 0', []))
+
+    def test_statement_depends_only_on_shape(self):
+        a = attribute_filters({'name__startswith': 'x', 'n__lt': 1})
+        b = attribute_filters({'n__lt': 100, 'name__startswith': 'y'})
+        self.assertEqual(a[0], b[0])
+        self.assertEqual(b[1], [100, 'y%'])
+
+    def test_literals(self):
+        self.assertEqual(attribute_filter('name', "o'brien", placeholder=literal), ('"name" = \'o\'\'brien\'', []))
+        self.assertEqual(attribute_filter('n__in', [1, 2.5], placeholder=literal)[0], '"n" IN (1, 2.5)')
+        self.assertEqual(literal(None), 'NULL')
+
+    def test_numbered_parameters(self):
+        self.assertEqual(numbered_parameters("select * from t where a = %s and b like '%%x' and c < %s"),
+                         ("select * from t where a = $1 and b like '%x' and c < $2", 2))
+        self.assertIsNone(numbered_parameters('select * from t where a = %(a)s'))
+
+    def test_filters_run_in_sqlite(self):
+        connection = sqlite3.connect(':memory:')
+        connection.execute('create table t (name text, n integer)')
+        connection.executemany('insert into t values (?, ?)', [("o'brien", 1), ('50% off', 2), ('500 off', 3)])
+
+        def names(**query):
+            where, values = attribute_filters(query, placeholder='?', ilike='LIKE')
+            return sorted(r[0] for r in connection.execute('select name from t where ' + where, values))
+
+        self.assertEqual(names(name="o'brien"), ["o'brien"])
+        self.assertEqual(names(name__startswith='50%'), ['50% off'])
+        self.assertEqual(names(name__icontains='OFF', n__in=[2, 3]), ['50% off', '500 off'])
@@ -0,0 +1,103 @@
+"""
+Time the same row lookups with their values spliced into the sql, as the drivers used to build them, and bound as
+parameters, so that the database can reuse each statement's parse and plan.
+
+    python -m ga_resources.tests.statement_benchmark [lookups]
+
+sqlite is timed on an in-memory table.  If django is configured with a PostgreSQL database, PostGISDriver's prepared
+statements are timed against it too.
+"""
+from __future__ import print_function
+import sqlite3
+import sys
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from ga_resources.drivers.sql import literal
+
+ROWS = 10000
+SELECT = 'select name, n, x from benchmark where {where}'
+FILTERS = ('n = {0}', 'name = {0}', 'x >= {0}', 'n >= {0}')
+
+
+def _timed(run, lookups):
+    began = time.time()
+    for i in range(lookups):
+        run(i)
+    return time.time() - began
+
+
+def _values(i):
+    return [i % ROWS, 'row {0}'.format(i % ROWS), float(ROWS - 100), ROWS - 2]
+
+
+def benchmark_sqlite(lookups):
+    connection = sqlite3.connect(':memory:')
+    connection.execute('create table benchmark (id INTEGER PRIMARY KEY, name text, n integer, x real)')
+    connection.executemany('insert into benchmark (name, n, x) values (?, ?, ?)',
+                           [('row {0}'.format(i), i, float(i)) for i in range(ROWS)])
+    connection.execute('create index benchmark_n on benchmark (n)')
+    connection.execute('create index benchmark_name on benchmark (name)')
+    where = ' and '.join(FILTERS)
+
+    def spliced(i):
+        connection.execute(SELECT.format(where=where.format(*[literal(v) for v in _values(i)]))).fetchall()
+
+    bound_statement = SELECT.format(where=where.format(*['?'] * len(FILTERS)))
+
+    def bound(i):
+        connection.execute(bound_statement, _values(i)).fetchall()
+
+    return _timed(spliced, lookups), _timed(bound, lookups)
+
+
+def benchmark_postgis(lookups):
+    from ga_resources.drivers import postgis
+    from ga_resources.tests.postgis_tests import local_config
+
+    cfg = local_config()
+    if cfg is None:
+        return None
+    connection = postgis.pooled_connection(cfg)
+    c = connection.cursor()
+    c.execute('create temporary table benchmark (id serial primary key, name text, n integer, x float8)')
+    c.execute("insert into benchmark (name, n, x) select 'row ' || i, i, i from generate_series(0, %s) as i", [ROWS - 1])
+    c.execute('create index on benchmark (n)')
+    c.execute('create index on benchmark (name)')
+    c.execute('analyze benchmark')
+    where = ' and '.join(FILTERS)
+
+    def spliced(i):
+        c.execute(SELECT.format(where=where.format(*[literal(v) for v in _values(i)])))
+        c.fetchall()
+
+    bound_statement = SELECT.format(where=where.format(*['%s'] * len(FILTERS)))
+
+    def prepared(i):
+        postgis.execute(c, bound_statement, _values(i))
+        c.fetchall()
+
+    try:
+        return _timed(spliced, lookups), _timed(prepared, lookups)
+    finally:
+        postgis.release_connections()
+
+
+def main(lookups=5000):
+    for name, benchmark in (('sqlite', benchmark_sqlite), ('postgis', benchmark_postgis)):
+        try:
+            timings = benchmark(lookups)
+        except (ImportError, ImproperlyConfigured) as e:
+            print('{name}: skipped, {e}'.format(name=name, e=e))
+            continue
+        if timings is None:
+            print('{name}: skipped, no PostgreSQL database configured'.format(name=name))
+            continue
+        spliced, bound = timings
+        print('{name}: {lookups} lookups, values in the sql {spliced:.3f}s, bound parameters {bound:.3f}s ({ratio:.1f}x)'.format(
+            name=name, lookups=lookups, spliced=spliced, bound=bound, ratio=spliced / bound))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
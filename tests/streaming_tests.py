@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from unittest import TestCase
+import json
+
+import numpy
+from shapely.geometry import Point
+
+from ga_resources.streaming import geojson_collection, gml_collection, ogr_datasource, xml_name
+
+
+def features(n):
+    for i in range(n):
+        yield OrderedDict([('name', u'feature <{0}>'.format(i)), ('n', i), ('x', i / 2.0)]), Point(i, -i)
+    yield OrderedDict([('name', None), ('n', None), ('x', None)]), None
+
+
+class StreamingTest(TestCase):
+    def test_geojson(self):
+        chunks = list(geojson_collection(features(5), batch_size=2))
+        self.assertEqual(len(chunks), 5)  # header, three batches of features, footer
+
+        collection = json.loads(''.join(chunks))
+        self.assertEqual(len(collection['features']), 6)
+        self.assertEqual(collection['features'][3]['geometry'], {'type': 'Point', 'coordinates': [3.0, -3.0]})
+        self.assertEqual(collection['features'][3]['properties']['name'], 'feature <3>')
+        self.assertIsNone(collection['features'][5]['geometry'])
+
+        self.assertEqual(json.loads(''.join(geojson_collection([])))['features'], [])
+
+    def test_gml(self):
+        gml = ''.join(gml_collection(features(3), 'my layer', 'http://example.com/schema', srs=4326))
+        self.assertEqual(gml.count('<gml:featureMember>'), 4)
+        self.assertIn('<ga_resources:name>feature &lt;2&gt;</ga_resources:name>', gml)
+        self.assertIn('fid="my layer.1"', gml)
+        self.assertIn('<ga_resources:my_layer ', gml)
+        self.assertIn('<gml:Point', gml)
+
+    def test_nan_is_null(self):
+        nan = [(OrderedDict([('x', numpy.float64('nan')), ('y', numpy.float32('nan')), ('n', 1)]), Point(0, 0))]
+
+        properties = json.loads(''.join(geojson_collection(nan)))['features'][0]['properties']
+        self.assertEqual(properties, {'x': None, 'y': None, 'n': 1})
+
+        gml = ''.join(gml_collection(nan, 'layer', 'http://example.com/schema'))
+        self.assertNotIn('<ga_resources:x>', gml)
+        self.assertIn('<ga_resources:n>1</ga_resources:n>', gml)
+
+    def test_xml_name(self):
+        self.assertEqual(xml_name('a b:c'), 'a_b_c')
+        self.assertEqual(xml_name('2010'), '_2010')
+
+    def test_ogr_datasource(self):
+        ds = ogr_datasource(features(4), 'layer', srs=4326)
+        layer = ds.GetLayerByIndex(0)
+        self.assertEqual(layer.GetFeatureCount(), 5)
+        feature = layer.GetFeature(2)
+        self.assertEqual(feature.GetField('name'), 'feature <2>')
+        self.assertEqual(feature.GetField('n'), 2)
+        self.assertEqual(feature.GetField('x'), 1.0)
+        self.assertEqual(feature.GetGeometryRef().GetX(), 2.0)
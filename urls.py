@@ -5,6 +5,7 @@ urlpatterns = patterns('',
     url(r'^api/', include(api.api.urls)),
     url(r'^wms/', views.WMS.as_view()),
     url(r'^(?P<layer>.*)/tms/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)/', views.tms),
+    url(r'^(?P<layer>.*)/mvt/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)/', views.vector_tile),
     url(r'^wfs/', views.WFS.as_view()),
     url(r'^download/(?P<slug>.*)$', views.download_file),
     url(r'^createpage/', views.create_page),
@@ -34,7 +35,11 @@ urlpatterns = patterns('',
     url(r'^q/(?P<slug>[a-z0-9\-/]+)/query/(?P<x1>[0-9\-.]+),(?P<y1>[0-9\-.]+),(?P<x2>[0-9\-.]+),(?P<y2>[0-9\-.]+)(?P<srid>;[0-9]+)?/',
         views.query),
     url(r'^q/(?P<slug>[a-z0-9\-/]+)/query/', views.query),
+    url(r'^q/(?P<slug>[a-z0-9\-/]+)/aggregate/', views.aggregate),
+    url(r'^q/(?P<slug>[a-z0-9\-/]+)/distribution/(?P<column>[^/]+)/', views.distribution),
+    url(r'^q/(?P<slug>[a-z0-9\-/]+)/points/', views.points),
     url(r'^q/(?P<slug>[a-z0-9\-/]+)/add_column/', views.add_column),
+    url(r'^q/(?P<slug>[a-z0-9\-/]+)/bulk/', views.BulkCRUDView.as_view()),
     url(r'^q/(?P<slug>[a-z0-9\-/]+)/(?P<ogc_fid>[0-9]+)/', views.CRUDView.as_view()),
     url(r'^q/(?P<slug>[a-z0-9\-/]+)/(?P<ogc_fid_start>[0-9]+):(?P<ogc_fid_end>[0-9]+)/', views.CRUDView.as_view()),
     url(r'^q/(?P<slug>[a-z0-9\-/]+)/(?P<ogc_fid_start>[0-9]+),(?P<limit>[0-9]+)/', views.CRUDView.as_view()),
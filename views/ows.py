@@ -1,13 +1,26 @@
 import json
-from django.http import HttpResponse
+from wsgiref.util import FileWrapper
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from ga_ows.views import wms, wfs
 from ga_resources import models, dispatch
-from ga_resources.drivers import shapefile, render, CacheManager
+from ga_resources.cache import WFSResultCache
+from ga_resources.drivers import render, zoom_tolerance, CacheManager
 from ga_resources.models import RenderedLayer
+from ga_resources.spatialrefs import proj4, spatial_reference
+from ga_resources.streaming import geojson_collection, gml_collection, ogr_datasource
 from ga_resources.utils import authorize
-from matplotlib.finance import md5
-from osgeo import osr, ogr
+
+# WFS outputFormats that are encoded as the features are read, instead of by OGR from a finished datasource
+STREAMED_FORMATS = {
+    'json': 'geojson',
+    'geojson': 'geojson',
+    'application/json': 'geojson',
+    'gml': 'gml',
+    'gml2': 'gml',
+    'text/xml; subtype=gml/2.1.2': 'gml',
+}
+
 
 class WMSAdapter(wms.WMSAdapterBase):
     def layerlist(self):
@@ -23,9 +36,7 @@ class WMSAdapter(wms.WMSAdapterBase):
         """use the driver to get feature info"""
 
         if srs.lower().startswith('epsg'):
-            s = osr.SpatialReference()
-            s.ImportFromEPSG(int(srs[5:]))
-            srs = s.ExportToProj4()
+            srs = proj4(srs)
 
         feature_info = {
             layer: models.RenderedLayer.objects.get(slug=layer).data_resource.driver_instance.get_data_for_point(
@@ -160,6 +171,38 @@ class WFSAdapter(wfs.WFSAdapter):
         else:
             return self.AdHocQuery(request, **parms.cleaned_data)
 
+    def _feature_query(self, req, type_name, filter=None, bbox=None, srs_name=None, start_index=None, count=None,
+                       sort_by=None, boundary=None, boundary_type=None):
+        """The DataResource a query is for, and the arguments to its driver's iter_features"""
+        model = get_object_or_404(models.DataResource, slug=type_name)
+
+        extra = {}
+        if filter:
+            extra['query'] = json.loads(filter) if isinstance(filter, basestring) else filter
+        if bbox:
+            extra['bbox'] = bbox
+        extra['srs'] = spatial_reference(srs_name) if srs_name else model.srs
+        if start_index:
+            extra['start'] = int(start_index)
+        if count:
+            extra['count'] = int(count)
+        if sort_by:
+            extra['sort_by'] = sort_by
+        if boundary:
+            extra['boundary'] = boundary
+            extra['boundary_type'] = boundary_type
+
+        # vendor parameters for generalizing output to the scale it will be drawn at
+        tolerance = req.GET.get('tolerance', None)
+        zoom = req.GET.get('zoom', None)
+        precision = req.GET.get('precision', None)
+        if zoom and not tolerance:
+            tolerance = zoom_tolerance(int(zoom), model.srs)
+        extra['tolerance'] = float(tolerance) if tolerance else None
+        extra['precision'] = int(precision) if precision else None
+
+        return model, extra
+
     def AdHocQuery(self, req,
                    type_names=None,
                    filter=None,
@@ -173,57 +216,65 @@ class WFSAdapter(wfs.WFSAdapter):
                    max_features=None,
                    **kwargs
     ):
-        model = get_object_or_404(models.DataResource, slug=type_names[0])
-        driver = model.driver_instance
-
-        extra = {}
-        if filter:
-            extra['filter'] = json.loads(filter)
-
-        if bbox:
-            extra['bbox'] = bbox
-
-        if srs_name:
-            srs = osr.SpatialReference()
-            if srs_name.lower().startswith('epsg'):
-                srs.ImportFromEPSG(int(srs_name[5:]))
-            else:
-                srs.ImportFromProj4(srs_name)
-            extra['srs'] = srs
-        else:
-            srs = model.srs
-
-        if start_index:
-            extra['start'] = start_index
-
-        count = count or max_features
-        if count:
-            extra['count'] = count
-
-        if "boundary" in kwargs:
-            extra['boundary'] = kwargs['boundary']
-            extra['boundary_type'] = kwargs['boundary_type']
-
-        df = driver.as_dataframe(**extra)
-
-        if sort_by:
-            extra['sort_by'] = sort_by
-
         if filter_language and filter_language != 'json':
             raise wfs.OperationNotSupported('filter language must be JSON for now')
 
-        filename = md5()
-
-        filename.update("{name}.{bbox}.{srs_name}x{filter}".format(
-            name=type_names[0],
-            bbox=','.join(str(b) for b in bbox),
+        model, extra = self._feature_query(req, type_names[0],
+            filter=filter,
+            bbox=bbox,
             srs_name=srs_name,
-            filter=filter
-        ))
-        filename = filename.hexdigest()
-        shapefile.ShapefileDriver.from_dataframe(df, filename, srs)
-        ds = ogr.Open(filename)
-        return ds
+            start_index=start_index,
+            count=count or max_features,
+            sort_by=sort_by,
+            boundary=kwargs.get('boundary', None),
+            boundary_type=kwargs.get('boundary_type', None)
+        )
+        return ogr_datasource(model.driver_instance.iter_features(**extra), model.slug, extra['srs'])
+
+    def stream_features(self, request):
+        """
+        Answer a KVP GetFeature request for GeoJSON or GML by encoding features as the driver reads them, or return
+        None for requests left to ga_ows.  Nothing the size of the result is built, in memory or on disk.
+        """
+        parms = dict((k.lower(), v) for k, v in request.GET.items())
+        output_format = STREAMED_FORMATS.get(parms.get('outputformat', '').lower(), None)
+        if parms.get('request', '').lower() != 'getfeature' or output_format is None or parms.get('storedquery_id') or \
+                parms.get('resulttype', 'results').lower() != 'results':
+            return None
+        if parms.get('filter_language', 'json') != 'json':
+            raise wfs.OperationNotSupported('filter language must be JSON for now')
+
+        type_name = (parms.get('typenames', None) or parms['typename']).split(',')[0].split(':')[-1]
+        bbox = [float(b) for b in parms['bbox'].split(',')[:4]] if parms.get('bbox') else None
+        sort_by = [c.split()[0] for c in parms['sortby'].split(',')] if parms.get('sortby') else None
+        model, extra = self._feature_query(request, type_name,
+            filter=parms.get('filter', None),
+            bbox=bbox,
+            srs_name=parms.get('srsname', None),
+            start_index=parms.get('startindex', None),
+            count=parms.get('count', None) or parms.get('maxfeatures', None),
+            sort_by=sort_by
+        )
+
+        if output_format == 'geojson':
+            content_type = 'application/json'
+        else:
+            content_type = 'text/xml; subtype=gml/2.1.2'
+            namespace = request.build_absolute_uri().split('?')[0] + "/schema"
+            parms['namespace'] = namespace
+
+        # desktop clients ask for the same layer over and over, so answer repeats from the result cache
+        results = WFSResultCache.get()
+        cached = results.open(model.slug, parms)
+        if cached is not None:
+            return StreamingHttpResponse(FileWrapper(cached), content_type=content_type)
+
+        features = model.driver_instance.iter_features(**extra)
+        if output_format == 'geojson':
+            encoded = geojson_collection(features)
+        else:
+            encoded = gml_collection(features, model.slug, namespace, extra['srs'])
+        return StreamingHttpResponse(results.store(model.slug, parms, encoded), content_type=content_type)
 
     def supports_feature_versioning(self):
         return False
@@ -232,6 +283,13 @@ class WFSAdapter(wfs.WFSAdapter):
 class WFS(wfs.WFS):
     adapter = WFSAdapter()
 
+    def dispatch(self, request, *args, **kwargs):
+        if request.method == 'GET':
+            response = self.adapter.stream_features(request)
+            if response is not None:
+                return response
+        return super(WFS, self).dispatch(request, *args, **kwargs)
+
 
 def tms(request, layer, z, x, y, **kwargs):
     z = int(z)
@@ -254,6 +312,15 @@ def tms(request, layer, z, x, y, **kwargs):
        return HttpResponse(str(e), mimetype='text/plain')
        
 
+def vector_tile(request, layer, z, x, y, **kwargs):
+    """A Mapbox vector tile of a layer whose driver supports them, from the tile cache or made by the database"""
+    tiles = CacheManager.get().get_vector_tile_cache([layer])
+    try:
+        return HttpResponse(tiles.fetch_tile(int(z), int(x), int(y)), mimetype='application/x-protobuf')
+    except NotImplementedError, e:
+        return HttpResponse(str(e), mimetype='text/plain', status=400)
+
+
 def seed_layer(request, layer):
     mnz = int(request.GET['minz'])
     mxz = int(request.GET['maxz']) # anything greater would cause a DOS attack.  We should do it manually
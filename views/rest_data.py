@@ -1,19 +1,22 @@
 from tempfile import NamedTemporaryFile
 import json
 
-from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.geos import GEOSGeometry, Polygon
 import pandas
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
 from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 from django.contrib.auth.models import User
+from ga_resources.drivers.postgis import PostGISDriver
 from ga_resources.drivers.spatialite import SpatialiteDriver
 from ga_resources.models import DataResource
 from mezzanine.pages.models import Page
 from tastypie.models import ApiKey
 from ga_resources import dispatch
+from ga_resources.cache import QueryResultCache, dataset_version
+from ga_resources.classification import CLASSIFICATION_METHODS
 from ga_resources.utils import authorize, get_data_page_for_user, json_or_jsonp
 
 
@@ -27,18 +30,66 @@ def get_user(request):
         return request.user
 
 
-def geojson_transform(request, data):
+def geojson_transform(request, data, geometry_field='GEOMETRY'):
     if request.REQUEST.get('format','wkt') == 'geojsonreal':
        if isinstance(data, list):
-            return { 'type' : 'FeatureCollection', 'features' : [{ 'type' : 'Feature', 'geometry' : feature['GEOMETRY'], 'properties' : feature } for feature in data] }
+            return { 'type' : 'FeatureCollection', 'features' : [{ 'type' : 'Feature', 'geometry' : feature[geometry_field], 'properties' : feature } for feature in data] }
        else:
-            return { 'type' : 'Feature', 'properties' : data, 'geometry' : data['GEOMETRY'] }
+            return { 'type' : 'Feature', 'properties' : data, 'geometry' : data[geometry_field] }
     else:
        return data
        
 
+def parse_features(body, schema, geometry_field='GEOMETRY', key_field='OGC_FID'):
+    """
+    Parse a bulk request body into a list of row dicts.  The body may be a JSON array or newline-delimited JSON.  Each
+    item is either a row in the same format add_row accepts or a GeoJSON Feature, whose geometry is converted to WKT and
+    whose id becomes the key_field.  Keys that aren't in the schema are dropped.
+    """
+    body = body.strip()
+    if body.startswith('['):
+        items = json.loads(body)
+    else:
+        items = [json.loads(line) for line in body.splitlines() if line.strip()]
+
+    rows = []
+    for item in items:
+        if isinstance(item, dict) and item.get('type', None) == 'Feature':
+            row = dict(item.get('properties', None) or {})
+            if item.get('geometry', None):
+                row[geometry_field] = GEOSGeometry(json.dumps(item['geometry'])).wkt
+            if item.get('id', None) is not None:
+                row[key_field] = item['id']
+        elif isinstance(item, dict):
+            row = dict(item)
+        else:
+            row = {key_field: item}  # bare ids are allowed for deletes
+        rows.append({k: v for k, v in row.items() if k in schema})
+    return rows
+
+
+def union_bbox(*extents):
+    """Union (xmin, ymin, xmax, ymax) extents, skipping Nones, into a Polygon suitable for shaving tile caches"""
+    extents = [e for e in extents if e]
+    if not extents:
+        return None
+    return Polygon.from_bbox((
+        min(e[0] for e in extents),
+        min(e[1] for e in extents),
+        max(e[2] for e in extents),
+        max(e[3] for e in extents)
+    ))
+
+
+
+DATASET_DRIVERS = {
+    'spatialite': SpatialiteDriver,
+    'postgis': PostGISDriver,
+}
+
 
 def create_dataset(request):
+    """Create an empty dataset.  The driver parameter picks where it is stored, spatialite (the default) or postgis"""
     user = authorize(request)
 
     title = request.REQUEST.get('title','Untitled dataset')
@@ -53,7 +104,11 @@ def create_dataset(request):
     else:
         parent = get_data_page_for_user(request.user)
 
-    ds = SpatialiteDriver.create_dataset(
+    driver = DATASET_DRIVERS.get(request.REQUEST.get('driver', 'spatialite'), None)
+    if driver is None:
+        return json_or_jsonp(request, {'error': 'unknown driver'}, code=400)
+
+    ds = driver.create_dataset(
         title=title,
         parent=parent,
         srid=srid,
@@ -191,7 +246,7 @@ def add_row(request, slug=None, *args, **kwargs):
         pass # just in case there's JSON in the payuload
 
     new_rec = ds.driver_instance.add_row(**row)
-    bbox = GEOSGeometry(row['GEOMETRY']).envelope
+    bbox = GEOSGeometry(row[ds.driver_instance._geometry_field]).envelope
 
     dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
     dispatch.features_created.send(sender=DataResource, instance=ds, user=user, count=1, bbox=bbox)
@@ -211,10 +266,11 @@ def update_row(request, slug=None, ogc_fid=None, *args, **kwargs):
     except:
         pass # just in case there's JSON in the payuload
 
+    driver = ds.driver_instance
     if ogc_fid is None:
-        ogc_fid = row['OGC_FID']
+        ogc_fid = row[driver._key_field]
 
-    bbox = GEOSGeometry(ds.driver_instance.get_row(int(ogc_fid), geometry_format='wkt')['GEOMETRY']).envelope
+    bbox = GEOSGeometry(driver.get_row(int(ogc_fid), geometry_format='wkt')[driver._geometry_field]).envelope
     result = ds.driver_instance.update_row(int(ogc_fid), **row)
     dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
     dispatch.features_updated.send(sender=DataResource, instance=ds, user=user, count=1, fid=ogc_fid, bbox=bbox)
@@ -223,8 +279,10 @@ def update_row(request, slug=None, ogc_fid=None, *args, **kwargs):
 @csrf_exempt
 def delete_row(request, slug=None, ogc_fid=None, *args, **kwargs):
     ds = get_object_or_404(DataResource, slug=slug)
-    bbox = GEOSGeometry(ds.driver_instance.get_row(int(ogc_fid), geometry_format='wkt')['GEOMETRY']).envelope
-    ds.driver_instance.delete_row(int(ogc_fid))
+    driver = ds.driver_instance
+    driver.ready_data_resource()
+    bbox = GEOSGeometry(driver.get_row(int(ogc_fid), geometry_format='wkt')[driver._geometry_field]).envelope
+    driver.delete_row(int(ogc_fid))
     user = authorize(request, ds, edit=True)
 
     dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
@@ -232,6 +290,67 @@ def delete_row(request, slug=None, ogc_fid=None, *args, **kwargs):
     return HttpResponse()
 
 
+@csrf_exempt
+def add_rows(request, slug=None, *args, **kwargs):
+    ds = get_object_or_404(DataResource, slug=slug)
+    user = authorize(request, ds, edit=True)
+    driver = ds.driver_instance
+    driver.ready_data_resource()
+
+    schema = set(driver.schema())
+    rows = parse_features(request.body, schema, driver._geometry_field, driver._key_field)
+    srid = request.REQUEST.get('srid', None)
+
+    new_ids = driver.add_rows(rows, srid=int(srid) if srid else None)
+    bbox = union_bbox(driver.extent_of_rows(new_ids))
+
+    dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
+    if new_ids:
+        dispatch.features_created.send(sender=DataResource, instance=ds, user=user, count=len(new_ids), bbox=bbox)
+    return json_or_jsonp(request, {driver._key_field: new_ids}, code=201)
+
+
+@csrf_exempt
+def update_rows(request, slug=None, *args, **kwargs):
+    ds = get_object_or_404(DataResource, slug=slug)
+    user = authorize(request, ds, edit=True)
+    driver = ds.driver_instance
+    driver.ready_data_resource()
+
+    schema = set(driver.schema())
+    key = driver._key_field
+    rows = [row for row in parse_features(request.body, schema, driver._geometry_field, key) if key in row]
+    srid = request.REQUEST.get('srid', None)
+
+    fids = [int(row[key]) for row in rows if set(row) - {key, 'srid'}]
+    before = driver.extent_of_rows(fids)  # tiles covering where the features were and where they are now are stale
+    updated = driver.update_rows(rows, srid=int(srid) if srid else None)
+    bbox = union_bbox(before, driver.extent_of_rows(updated))
+
+    dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
+    if updated:
+        dispatch.features_updated.send(sender=DataResource, instance=ds, user=user, count=len(updated), fid=updated, bbox=bbox)
+    return json_or_jsonp(request, {key: updated})
+
+
+@csrf_exempt
+def delete_rows(request, slug=None, *args, **kwargs):
+    ds = get_object_or_404(DataResource, slug=slug)
+    user = authorize(request, ds, edit=True)
+    driver = ds.driver_instance
+    driver.ready_data_resource()
+
+    key = driver._key_field
+    fids = [int(row[key]) for row in parse_features(request.body, {key}, key_field=key) if key in row]
+    bbox = union_bbox(driver.extent_of_rows(fids))
+    driver.delete_rows(fids)
+
+    dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
+    if fids:
+        dispatch.features_deleted.send(sender=DataResource, instance=ds, user=user, count=len(fids), fid=fids, bbox=bbox)
+    return HttpResponse()
+
+
 def get_row(request, slug=None, ogc_fid=None, *args, **kwargs):
     ds = get_object_or_404(DataResource, slug=slug)
     ds.driver_instance.ready_data_resource()
@@ -245,7 +364,7 @@ def get_row(request, slug=None, ogc_fid=None, *args, **kwargs):
 
     dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
     dispatch.features_retrieved.send(sender=DataResource, instance=ds, user=user, count=1, fid=ogc_fid)
-    return json_or_jsonp(request, geojson_transform(request, row))
+    return json_or_jsonp(request, geojson_transform(request, row, ds.driver_instance._geometry_field))
 
 
 def get_rows(request, slug=None, ogc_fid_start=None, ogc_fid_end=None, limit=None, *args, **kwargs):
@@ -263,7 +382,7 @@ def get_rows(request, slug=None, ogc_fid_start=None, ogc_fid_end=None, limit=Non
 
     dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
     dispatch.features_retrieved.send(sender=DataResource, instance=ds, user=user, count=len(rows))
-    return json_or_jsonp(request, geojson_transform(request, rows))
+    return json_or_jsonp(request, geojson_transform(request, rows, ds.driver_instance._geometry_field))
 
 
 def query(request, slug=None, **kwargs):
@@ -284,26 +403,212 @@ def query(request, slug=None, **kwargs):
     only = request.REQUEST.get('only', None)
     if only:
         only = only.split(',')
+    tolerance = request.REQUEST.get('tolerance', None)
+    tolerance = float(tolerance) if tolerance else None
+    zoom = maybeint(request.REQUEST.get('zoom', None))
+    precision = maybeint(request.REQUEST.get('precision', None))
 
     rest = {k: v for k, v in request.REQUEST.items() if
-            k not in {'limit', 'start', 'end', 'only', 'g', 'op', 'format', 'api_key','callback','jsonp', '_'}}
-
-    rows = ds.driver_instance.query(
-        query_mbr=geometry_mbr,
-        query_geometry=geometry,
-        geometry_format=geometry_format if geometry_format != 'geojsonreal' else 'geojson',
-        geometry_operator=geometry_operator,
-        query_geometry_srid=srid,
-        limit=limit,
-        start=start,
-        end=end,
-        only=only,
-        **rest
+            k not in {'limit', 'start', 'end', 'only', 'g', 'op', 'format', 'tolerance', 'zoom', 'precision',
+                      'api_key', 'callback', 'jsonp', '_'}}
+
+    cache = QueryResultCache.get_cache()
+    version = dataset_version(ds.slug)  # read before the query runs, so an edit during it isn't missed
+    cache_params = dict(
+        rest,
+        _mbr=geometry_mbr,
+        _g=geometry,
+        _format=geometry_format if geometry_format != 'geojsonreal' else 'geojson',
+        _op=geometry_operator,
+        _srid=srid,
+        _limit=limit,
+        _start=start,
+        _end=end,
+        _only=only,
+        _tolerance=tolerance,
+        _zoom=zoom,
+        _precision=precision
     )
+    rows = cache.get(ds.slug, cache_params, version)
+    if rows is None:
+        try:
+            rows = ds.driver_instance.query(
+                query_mbr=geometry_mbr,
+                query_geometry=geometry,
+                geometry_format=geometry_format if geometry_format != 'geojsonreal' else 'geojson',
+                geometry_operator=geometry_operator,
+                query_geometry_srid=srid,
+                limit=limit,
+                start=start,
+                end=end,
+                only=only,
+                tolerance=tolerance,
+                zoom=zoom,
+                precision=precision,
+                **rest
+            )
+        except ValueError as e:  # a malformed query, such as nearest:N without a geometry
+            return HttpResponseBadRequest(str(e))
+        cache.set(ds.slug, cache_params, rows, version)
 
     dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
     dispatch.features_retrieved.send(sender=DataResource, instance=ds, user=user, count=len(rows))
-    return json_or_jsonp(request, geojson_transform(request, rows))
+    return json_or_jsonp(request, geojson_transform(request, rows, ds.driver_instance._geometry_field))
+
+
+def aggregate(request, slug=None, **kwargs):
+    """
+    Aggregate a dataset in the database.  Parameters:
+
+        * agg: comma separated aggregates, either "count" or function:column where function is count, sum, avg, min, max
+        * group_by: comma separated columns to group by
+        * grid: group by square cells of this size in native units
+        * zones: group by the polygons of this dataset, identified by zone_key (default the zones' key field)
+        * bbox, g, op, srid and column filters: as for query
+    """
+    ds = get_object_or_404(DataResource, slug=slug)
+    user = authorize(request, ds, view=True)
+
+    ds.driver_instance.ready_data_resource()
+    maybeint = lambda x: int(x) if x else None
+
+    aggregates = []
+    for spec in request.REQUEST.get('agg', 'count').split(','):
+        function, _, column = spec.partition(':')
+        aggregates.append((function, column or '*'))
+    group_by = [c for c in request.REQUEST.get('group_by', '').split(',') if c]
+    bbox = request.REQUEST.get('bbox', None)
+    zones = request.REQUEST.get('zones', None)
+    if zones:
+        zones = get_object_or_404(DataResource, slug=zones)
+        authorize(request, zones, view=True)
+
+    rest = {k: v for k, v in request.REQUEST.items() if
+            k not in {'agg', 'group_by', 'grid', 'zones', 'zone_key', 'bbox', 'g', 'op', 'srid', 'start', 'end',
+                      'api_key', 'callback', 'jsonp', '_'}}
+
+    cache = QueryResultCache.get_cache()
+    version = dataset_version(ds.slug)
+    cache_params = dict(
+        rest,
+        _aggregate=aggregates,
+        _group_by=group_by,
+        _grid=request.REQUEST.get('grid', None),
+        _zones=zones.slug if zones else None,
+        _zones_version=dataset_version(zones.slug) if zones else None,  # edited zones change every aggregate
+        _zone_key=request.REQUEST.get('zone_key', None),
+        _bbox=bbox,
+        _g=request.REQUEST.get('g', None),
+        _op=request.REQUEST.get('op', 'intersects'),
+        _srid=request.REQUEST.get('srid', None),
+        _start=request.REQUEST.get('start', None),
+        _end=request.REQUEST.get('end', None)
+    )
+    rows = cache.get(ds.slug, cache_params, version)
+    if rows is None:
+        try:
+            rows = ds.driver_instance.aggregate(
+                aggregates=aggregates,
+                group_by=group_by,
+                grid=request.REQUEST.get('grid', None),
+                zones=zones,
+                zone_key=request.REQUEST.get('zone_key', None),
+                query_mbr=[float(b) for b in bbox.split(',')] if bbox else None,
+                query_geometry=request.REQUEST.get('g', None),
+                geometry_operator=request.REQUEST.get('op', 'intersects'),
+                query_geometry_srid=request.REQUEST.get('srid', None),
+                start=maybeint(request.REQUEST.get('start', None)),
+                end=maybeint(request.REQUEST.get('end', None)),
+                **rest
+            )
+        except ValueError as e:  # an unknown aggregate function or column, or a malformed bbox or grid
+            return HttpResponseBadRequest(str(e))
+        cache.set(ds.slug, cache_params, rows, version)
+
+    dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
+    return json_or_jsonp(request, rows)
+
+
+def distribution(request, slug=None, column=None, **kwargs):
+    """
+    The distribution of one column's values, for building style classes.  Parameters:
+
+        * bins: number of equal width histogram bins (default 10)
+        * classes: number of classes to break the values into (default 5)
+        * methods: comma separated classification methods, from equal_interval, quantile and jenks (default all)
+        * top: number of most common values to return (default 10)
+    """
+    ds = get_object_or_404(DataResource, slug=slug)
+    user = authorize(request, ds, view=True)
+
+    if column not in ds.driver_instance.schema():
+        raise Http404('no column {column}'.format(column=column))
+
+    try:
+        options = dict(
+            bins=int(request.REQUEST.get('bins', 10)),
+            classes=int(request.REQUEST.get('classes', 5)),
+            methods=[m for m in request.REQUEST.get('methods', ','.join(CLASSIFICATION_METHODS)).split(',') if m],
+            top=int(request.REQUEST.get('top', 10))
+        )
+    except ValueError:
+        return HttpResponseBadRequest('bins, classes and top must be integers')
+    if options['bins'] < 1 or options['classes'] < 1 or options['top'] < 0:
+        return HttpResponseBadRequest('bins and classes must be positive, and top not negative')
+    unknown = [m for m in options['methods'] if m not in CLASSIFICATION_METHODS]
+    if unknown:
+        return HttpResponseBadRequest('unknown classification methods {unknown}, use {methods}'.format(
+            unknown=','.join(unknown), methods=','.join(CLASSIFICATION_METHODS)))
+
+    cache = QueryResultCache.get_cache()
+    version = dataset_version(ds.slug)
+    cache_params = dict(options, _distribution=column)
+    result = cache.get(ds.slug, cache_params, version)
+    if result is None:
+        result = ds.driver_instance.column_distribution(column, **options)
+        cache.set(ds.slug, cache_params, result, version)
+
+    dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
+    return json_or_jsonp(request, result)
+
+
+@csrf_exempt
+def points(request, slug=None, **kwargs):
+    """
+    Sample a layer at many points in one request.  The body is a JSON array of [x, y] pairs, or a GeoJSON MultiPoint.
+    Parameters:
+
+        * srs: the coordinate system of the points, as EPSG:#### or a PROJ.4 string (default EPSG:4326)
+        * fuzziness: the distance in meters around each point to pull features from (default 0)
+
+    Returns a list with an entry for each point, in order: the features at it for vector data, or the band values
+    for rasters.
+    """
+    ds = get_object_or_404(DataResource, slug=slug)
+    user = authorize(request, ds, view=True)
+
+    try:
+        body = json.loads(request.body)
+        coordinates = body.get('coordinates', None) if isinstance(body, dict) else body
+        if not isinstance(coordinates, list):
+            raise ValueError('expected a JSON array of [x, y] pairs or a GeoJSON MultiPoint')
+        points = []
+        for c in coordinates:
+            if not isinstance(c, (list, tuple)) or len(c) < 2:
+                raise ValueError('each point should be an [x, y] pair, not {c}'.format(c=json.dumps(c)))
+            points.append((float(c[0]), float(c[1])))
+        fuzziness = float(request.REQUEST.get('fuzziness', 0))
+    except (ValueError, TypeError) as e:  # json.loads raises ValueError for a malformed body
+        return HttpResponseBadRequest(str(e))
+    srs = request.REQUEST.get('srs', 'EPSG:4326')
+
+    try:
+        result = ds.driver_instance.get_data_for_points(points, srs, fuzziness=fuzziness)
+    except ValueError as e:  # an unrecognized srs
+        return HttpResponseBadRequest(str(e))
+
+    dispatch.api_accessed.send(sender=DataResource, instance=ds, user=user)
+    return json_or_jsonp(request, result)
 
 
 class CRUDView(View):
@@ -338,3 +643,22 @@ class CRUDView(View):
     def delete(self, request, *args, **kwargs):
         return delete_row(request, kwargs['slug'], kwargs.get('ogc_fid', None))
 
+
+
+
+class BulkCRUDView(View):
+    """Batch versions of the row endpoints.  Bodies are a JSON array or newline-delimited JSON of rows or GeoJSON
+    Features, and each batch is written in one transaction and announced with one signal."""
+
+    @method_decorator(csrf_exempt)
+    def dispatch(self, *args, **kwargs):
+        return super(BulkCRUDView, self).dispatch(*args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        return add_rows(request, kwargs['slug'])
+
+    def put(self, request, *args, **kwargs):
+        return update_rows(request, kwargs['slug'])
+
+    def delete(self, request, *args, **kwargs):
+        return delete_rows(request, kwargs['slug'])